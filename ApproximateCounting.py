@@ -0,0 +1,97 @@
+import hashlib
+import heapq
+
+DISTINCT_SKETCH_SIZE = 4096
+HASH_RANGE = 1 << 64
+
+class SpaceSaving:
+    """
+        A Space-Saving heavy-hitters sketch (Metwally, Agrawal & El Abbadi, 2005) counting keys in at most `capacity` counters,
+        used instead of an unbounded count dictionary when the distinct keys don't fit in memory.
+        A key that isn't monitored replaces the key with the smallest count m and takes the count m + 1, so with N counted keys:
+            - A count never underestimates, and overestimates by at most errors[key] <= N / capacity.
+            - Every key occurring more than N / capacity times is monitored.
+            - The counts always sum to N, the true total mass, so count / N is normalized like the exact distribution.
+        The smallest counter is found with a lazy min-heap holding an entry per monitored key, whose count may lag behind the key's count:
+        stale entries are only refreshed when they reach the top of the heap.
+        The number of distinct keys, which the sub models are sized by, is estimated with a DistinctCounter of the keys that enter the sketch.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+        self.distinct = DistinctCounter()
+
+    def update(self, keys):
+        """
+            Counts every key of the iterable once.
+        """
+        counts, errors, heap, capacity = self.counts, self.errors, self.heap, self.capacity
+        heappush, heapreplace = heapq.heappush, heapq.heapreplace
+        for key in keys:
+            self.total += 1
+            if key in counts:
+                counts[key] += 1
+                continue
+            self.distinct.add(key)
+            if len(counts) < capacity:
+                counts[key] = 1
+                errors[key] = 0
+                heappush(heap, (1, key))
+                continue
+            (count, evicted_key) = heap[0]
+            while counts[evicted_key] != count:
+                heapreplace(heap, (counts[evicted_key], evicted_key))
+                (count, evicted_key) = heap[0]
+            del counts[evicted_key]
+            del errors[evicted_key]
+            counts[key] = count + 1
+            errors[key] = count
+            heapreplace(heap, (count + 1, key))
+
+    def error_bound(self):
+        """
+            Returns the largest possible overestimation of a count, N / capacity.
+        """
+        return self.total / self.capacity
+
+    def distinct_count(self):
+        """
+            Returns the estimated number of distinct keys counted.
+        """
+        return max(self.distinct.estimate(), len(self.counts))
+
+    def items(self):
+        return self.counts.items()
+
+    def __len__(self):
+        return len(self.counts)
+
+class DistinctCounter:
+    """
+        A K-Minimum-Values sketch (Bar-Yossef et al., 2002) estimating the number of distinct keys added to it from the `size` smallest
+        64 bit hashes of the keys. Below `size` distinct keys the count is exact, above it the relative standard error is about 1 / sqrt(size).
+    """
+    def __init__(self, size: int = DISTINCT_SKETCH_SIZE):
+        self.size = size
+        self.hashes = set()
+        # A max-heap (of negated hashes) of the kept hashes.
+        self.heap = []
+
+    def add(self, key: str):
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+        if key_hash in self.hashes:
+            return
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, -key_hash)
+            self.hashes.add(key_hash)
+        elif key_hash < -self.heap[0]:
+            self.hashes.discard(-heapq.heapreplace(self.heap, -key_hash))
+            self.hashes.add(key_hash)
+
+    def estimate(self):
+        if len(self.heap) < self.size:
+            return len(self.heap)
+        return int((self.size - 1) * HASH_RANGE / -self.heap[0])
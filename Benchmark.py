@@ -0,0 +1,504 @@
+import datetime
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+import CleanLabeledData
+import CreateProbabilityDistribution
+import DataLabelingUtils
+import DataPreparation
+import GuessEnumerator
+import Instrumentation
+import math
+import ModelTrainingUtils
+import PasswordScorer
+from FilesUtils import save_json_array_to_file, save_labeled_records, pop_cli_option, iter_line_blocks
+
+# (email domain, weight) pairs of the generated dumps. Generic domains (.com, .net, .org) resolve to no country, like in real dumps.
+DOMAIN_WEIGHTS = [
+    ("gmail.com", 20), ("yahoo.com", 8), ("hotmail.com", 8), ("aol.com", 2), ("mail.net", 1), ("post.org", 1),
+    ("qq.com.cn", 8), ("163.cn", 6), ("sina.cn", 3),
+    ("mail.ru", 6), ("yandex.ru", 3),
+    ("web.de", 4), ("gmx.de", 3),
+    ("wp.pl", 4), ("o2.pl", 2), ("interia.pl", 1),
+    ("libero.it", 3), ("virgilio.it", 1),
+    ("orange.fr", 3), ("free.fr", 2),
+    ("yahoo.co.jp", 3), ("docomo.ne.jp", 1),
+    ("rediffmail.co.in", 2), ("btinternet.co.uk", 3), ("sky.co.uk", 1),
+    ("walla.co.il", 1), ("uol.com.br", 2), ("terra.es", 1)
+]
+# Weights of the password lengths 4..16, peaking at 8 like leaked password lists.
+PASSWORD_LENGTH_WEIGHTS = [2, 4, 12, 16, 18, 14, 10, 8, 6, 4, 3, 2, 1]
+# (character class structure, weight) pairs of the generated passwords.
+PASSWORD_CLASS_WEIGHTS = [("lower", 30), ("lower_digits", 28), ("digits", 14), ("capitalized_digits", 10), ("leet", 6), ("symbols", 7), ("random", 5)]
+LEET_REPLACEMENTS = {"a": "@", "e": "3", "i": "1", "o": "0", "s": "$"}
+NON_ASCII_CHARACTERS = "éüñçøß密码пароль"
+SYMBOLS = "!@#$%&*."
+DIGIT_SUFFIXES = ["1", "12", "123", "1234", "01", "007", "11", "99", "2000", "1990", "1987", "2020", "69", "777"]
+VOCABULARY_SIZE = 50000
+NON_ASCII_RATE = 0.01
+MALFORMED_RATE = 0.005
+SEMICOLON_RATE = 0.02
+COUNTRY_FILES_COUNT = 3
+STAGES = ["label", "clean", "country", "count", "distribution"]
+REGRESSION_THRESHOLD = 0.1
+# Raw rows the generated dumps don't have: escapes (some decoding to a separator or a non ascii character, some invalid), carriage returns,
+# empty rows and rows without a separator. They are parsed by check_raw_parsing before the rows of the dump, in order and reversed with a last
+# non ascii row without a line break, so the runs of ascii rows between them start and end at every kind of row.
+EDGE_CASE_ROWS = [
+    b"name@mail.de:pass\\x3aword\n", b"name\\x3a@mail.de;password1\n", b"name@mail.de:pass\\u00e9word\n", b"name@mail.de:password\\\n",
+    b"name@mail.de:pass\\N{bad}\n", b"n\xc3\xa9me@mail.de:password1\n", b"name@mail.de:p\xc3\xa9ssword\n", b"name@mail.de:password1\r\n",
+    b"name@mail.de;pass:word1\n", b"name@mail.de\n", b"\n", b":\n", b";\n", b"name@mail.de:password1"
+]
+
+# Passwords the generated dumps rarely or never have: no letters, a single letter, a letter last, leet characters outside the base word,
+# "6" and "9" (whose leet transformations have int keys, so they are never leet characters of a str) and non ascii letters.
+# They are checked by check_password_features before the passwords of the dump.
+EDGE_CASE_PASSWORDS = [
+    "", "1", "123456", "!@#$", "6969", "a", "1a", "a1", "1a1", "A", "12A34", "pass", "Pass1", "passworD", "1passworD", "p@ss", "p@4ss",
+    "h3ll0W0rld", "@dmin", "@dmin!", "4dm1n", "adm1n", "gg6g9", "6dog9", "9lives6", "p@ss6", "M1X3d!C@SE%x", "0o0o", "$tar$", "x%x%",
+    "ÉCOLE1", "straße", "пароль123", "密码a"
+]
+
+def generate_dump(file_path: str, records: int, seed: int = 0):
+    """
+        Writes a deterministic synthetic dump of `records` "email:password" lines to file_path.
+        The same records and seed always produce the same bytes. The emails follow DOMAIN_WEIGHTS, the passwords follow PASSWORD_LENGTH_WEIGHTS and
+        PASSWORD_CLASS_WEIGHTS with base words drawn from a Zipf-like vocabulary, so the count dictionaries have realistic repetitions.
+        A NON_ASCII_RATE of the passwords contain non-ASCII characters, a MALFORMED_RATE of the lines have no separator and a SEMICOLON_RATE use ';'.
+        Returns the number of bytes written.
+    """
+    generator = random.Random(seed)
+    vocabulary = ["".join(generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(generator.randint(3, 10))) for _ in range(VOCABULARY_SIZE)]
+    vocabulary_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCABULARY_SIZE)))
+    domains = [domain for domain, _ in DOMAIN_WEIGHTS]
+    domain_weights = list(itertools.accumulate(weight for _, weight in DOMAIN_WEIGHTS))
+    lengths = list(range(4, 4 + len(PASSWORD_LENGTH_WEIGHTS)))
+    length_weights = list(itertools.accumulate(PASSWORD_LENGTH_WEIGHTS))
+    classes = [name for name, _ in PASSWORD_CLASS_WEIGHTS]
+    class_weights = list(itertools.accumulate(weight for _, weight in PASSWORD_CLASS_WEIGHTS))
+
+    bytes_written = 0
+    with open(file_path, "wb") as file:
+        for index in range(records):
+            length = generator.choices(lengths, cum_weights=length_weights)[0]
+            password_class = generator.choices(classes, cum_weights=class_weights)[0]
+            word = generator.choices(vocabulary, cum_weights=vocabulary_weights)[0]
+            password = create_password(generator, password_class, word, length)
+            if generator.random() < NON_ASCII_RATE:
+                position = generator.randint(0, len(password))
+                password = password[ : position] + generator.choice(NON_ASCII_CHARACTERS) + password[position : ]
+            name = generator.choices(vocabulary, cum_weights=vocabulary_weights)[0] + (str(generator.randint(1, 9999)) if generator.random() < 0.5 else "")
+            email = f"{name}@{generator.choices(domains, cum_weights=domain_weights)[0]}"
+            separator = ";" if generator.random() < SEMICOLON_RATE else ":"
+            line = f"{email}{password}\n" if generator.random() < MALFORMED_RATE else f"{email}{separator}{password}\n"
+            encoded_line = line.encode("utf-8")
+            file.write(encoded_line)
+            bytes_written += len(encoded_line)
+    return bytes_written
+
+def create_password(generator, password_class: str, word: str, length: int):
+    """
+        Creates a password of the provided character class structure around a vocabulary word, of about the provided length.
+    """
+    if password_class == "digits":
+        return "".join(generator.choice("0123456789") for _ in range(length))
+    if password_class == "random":
+        return "".join(generator.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789" + SYMBOLS) for _ in range(length))
+    base_word = (word * (length // len(word) + 1))[ : max(length - 2, 3)] if len(word) < length - 2 else word
+    if password_class == "lower":
+        return base_word
+    suffix = generator.choice(DIGIT_SUFFIXES)
+    if password_class == "lower_digits":
+        return base_word + suffix
+    if password_class == "capitalized_digits":
+        return base_word.capitalize() + suffix
+    if password_class == "leet":
+        return "".join(LEET_REPLACEMENTS.get(char, char) for char in base_word) + suffix
+    return base_word + generator.choice(SYMBOLS) + (suffix if generator.random() < 0.5 else "")
+
+def run_stage(stage: str, work_path: str, state: dict):
+    """
+        Runs a single stage of the pipeline on the benchmark's work directory and measures it. Runs inside a fresh child process, so the peak RSS
+        (see Instrumentation.get_peak_rss_mb) is the stage's own. It is None where the platform doesn't provide it.
+        Returns a tuple of (measurements, state) where state holds what the following stages need.
+    """
+    start, start_cpu = time.perf_counter(), time.process_time()
+    (records, state) = STAGE_FUNCTIONS[stage](work_path, dict(state))
+    seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+    measurements = {
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "records": records,
+        "records_per_second": records / seconds if seconds > 0 else 0.0,
+        "peak_rss_mb": Instrumentation.get_peak_rss_mb(children=False)
+    }
+    return (measurements, state)
+
+def label_stage(work_path: str, state: dict):
+    """
+        Labels the dump with DataLabelingUtils.create_origin_label and saves the labeled data file. Counts the dump's lines.
+    """
+    domains_count = defaultdict(int)
+    labeled_data = DataLabelingUtils.create_origin_label(os.path.join(work_path, "raw", "dump.txt"), domains_count)
+    save_labeled_records(labeled_data, os.path.join(work_path, "labeled", "dump.txt_labeled_data.json"))
+    countries = sorted((country for country in domains_count if country not in (None, "null")), key=lambda country: domains_count[country], reverse=True)
+    state["countries"] = countries[ : COUNTRY_FILES_COUNT]
+    state["labeled_records"] = len(labeled_data)
+    return (state["lines"], state)
+
+def clean_stage(work_path: str, state: dict):
+    """
+        Cleans the labeled data with CleanLabeledData.clean_labeled_data. Counts the labeled records.
+    """
+    CleanLabeledData.clean_labeled_data(os.path.join(work_path, "labeled"))
+    return (state["labeled_records"], state)
+
+def country_stage(work_path: str, state: dict):
+    """
+        Creates the country files of the COUNTRY_FILES_COUNT largest countries with DataPreparation.create_country_files.
+        Every country reads all the labeled records, so the records are the labeled records times the number of countries.
+    """
+    destination_path = os.path.join(work_path, "country").replace("\\", "/")
+    for country in state["countries"]:
+        DataPreparation.create_country_files(destination_path=destination_path, path=os.path.join(work_path, "labeled"), country=country, country_data=[], file_index=0)
+    return (state["labeled_records"] * len(state["countries"]), state)
+
+def count_stage(work_path: str, state: dict):
+    """
+        Creates the count dictionaries of every country with CreateProbabilityDistribution.create_count_dictionaries. Counts the passwords of the country files.
+    """
+    records = 0
+    state["distinct_keys"] = 0
+    for country in state["countries"]:
+        destination_path = os.path.join(work_path, "distributions", country)
+        os.makedirs(destination_path, exist_ok=True)
+        count_dics = CreateProbabilityDistribution.create_count_dictionaries(os.path.join(work_path, "country"), country, True, destination_path)
+        records += sum(count_dics[0]["data"].values())
+        state["distinct_keys"] += sum(dic_data["total_size"] for dic_data in count_dics)
+    return (records, state)
+
+def distribution_stage(work_path: str, state: dict):
+    """
+        Creates the probability distributions of every country from its saved count dictionaries with CreateProbabilityDistribution.create_probability_disribution.
+        Counts the distinct keys of the count dictionaries.
+    """
+    for country in state["countries"]:
+        destination_path = os.path.join(work_path, "distributions", country)
+        with open(os.path.join(destination_path, "count_dict.json"), "r") as file:
+            count_dics = json.load(file)
+        CreateProbabilityDistribution.create_probability_disribution(count_dics, destination_path)
+    return (state["distinct_keys"], state)
+
+STAGE_FUNCTIONS = {
+    "label": label_stage,
+    "clean": clean_stage,
+    "country": country_stage,
+    "count": count_stage,
+    "distribution": distribution_stage
+}
+
+def run_benchmark(work_path: str, records: int, seed: int = 0):
+    """
+        Generates a dump of `records` lines in work_path and runs the pipeline stages on it in order, each in a fresh child process.
+        The work directory is recreated, so every run starts from the same files.
+        Returns the results as a dictionary of the run's parameters and the measurements of every stage.
+    """
+    if os.path.isdir(work_path):
+        shutil.rmtree(work_path)
+    for directory in ["raw", "labeled", "country", "distributions"]:
+        os.makedirs(os.path.join(work_path, directory))
+    start = time.perf_counter()
+    dump_bytes = generate_dump(os.path.join(work_path, "raw", "dump.txt"), records, seed)
+    results = {
+        "records": records,
+        "seed": seed,
+        "dump_bytes": dump_bytes,
+        "generate_seconds": time.perf_counter() - start,
+        "date": str(datetime.datetime.now()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "stages": {}
+    }
+    state = {"lines": records}
+    context = multiprocessing.get_context("spawn")
+    for stage in STAGES:
+        with context.Pool(processes=1) as pool:
+            (measurements, state) = pool.apply(run_stage, (stage, work_path, state))
+        results["stages"][stage] = measurements
+        peak_rss = f"{measurements['peak_rss_mb']:.1f} MB" if measurements["peak_rss_mb"] is not None else "peak RSS unavailable"
+        print(f"{stage}: {measurements['seconds']:.2f}s, {measurements['records_per_second']:.0f} records/s, {peak_rss}")
+    results["countries"] = state["countries"]
+    return results
+
+def check_approximate_counting(work_path: str, capacities: list):
+    """
+        Compares approximate counting (CreateProbabilityDistribution.count_files with a capacity) to exact counting on the country files of a benchmark run.
+        For every country, capacity and count dictionary, reports the exact and estimated number of distinct keys, the observed and guaranteed
+        (N / capacity) largest count error, and for every ratio the recall of the exact top n keys in the approximate top n and the largest error
+        in the probability of an exact top n key. The tracemalloc peak of every counting is reported too.
+        Returns the results as a dictionary of {country: {"exact_peak_mb", "capacities": {capacity: {...}}}}.
+    """
+    results = {}
+    country_path = os.path.join(work_path, "country")
+    for country in sorted(os.listdir(country_path)):
+        file_paths = CreateProbabilityDistribution.get_files_to_count(country_path, country)
+        (exact_counts, exact_peak_mb) = trace_peak_memory(CreateProbabilityDistribution.count_files, file_paths)
+        results[country] = {"exact_peak_mb": exact_peak_mb, "capacities": {}}
+        for capacity in capacities:
+            (approximate_counts, approximate_peak_mb) = trace_peak_memory(CreateProbabilityDistribution.count_files, file_paths, capacity)
+            dictionaries = {}
+            for name, exact_dic, sketch in zip(CreateProbabilityDistribution.COUNT_DICTIONARIES_NAMES, exact_counts[0], approximate_counts[0]):
+                total_mass = sketch.total
+                ratios = {}
+                for ratio in CreateProbabilityDistribution.RATIOS:
+                    n = len(exact_dic) // ratio if len(exact_dic) > (ratio * 2) else 2
+                    approximate_n = sketch.distinct_count() // ratio if sketch.distinct_count() > (ratio * 2) else 2
+                    exact_top = heapq.nlargest(n, exact_dic.items(), key=lambda item: item[1])
+                    approximate_top = {key for key, _ in heapq.nlargest(approximate_n, sketch.items(), key=lambda item: item[1])}
+                    ratios[ratio] = {
+                        "n": n,
+                        "approximate_n": approximate_n,
+                        "recall": sum(1 for key, _ in exact_top if key in approximate_top) / max(len(exact_top), 1),
+                        "max_probability_error": max((abs(sketch.counts.get(key, 0) - count) / total_mass for key, count in exact_top), default=0.0)
+                    }
+                dictionaries[name] = {
+                    "exact_keys": len(exact_dic),
+                    "kept_keys": len(sketch),
+                    "estimated_keys": sketch.distinct_count(),
+                    "total_mass": total_mass,
+                    "max_count_error": max((count - exact_dic[key] for key, count in sketch.items()), default=0),
+                    "error_bound": sketch.error_bound(),
+                    "ratios": ratios
+                }
+            results[country]["capacities"][capacity] = {"approximate_peak_mb": approximate_peak_mb, "dictionaries": dictionaries}
+            base_words = dictionaries["base_word_count"]
+            print(f"{country}, capacity {capacity}: {base_words['exact_keys']} base words, estimated {base_words['estimated_keys']}, "
+                  f"ratio {CreateProbabilityDistribution.RATIOS[-1]} recall {base_words['ratios'][CreateProbabilityDistribution.RATIOS[-1]]['recall']:.3f}, "
+                  f"peak {exact_peak_mb:.1f} -> {approximate_peak_mb:.1f} MB")
+    return results
+
+def check_raw_parsing(dump_path: str, repeats: int = 3):
+    """
+        Checks the block parser of the raw rows (DataLabelingUtils.parse_raw_lines) against the row parser (DataLabelingUtils.parse_raw_line)
+        on EDGE_CASE_ROWS and every block of the dump, and times both on the dump in lines per second (the best of `repeats` runs).
+        Returns the results as a dictionary, with the number of blocks whose pairs differ as "mismatched_blocks" and the number of blocks of the
+        dump mixing ascii rows with non ascii or escaped rows (which the block parser decodes a run of ascii rows at a time) as "mixed_blocks".
+    """
+    edge_case_blocks = [b"".join(EDGE_CASE_ROWS), b"".join(reversed(EDGE_CASE_ROWS[ : -1])) + b"name@mail.de:p\xc3\xa9ssword"]
+    blocks = edge_case_blocks + list(iter_line_blocks(dump_path))
+    rows_by_block = []
+    for block in blocks:
+        rows = [row + b"\n" for row in block.split(b"\n")]
+        rows[-1] = rows[-1][ : -1]
+        rows_by_block.append([row for row in rows if row])
+    mismatched_blocks = 0
+    for block, rows in zip(blocks, rows_by_block):
+        expected_pairs = [pair for pair in map(DataLabelingUtils.parse_raw_line, rows) if pair is not None]
+        if DataLabelingUtils.parse_raw_lines(block) != expected_pairs:
+            mismatched_blocks += 1
+    dump_rows_by_block, dump_blocks = rows_by_block[len(edge_case_blocks) : ], blocks[len(edge_case_blocks) : ]
+    lines = sum(len(rows) for rows in dump_rows_by_block)
+    mixed_blocks = sum(1 for block in dump_blocks if not block.isascii() or b"\\" in block)
+    row_seconds, block_seconds = float("inf"), float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for rows in dump_rows_by_block:
+            for row in rows:
+                DataLabelingUtils.parse_raw_line(row)
+        row_seconds = min(row_seconds, time.perf_counter() - start)
+        start = time.perf_counter()
+        for block in dump_blocks:
+            DataLabelingUtils.parse_raw_lines(block)
+        block_seconds = min(block_seconds, time.perf_counter() - start)
+    results = {
+        "lines": lines,
+        "mismatched_blocks": mismatched_blocks,
+        "mixed_blocks": mixed_blocks,
+        "row_lines_per_second": lines / row_seconds if row_seconds > 0 else 0.0,
+        "block_lines_per_second": lines / block_seconds if block_seconds > 0 else 0.0
+    }
+    print(f"{lines} lines, {mismatched_blocks} mismatched blocks, {mixed_blocks} of {len(dump_blocks)} blocks mixed, {results['row_lines_per_second']:.0f} -> {results['block_lines_per_second']:.0f} lines/s")
+    return results
+
+def check_password_features(dump_path: str, repeats: int = 3):
+    """
+        Checks the single scan feature extraction (ModelTrainingUtils.extract_password_features, with its patterns rendered) against the features
+        of parse_password_to_3d, get_base_word_shift_pattern and get_base_word_leet_pattern on EDGE_CASE_PASSWORDS and every password of the dump,
+        and times both on the dump in passwords per second (the best of `repeats` runs).
+        Returns the results as a dictionary, with the number of passwords whose features differ as "mismatched_passwords".
+    """
+    passwords = list(EDGE_CASE_PASSWORDS)
+    for block in iter_line_blocks(dump_path):
+        passwords.extend(pair[1] for pair in DataLabelingUtils.parse_raw_lines(block))
+    mismatched_passwords = 0
+    for password in passwords:
+        if get_password_features(password) != get_old_password_features(password):
+            mismatched_passwords += 1
+            print(f"Mismatched features of {password!r}: {get_password_features(password)} != {get_old_password_features(password)}")
+    dump_passwords = passwords[len(EDGE_CASE_PASSWORDS) : ]
+    old_seconds, new_seconds = float("inf"), float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for password in dump_passwords:
+            get_old_password_features(password)
+        old_seconds = min(old_seconds, time.perf_counter() - start)
+        start = time.perf_counter()
+        for password in dump_passwords:
+            ModelTrainingUtils.extract_password_features(password)
+        new_seconds = min(new_seconds, time.perf_counter() - start)
+    results = {
+        "passwords": len(passwords),
+        "mismatched_passwords": mismatched_passwords,
+        "old_passwords_per_second": len(dump_passwords) / old_seconds if old_seconds > 0 else 0.0,
+        "new_passwords_per_second": len(dump_passwords) / new_seconds if new_seconds > 0 else 0.0
+    }
+    print(f"{len(passwords)} passwords, {mismatched_passwords} mismatched, {results['old_passwords_per_second']:.0f} -> {results['new_passwords_per_second']:.0f} passwords/s")
+    return results
+
+def get_password_features(password: str):
+    """
+        Returns the features of extract_password_features with the patterns rendered, as get_old_password_features returns them.
+    """
+    (prefix, base_word, suffix, shift_pattern, leet_pattern, unleet_base_word) = ModelTrainingUtils.extract_password_features(password)
+    return (prefix, base_word, suffix, ModelTrainingUtils.render_shift_pattern(shift_pattern), ModelTrainingUtils.render_leet_pattern(leet_pattern), unleet_base_word)
+
+def get_old_password_features(password: str):
+    """
+        Returns the features of the password as the counting computed them before extract_password_features, one function per feature.
+    """
+    (prefix, base_word, suffix) = ModelTrainingUtils.parse_password_to_3d(password)
+    (leet_pattern, unleet_base_word) = ModelTrainingUtils.get_base_word_leet_pattern(base_word)
+    return (prefix, base_word, suffix, str(ModelTrainingUtils.get_base_word_shift_pattern(base_word)), str(leet_pattern), unleet_base_word)
+
+def check_guess_probabilities(model_path: str, max_guesses: int, ratio: int = None):
+    """
+        Checks that the guesses of GuessEnumerator.enumerate_guesses round-trip through PasswordScorer: the scorer decomposes every one of the
+        first max_guesses guesses back to the components it was enumerated from, so it gives the guess the probability it was enumerated with.
+        Returns the results as a dictionary, with the number of guesses whose probabilities differ as "mismatched_guesses".
+    """
+    scorer = PasswordScorer.PasswordScorer(model_path, ratio)
+    guesses, mismatched_guesses = 0, 0
+    for guess, probability in itertools.islice(GuessEnumerator.enumerate_guesses(model_path, ratio), max_guesses):
+        guesses += 1
+        scored_probability = scorer.probability(guess)
+        # The enumeration multiplies the probabilities in another order, so they may differ in the last bits.
+        if not math.isclose(probability, scored_probability, rel_tol=1e-9):
+            mismatched_guesses += 1
+            print(f"Mismatched probability of {guess!r}: enumerated {probability}, scored {scored_probability}")
+    print(f"{guesses} guesses, {mismatched_guesses} mismatched")
+    return {"guesses": guesses, "mismatched_guesses": mismatched_guesses}
+
+def trace_peak_memory(function, *args):
+    """
+        Calls the function and returns a tuple of its result and the peak memory it allocated in MB, as traced by tracemalloc.
+    """
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (result, peak / 1024 / 1024)
+
+def compare_results(baseline: dict, current: dict, threshold: float = REGRESSION_THRESHOLD):
+    """
+        Compares the stages of two benchmark results.
+        Returns a list of the regressions: stages whose records/sec dropped, or whose peak RSS grew, by more than `threshold` (a fraction) of the baseline.
+        Peak RSS is only compared when both results measured it.
+    """
+    regressions = []
+    for stage, baseline_measurements in baseline["stages"].items():
+        if stage not in current["stages"]:
+            continue
+        current_measurements = current["stages"][stage]
+        if current_measurements["records_per_second"] < baseline_measurements["records_per_second"] * (1 - threshold):
+            regressions.append(f"{stage}: {baseline_measurements['records_per_second']:.0f} -> {current_measurements['records_per_second']:.0f} records/s")
+        if None in (current_measurements["peak_rss_mb"], baseline_measurements["peak_rss_mb"]):
+            continue
+        if current_measurements["peak_rss_mb"] > baseline_measurements["peak_rss_mb"] * (1 + threshold):
+            regressions.append(f"{stage}: {baseline_measurements['peak_rss_mb']:.1f} -> {current_measurements['peak_rss_mb']:.1f} MB peak RSS")
+    return regressions
+
+def main():
+    """
+        Benchmarks the pipeline stages on synthetic data.
+        Usage:
+            python Benchmark.py run <work_path> <records> [--seed <n>] [--output <results_path>]
+            python Benchmark.py generate <dump_path> <records> [--seed <n>]
+            python Benchmark.py compare <baseline_results_path> <results_path> [--threshold <fraction>]
+            python Benchmark.py accuracy <work_path> <capacity>[,<capacity>...] [--output <results_path>]
+            python Benchmark.py parse <dump_path> [--output <results_path>]
+            python Benchmark.py features <dump_path> [--output <results_path>]
+            python Benchmark.py guesses <model_path> <max_guesses> [--ratio <ratio>] [--output <results_path>]
+        Args:
+            run: Generates a dump of `records` lines in work_path, times every stage and saves the results json to --output (defaults to work_path/results.json).
+            generate: Only generates a dump of `records` lines to dump_path.
+            compare: Prints the regressions of a results json against a baseline results json, and exits with 1 if there are any.
+            accuracy: Checks approximate counting with the provided capacities against exact counting on the country files of a run in work_path,
+                      and saves the results json to --output (defaults to work_path/accuracy.json).
+            parse: Checks the block parser of the raw rows against the row parser on the dump and times both, saves the results json to --output
+                   if provided, and exits with 1 if they disagree.
+            features: Checks the single scan feature extraction against the per feature functions on the passwords of the dump and times both,
+                      saves the results json to --output if provided, and exits with 1 if they disagree.
+            guesses: Checks that the scorer gives the first max_guesses guesses of the model the probabilities they were enumerated with (of the
+                     sub model of --ratio, defaults to the full distributions), saves the results json to --output if provided, and exits with 1 if not.
+            --seed: The seed of the generated dump. Defaults to 0.
+            --threshold: The fraction of records/sec or peak RSS change counted as a regression. Defaults to REGRESSION_THRESHOLD.
+    """
+    seed = int(pop_cli_option(sys.argv, "seed", 0))
+    output_path = pop_cli_option(sys.argv, "output")
+    threshold = float(pop_cli_option(sys.argv, "threshold", REGRESSION_THRESHOLD))
+    ratio = pop_cli_option(sys.argv, "ratio")
+    function = sys.argv[1]
+    if function == "run":
+        work_path = sys.argv[2]
+        results = run_benchmark(work_path, int(sys.argv[3]), seed)
+        save_json_array_to_file(results, output_path or os.path.join(work_path, "results.json"))
+    elif function == "generate":
+        generate_dump(sys.argv[2], int(sys.argv[3]), seed)
+    elif function == "compare":
+        with open(sys.argv[2], "r") as file:
+            baseline = json.load(file)
+        with open(sys.argv[3], "r") as file:
+            current = json.load(file)
+        regressions = compare_results(baseline, current, threshold)
+        for regression in regressions:
+            print(regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions")
+    elif function == "accuracy":
+        work_path = sys.argv[2]
+        results = check_approximate_counting(work_path, [int(capacity) for capacity in sys.argv[3].split(",")])
+        save_json_array_to_file(results, output_path or os.path.join(work_path, "accuracy.json"))
+    elif function == "parse":
+        results = check_raw_parsing(sys.argv[2])
+        if output_path:
+            save_json_array_to_file(results, output_path)
+        if results["mismatched_blocks"] > 0:
+            sys.exit(1)
+    elif function == "features":
+        results = check_password_features(sys.argv[2])
+        if output_path:
+            save_json_array_to_file(results, output_path)
+        if results["mismatched_passwords"] > 0:
+            sys.exit(1)
+    elif function == "guesses":
+        results = check_guess_probabilities(sys.argv[2], int(sys.argv[3]), int(ratio) if ratio else None)
+        if output_path:
+            save_json_array_to_file(results, output_path)
+        if results["mismatched_guesses"] > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,58 @@
 import os
 import json
 import sys
+import Instrumentation
 from DataLabelingUtils import is_legal_password
+from FilesUtils import iter_labeled_records, save_labeled_records, is_labeled_data_file, add_path_tag, replace_file, get_file_fingerprint, RunJournal
+
+# The journal of the files cleaned in a directory. It isn't a labeled data file, so it is never cleaned itself.
+CLEAN_JOURNAL_NAME = "clean_journal_log.jsonl"
 
 def filter_passwords(data):
     """
         Filter ilegal passwords from data.
     """
-    filtered_data = []
-    ilegal_passwords_count = 0
+    ilegal_passwords_count = {"ilegal": 0}
+    filtered_data = list(iter_legal_records(data, ilegal_passwords_count))
+    return filtered_data, ilegal_passwords_count["ilegal"]
+
+def iter_legal_records(data, ilegal_passwords_count: dict):
+    """
+        A streaming version of filter_passwords. Yields the records of data with a legal password and counts the rest in ilegal_passwords_count["ilegal"].
+        Items may be records or json-encoded records.
+    """
     for item in data:
-        json_item = json.loads(item)
+        json_item = json.loads(item) if isinstance(item, str) else item
         if 'password' in json_item and is_legal_password(json_item['password']):
-            filtered_data.append(json_item)
+            yield json_item
         else:
-            ilegal_passwords_count += 1
-    return filtered_data, ilegal_passwords_count
+            ilegal_passwords_count["ilegal"] += 1
 
-def clean_labeled_file(file_name: str, path: str):
+def clean_labeled_file(file_name: str, path: str, journal: RunJournal = None):
     """
         Clean a labeled file from ilegal passwords.
+        The records are streamed to a temporary file which then atomically replaces the labeled file (see FilesUtils.replace_file),
+        so an interrupted run never leaves a partially cleaned file.
+        If a journal is provided, the counts are recorded to it with the fingerprint of the cleaned file right before the replace, so a
+        restarted run knows the file was cleaned (and with which counts) if and only if the replace happened.
     """
-    if not str.endswith(file_name, "labeled_data.json"):
+    if not is_labeled_data_file(file_name):
         return 0, 0
     file_path = os.path.join(path, file_name)
+    temp_path = add_path_tag(file_path, ".tmp")
     try:
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-            
-        filtered_data, file_ilegal_data_count = filter_passwords(data)
-        
-        with open(file_path, 'w') as file:
-            json.dump(filtered_data, file, indent=4)
+        with Instrumentation.measure("clean", file_path, profile=True) as measurement:
+            ilegal_passwords_count = {"ilegal": 0}
+            bytes_read = Instrumentation.get_file_size(file_path)
+            filtered_data = iter_legal_records(iter_labeled_records(file_path), ilegal_passwords_count)
+            legal_passwords_count = save_labeled_records(filtered_data, temp_path)
+            if journal is not None:
+                journal.record(file_path, fingerprint=get_file_fingerprint(temp_path), legal=legal_passwords_count, ilegal=ilegal_passwords_count["ilegal"])
+            replace_file(temp_path, file_path)
+            measurement.add(records_in=legal_passwords_count + ilegal_passwords_count["ilegal"], records_out=legal_passwords_count, bytes_read=bytes_read, bytes_written=Instrumentation.get_file_size(file_path))
         
         print("Filtered and updated data saved successfully.")
-        return len(filtered_data), file_ilegal_data_count
+        return legal_passwords_count, ilegal_passwords_count["ilegal"]
         
     except FileNotFoundError:
         print("File not found.")
@@ -42,26 +60,39 @@ def clean_labeled_file(file_name: str, path: str):
         print("Invalid JSON format in the file.")
     except Exception as e:
         print(f"An error occurred: {e}")
+    if os.path.isfile(temp_path):
+        os.remove(temp_path)
 
-def clean_labeled_data(path: str):
+def clean_labeled_data(path: str, recursive: bool = True):
     """
-        Clean all labeled data from ilegal passwords in the provided path.
+        Clean all labeled data from ilegal passwords in the provided path, or only the files directly in it if recursive is False.
+        Every cleaned file is recorded to the CLEAN_JOURNAL_NAME journal of the path, so a restarted run skips the files that were cleaned
+        and still have the fingerprint they were cleaned with, adds their journaled counts, and only cleans the rest. The totals are the same
+        as the totals of an uninterrupted run.
     """
     total_legal_passwords, total_ilegal_passwords = 0, 0
     failed_files = []
     if os.path.isdir(path):
+        journal = RunJournal(os.path.join(path, CLEAN_JOURNAL_NAME))
         for root, directories, files in os.walk(path):
-            # if path has been cleaned and has a cleaned_data.txt file, skip it.
-            if "cleaned_data.txt" in files:
-               return
+            if not recursive:
+                directories.clear()
             for file_name in files:
+                if not is_labeled_data_file(file_name):
+                    continue
+                entry = journal.get(os.path.join(root, file_name))
+                if entry is not None and entry["fingerprint"] == get_file_fingerprint(os.path.join(root, file_name)):
+                    total_legal_passwords += entry["legal"]
+                    total_ilegal_passwords += entry["ilegal"]
+                    continue
                 try:
-                    legal_passwords, ilegal_passwords = clean_labeled_file(file_name, root)
+                    legal_passwords, ilegal_passwords = clean_labeled_file(file_name, root, journal)
                     total_legal_passwords += legal_passwords
                     total_ilegal_passwords += ilegal_passwords
                 except Exception as e:
                     print(f"Failed to clean file {file_name}. Error: {e}")
                     failed_files.append(file_name)
+        journal.close()
     with (open(os.path.join(path, "cleaned_data.txt"), "w")) as file:
         file.write(f"Total legal passwords: {total_legal_passwords}\n")
         file.write(f"Total ilegal passwords: {total_ilegal_passwords}\n")
@@ -69,14 +100,18 @@ def clean_labeled_data(path: str):
         file.write(f"Failed files: {failed_files}\n")
 
 def main():
+    """
+        Cleans the labeled data files directly in the provided path from ilegal passwords, then the labeled data of every directory in it.
+        A run that was interrupted resumes when it is started again (see clean_labeled_data).
+        Usage: python CleanLabeledData.py <path> [--metrics <report_path>] [--metrics_format json/prometheus] [--profile <seconds>]
+    """
+    Instrumentation.enable_from_cli(sys.argv)
     base_path = sys.argv[1].replace("\\", "/")
-    for root, directories, files in os.walk(base_path):
-        if len(directories) == 0:
-            clean_labeled_data(base_path)
-        else:
-            for directory in directories:
-                path = os.path.join(base_path, directory)
-                clean_labeled_data(path)
+    with Instrumentation.measure("clean"):
+        clean_labeled_data(base_path, recursive=False)
+        for directory in sorted(next(os.walk(base_path))[1]):
+            clean_labeled_data(os.path.join(base_path, directory))
+    Instrumentation.save_report()
         
 if __name__ == "__main__":
     main()        
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import sys
+from DataLabelingUtils import is_legal_password
+from FilesUtils import iter_labeled_records, is_labeled_data_file, pop_cli_option, pop_cli_flag
+
+FILE_KINDS = ["labeled", "shard"]
+# Records labeled without a country are counted under the key json writes for None.
+NO_COUNTRY = "null"
+
+class FileCounts:
+    """
+        The record counts of a single file, as {country: [records, legal, illegal]} where legal passwords are the ones
+        CleanLabeledData keeps (see DataLabelingUtils.is_legal_password).
+        Plain dicts and lists only, so the counts of a chunk can be returned from a worker process.
+    """
+    def __init__(self, countries: dict = None):
+        self.countries = countries if countries is not None else {}
+
+    def add(self, record: dict):
+        counts = self.countries.setdefault(record["country"] if record["country"] is not None else NO_COUNTRY, [0, 0, 0])
+        counts[0] += 1
+        counts[1 if is_legal_password(record["password"]) else 2] += 1
+
+    def iter_counted(self, records):
+        """
+            Yields the records of the iterable, counting every record on the way.
+        """
+        for record in records:
+            self.add(record)
+            yield record
+
+    def update(self, countries: dict):
+        """
+            Adds the {country: [records, legal, illegal]} counts of another file or chunk.
+        """
+        for country, (records, legal, illegal) in countries.items():
+            counts = self.countries.setdefault(country, [0, 0, 0])
+            counts[0] += records
+            counts[1] += legal
+            counts[2] += illegal
+
+class CorpusCatalog:
+    """
+        A persistent catalog of the labeled data and country files in a SQLite file: the per-country record, legal and illegal counts of
+        every file, recorded by labeling and sharding as they write the files, and the fingerprint of every file, its size and modification time.
+        Questions about the corpus are indexed queries of the counts, and refresh re-scans only the files whose fingerprint changed since
+        they were recorded (e.g. by CleanLabeledData), so they never cost a scan of the whole corpus.
+        Files are keyed by their absolute path with "/" separators, so the files under a directory are a range of the primary key.
+
+        Args:
+            path: The SQLite file of the catalog, created if it doesn't exist. If it is in the raw data path, its name must have "data" in it
+                  so it is not labeled as a raw file (see DataPreparation.get_files_to_label).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS file_countries (path TEXT NOT NULL, country TEXT NOT NULL, records INTEGER NOT NULL, legal INTEGER NOT NULL,
+                illegal INTEGER NOT NULL, PRIMARY KEY (path, country)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS file_countries_country ON file_countries (country);
+        """)
+
+    def new_file_counts(self):
+        return FileCounts()
+
+    def record_file(self, file_path: str, kind: str, file_counts: FileCounts):
+        """
+            Replaces the counts of the file with the provided counts and saves its current fingerprint. Call it once the file is closed.
+        """
+        if kind not in FILE_KINDS:
+            raise ValueError(f"Unknown file kind {kind}, expected one of {FILE_KINDS}")
+        key = get_catalog_key(file_path)
+        stat = os.stat(file_path)
+        with self.connection:
+            self.connection.execute("DELETE FROM file_countries WHERE path = ?", (key,))
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (key, kind, stat.st_size, stat.st_mtime_ns))
+            self.connection.executemany("INSERT INTO file_countries VALUES (?, ?, ?, ?, ?)",
+                                        [(key, country, records, legal, illegal) for country, (records, legal, illegal) in file_counts.countries.items()])
+
+    def scan_file(self, file_path: str, kind: str):
+        """
+            Counts the records of the file and records them. Returns False if the file couldn't be read.
+        """
+        file_counts = FileCounts()
+        try:
+            for record in iter_labeled_records(file_path):
+                file_counts.add(record)
+        except Exception as e:
+            print(e, file_path)
+            return False
+        self.record_file(file_path, kind, file_counts)
+        return True
+
+    def forget_file(self, key: str):
+        with self.connection:
+            self.connection.execute("DELETE FROM file_countries WHERE path = ?", (key,))
+            self.connection.execute("DELETE FROM files WHERE path = ?", (key,))
+
+    def refresh(self, path: str):
+        """
+            Brings the catalog up to date with the files under path (or the file at path): scans the labeled data files that aren't in it,
+            re-scans the files whose fingerprint changed and forgets the files that were deleted.
+            Country files are only known from being recorded by sharding, as their names don't tell them apart from other json files.
+            Returns the number of files scanned.
+        """
+        catalogued = {key: (kind, size, mtime_ns) for key, kind, size, mtime_ns in
+                      self.connection.execute("SELECT path, kind, size, mtime_ns FROM files WHERE " + get_path_condition(), get_path_parameters(path))}
+        file_paths = [path] if os.path.isfile(path) else [os.path.join(root, file_name) for root, directories, files in os.walk(path) for file_name in files]
+        file_paths = {get_catalog_key(file_path): file_path for file_path in file_paths}
+        scanned_files = 0
+        for key, file_path in file_paths.items():
+            if key in catalogued:
+                (kind, size, mtime_ns) = catalogued[key]
+                stat = os.stat(file_path)
+                if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+                    continue
+            elif is_labeled_data_file(os.path.basename(file_path)):
+                kind = "labeled"
+            else:
+                continue
+            scanned_files += self.scan_file(file_path, kind)
+        for key in catalogued.keys() - file_paths.keys():
+            self.forget_file(key)
+        return scanned_files
+
+    def count_countries(self, path: str = None, kind: str = "labeled", country: str = None):
+        """
+            Returns the {country: (records, legal, illegal)} totals of the files of the provided kind under path (or the file at path, or all the files
+            if None), of the provided country only if provided. The counts are as recorded, call refresh first to re-scan changed files.
+            Kinds are never summed, as the country files hold the same records as the labeled data files they were sharded from.
+        """
+        if kind not in FILE_KINDS:
+            raise ValueError(f"Unknown file kind {kind}, expected one of {FILE_KINDS}")
+        conditions, parameters = ["files.kind = ?"], [kind]
+        if path is not None:
+            conditions.append(get_path_condition("file_countries."))
+            parameters.extend(get_path_parameters(path))
+        if country is not None:
+            conditions.append("file_countries.country = ?")
+            parameters.append(country)
+        query = ("SELECT country, SUM(records), SUM(legal), SUM(illegal) FROM file_countries JOIN files ON files.path = file_countries.path"
+                 " WHERE " + " AND ".join(conditions) + " GROUP BY country ORDER BY country")
+        return {country: (records, legal, illegal) for country, records, legal, illegal in self.connection.execute(query, parameters)}
+
+    def close(self):
+        self.connection.close()
+
+def get_catalog_key(file_path: str):
+    return os.path.abspath(file_path).replace("\\", "/")
+
+def get_path_condition(table: str = ""):
+    """
+        Returns the condition matching the keys of a file or of the files under a directory, as a range of keys so it is answered by the index.
+        Its parameters are returned by get_path_parameters.
+    """
+    return f"({table}path = ? OR ({table}path >= ? AND {table}path < ?))"
+
+def get_path_parameters(path: str):
+    key = get_catalog_key(path).rstrip("/")
+    # "0" is the character after "/", so the range holds exactly the keys starting with key + "/".
+    return (key, key + "/", key + "0")
+
+def main():
+    """
+        Prints the counts of the corpus catalog by country, a table for every kind of files.
+        Usage: python CorpusCatalog.py <catalog_path> [<country>] [--path <path>] [--kind <labeled/shard>] [--refresh]
+        Args:
+            catalog_path: The SQLite file of the catalog (see DataPreparation --catalog)
+            country: Only print the counts of this country. Defaults to all countries.
+            --path: Only count the files under this path (or this file). Defaults to all the files.
+            --kind: Only print the counts of the files of this kind, one of FILE_KINDS. Defaults to all the kinds, each in its own table.
+            --refresh: Re-scan the files under --path that changed before counting.
+    """
+    path = pop_cli_option(sys.argv, "path")
+    kind = pop_cli_option(sys.argv, "kind")
+    refresh = pop_cli_flag(sys.argv, "refresh")
+    catalog = CorpusCatalog(sys.argv[1])
+    if refresh and path is not None:
+        print(f"Scanned {catalog.refresh(path)} files")
+    for file_kind in FILE_KINDS if kind is None else [kind]:
+        country_counts = catalog.count_countries(path, file_kind, sys.argv[2] if len(sys.argv) > 2 else None)
+        if kind is None and len(country_counts) == 0:
+            continue
+        print(f"{file_kind + ' files':<20}{'records':>12}{'legal':>12}{'illegal':>12}")
+        for country, (records, legal, illegal) in country_counts.items():
+            print(f"{country:<20}{records:>12}{legal:>12}{illegal:>12}")
+        print(f"{'total':<20}{sum(counts[0] for counts in country_counts.values()):>12}{sum(counts[1] for counts in country_counts.values()):>12}"
+              f"{sum(counts[2] for counts in country_counts.values()):>12}")
+    catalog.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,26 @@
 import datetime
+import hashlib
 import heapq
+import math
 import os
-from collections import defaultdict
+import time
+from collections import defaultdict, Counter
 import sys
 import ModelTrainingUtils
 import json
 from pathlib import Path
 import multiprocessing
+import ApproximateCounting
 import DataLabelingUtils
+import DistributionStore
+import ExternalCounting
+import FilesUtils
+import Instrumentation
+
+PASSWORDS_BATCH_SIZE = 10000
+GROUPS_PER_WORKER = 4
+RATIOS = [1000, 500, 200, 100]
+COUNT_DICTIONARIES_NAMES = ["prefix_count", "base_word_count", "suffix_count", "shift_pattern_count", "leet_pattern_count"]
 
 def save_distribution(data: dict, file_name: str, path: str):
     """
@@ -18,47 +31,98 @@ def save_distribution(data: dict, file_name: str, path: str):
             file_name: The desiered name to the file created
             path: The path to the file created
     """
+    save_sorted_distribution(sorted(data.items()), file_name, path)
+
+def save_sorted_distribution(sorted_items: list, file_name: str, path: str):
+    """
+        Saves a list of (key, p) pairs, already sorted by key, in the provided path with the provided name, in the format of save_distribution.
+        A binary copy for memory-mapped lookups is saved next to it (see DistributionStore.save_binary_distribution).
+    """
     distribution_path = os.path.join(path, "distributions")
     Path(distribution_path).mkdir(parents=True, exist_ok=True)
-    file_name = os.path.join(distribution_path, file_name + ".txt")
-    sorted_data = dict(sorted(data.items()))
+    file_path = os.path.join(distribution_path, file_name + ".txt")
+
+    with open(file_path, "w") as file :
+        for key,value in sorted_items:
+            file.write(format_distribution_line(key, value))
+    DistributionStore.save_binary_distribution(sorted_items, file_name, path)
 
-    with open(file_name, "w") as file :
-        for key,value in sorted_data.items():
-            file.write(f"{repr(key)[1:-1]} {value}\n")
+def format_distribution_line(key: str, value: float):
+    """
+        Returns the line of a (key, p) pair in a text distribution file.
+    """
+    return f"{repr(key)[1:-1]} {value}\n"
 
-def enrich_counts_from_files(file_path: str, base_word_count: defaultdict, prefix_count: defaultdict, suffix_count: defaultdict, shift_pattern_count: defaultdict, leet_pattern_count: defaultdict):
+def enrich_counts_from_files(file_path: str, base_word_count: Counter, prefix_count: Counter, suffix_count: Counter, shift_pattern_count: Counter, leet_pattern_count: Counter):
     """
-        Enriches the provided dictionaries according to the passowrds in the provided path
+        Enriches the provided dictionaries according to the passowrds in the provided path.
+        Only the passwords are read from the file, one record at a time, and they are counted in batches of PASSWORDS_BATCH_SIZE.
     """
     total_passwords, ilegal_passwords = 0, 0
-    with open(file_path, "r") as read_file:
-        array = json.load(read_file)
-        for user in array:
-            password = str(user['password']).removesuffix("\n")
-            if (not DataLabelingUtils.is_legal_password(password)) or (DataLabelingUtils.is_short_and_not_date(password)):
-                ilegal_passwords += 1
-                continue
-            [prefix, base_word, suffix] = ModelTrainingUtils.parse_password_to_3d(password)
-            if suffix_count != None:
-                suffix_count[suffix] += 1
-            if prefix_count != None:
-                prefix_count[prefix] += 1
-            if shift_pattern_count != None:
-                shift_pattern = ModelTrainingUtils.get_base_word_shift_pattern(base_word)
-                if len(shift_pattern) == len(base_word):
-                    shift_pattern_as_string = "all-cap"
-                shift_pattern_as_string = str(shift_pattern)
-                shift_pattern_count[shift_pattern_as_string] += 1
-            if leet_pattern_count != None:
-                (leet_pattern, base_word) = ModelTrainingUtils.get_base_word_leet_pattern(base_word)
-                leet_pattern_as_string = str(leet_pattern)
-                leet_pattern_count[leet_pattern_as_string] += 1
-            if base_word_count != None:
-                base_word_count[base_word.lower()] += 1
-            total_passwords += 1
+    passwords = []
+    for password in FilesUtils.iter_labeled_passwords(file_path):
+        password = str(password).removesuffix("\n")
+        if (not DataLabelingUtils.is_legal_password(password)) or (DataLabelingUtils.is_short_and_not_date(password)):
+            ilegal_passwords += 1
+            continue
+        passwords.append(password)
+        if len(passwords) >= PASSWORDS_BATCH_SIZE:
+            count_passwords(passwords, base_word_count, prefix_count, suffix_count, shift_pattern_count, leet_pattern_count)
+            total_passwords += len(passwords)
+            passwords = []
+    count_passwords(passwords, base_word_count, prefix_count, suffix_count, shift_pattern_count, leet_pattern_count)
+    total_passwords += len(passwords)
     return total_passwords, ilegal_passwords
 
+def count_passwords(passwords: list, base_word_count: Counter, prefix_count: Counter, suffix_count: Counter, shift_pattern_count: Counter, leet_pattern_count: Counter):
+    """
+        Counts the features of a batch of legal passwords into the provided dictionaries. Dictionaries that are None are skipped.
+        The base word is counted lowercased, and after undoing its leet transformations if leet patterns are counted.
+        Counters count the int codes of the shift and leet patterns (see ModelTrainingUtils.extract_password_features), which render_pattern_counts
+        renders to their string form once counting is done. Other dictionaries count the string form right away.
+    """
+    features = ModelTrainingUtils.extract_password_features_batch(passwords)
+    if suffix_count != None:
+        add_counts(suffix_count, features["suffix"])
+    if prefix_count != None:
+        add_counts(prefix_count, features["prefix"])
+    if shift_pattern_count != None:
+        add_counts(shift_pattern_count, get_pattern_keys(shift_pattern_count, features["shift_pattern"], ModelTrainingUtils.render_shift_pattern))
+    if leet_pattern_count != None:
+        add_counts(leet_pattern_count, get_pattern_keys(leet_pattern_count, features["leet_pattern"], ModelTrainingUtils.render_leet_pattern))
+    if base_word_count != None:
+        base_words = features["unleet_base_word"] if leet_pattern_count != None else features["base_word"]
+        add_counts(base_word_count, map(str.lower, base_words))
+
+def get_pattern_keys(count_dict: dict, codes: list, render):
+    """
+        Returns the keys to count the pattern codes with in count_dict: the codes themselves for Counters, and their rendered string form otherwise.
+    """
+    return codes if isinstance(count_dict, Counter) else map(render, codes)
+
+def render_pattern_counts(count_dics: list):
+    """
+        Returns the count dictionaries, ordered as COUNT_DICTIONARIES_NAMES, with the pattern codes counted by count_passwords
+        rendered to their string form. Keys keep their order, so rendering doesn't change the order the keys were first counted in.
+    """
+    renders = {"shift_pattern_count": ModelTrainingUtils.render_shift_pattern, "leet_pattern_count": ModelTrainingUtils.render_leet_pattern}
+    rendered_dics = []
+    for dic_name, dic in zip(COUNT_DICTIONARIES_NAMES, count_dics):
+        if dic_name in renders and isinstance(dic, Counter):
+            dic = Counter({renders[dic_name](code): count for code, count in dic.items()})
+        rendered_dics.append(dic)
+    return rendered_dics
+
+def add_counts(count_dict: dict, keys):
+    """
+        Adds one to the count of every key in keys. Counters count the whole iterable in a single update call, other dictionaries are counted key by key.
+    """
+    if isinstance(count_dict, Counter) or not isinstance(count_dict, dict):
+        count_dict.update(keys)
+        return
+    for key in keys:
+        count_dict[key] += 1
+
 def count_to_distribution(count_dict: defaultdict):
     """
         Converts a dict of {key: count} to a distribution dict of {key: p} where p = count_dict[key] / sum(count_dict.values)
@@ -80,7 +144,7 @@ def count_to_distribution(count_dict: defaultdict):
 #     all_dict_sorted_by_dist
     
 
-def create_count_dictionaries(path: str, country: str, save_count_dict: bool, destination_path: str):
+def create_count_dictionaries(path: str, country: str, save_count_dict: bool, destination_path: str, workers: int = 1, capacity: int = None, spill_keys: int = None):
     """
         Creates a count dicitonary of {password: number_of_occurences} for each of the following:
             1. Prefixes
@@ -93,25 +157,238 @@ def create_count_dictionaries(path: str, country: str, save_count_dict: bool, de
             country: The country of the passwords
             save_count_dict: If True, saves the count dictionaries to a file
             destination_path: The path to save the count dictionaries to
+            workers: If > 1, the files are counted by a pool of `workers` processes (see count_files_in_parallel)
+            capacity: If provided, the files are counted approximately, in ApproximateCounting.SpaceSaving sketches of `capacity` keys per dictionary,
+                      so memory is bounded by the capacity instead of the number of distinct keys. Sketches are counted serially.
+            spill_keys: If provided, the files are counted exactly in ExternalCounting.SpillingCounter dictionaries that spill their counts to
+                        sorted runs in "{destination_path}/count_runs" every `spill_keys` distinct keys, so memory is bounded by spill_keys.
+                        The counters are returned in place of the dictionaries' data, to be merged by create_probability_distributions_external,
+                        which saves count_dict.json once the runs are merged. Spilling counters are counted serially.
+    """
+    file_paths = get_files_to_count(path, country)
+    if spill_keys is not None:
+        counts = count_files(file_paths, spill_keys=spill_keys, spill_path=os.path.join(destination_path, "count_runs"))
+        # The counts are only known once the runs are merged, see save_spilled_count_dictionaries.
+        save_count_dict = False
+    elif capacity is not None:
+        counts = count_files(file_paths, capacity)
+    elif workers > 1:
+        counts = count_files_in_parallel({country: file_paths}, workers)[country]
+    else:
+        counts = count_files(file_paths)
+    return save_count_dictionaries(counts, save_count_dict, destination_path)
+
+def get_files_to_count(path: str, country: str):
+    """
+        Returns the paths of the data files of the country, in the order they are counted.
     """
-    prefix_count = defaultdict(int)
-    base_word_count = defaultdict(int) 
-    suffix_count = defaultdict(int) 
-    shift_pattern_count = defaultdict(int) 
-    leet_pattern_count = defaultdict(int) 
+    file_paths = []
     data_path = os.path.join(path, country)
-    ilegal_passwords = 0
-    total_passwords = 0
     for root, _, files in os.walk(data_path):
         for file in files:
-            if country or str.endswith(file, "labeled_data.json"):
-                file_path = os.path.join(root, file)
-                added_total_passwords, added_ilegal_passwords = enrich_counts_from_files(file_path, base_word_count, prefix_count, suffix_count, shift_pattern_count, leet_pattern_count)
-                total_passwords += added_total_passwords
-                ilegal_passwords += added_ilegal_passwords
-    count_dics = [("prefix_count", prefix_count), ("base_word_count", base_word_count), ("suffix_count", suffix_count), ("shift_pattern_count", shift_pattern_count), ("leet_pattern_count", leet_pattern_count)]
+            if file != "meta_data.json" and not FilesUtils.is_temp_file(file) and (country or FilesUtils.is_labeled_data_file(file)):
+                file_paths.append(os.path.join(root, file))
+    return file_paths
+
+def count_files(file_paths: list, capacity: int = None, spill_keys: int = None, spill_path: str = None):
+    """
+        Counts the passwords of the provided files to new count dictionaries, with their patterns rendered (see render_pattern_counts). This is the map step of count_files_in_parallel.
+        If capacity is provided, the passwords are counted to ApproximateCounting.SpaceSaving sketches of `capacity` keys instead.
+        If spill_keys is provided, they are counted to ExternalCounting.SpillingCounter dictionaries spilling to runs in spill_path instead.
+        Returns a tuple of ([prefix_count, base_word_count, suffix_count, shift_pattern_count, leet_pattern_count], total_passwords, ilegal_passwords)
+    """
+    if spill_keys is not None:
+        count_dics = [ExternalCounting.SpillingCounter(spill_path, dic_name, spill_keys) for dic_name in COUNT_DICTIONARIES_NAMES]
+    else:
+        count_dics = [Counter() if capacity is None else ApproximateCounting.SpaceSaving(capacity) for _ in COUNT_DICTIONARIES_NAMES]
+    [prefix_count, base_word_count, suffix_count, shift_pattern_count, leet_pattern_count] = count_dics
+    ilegal_passwords = 0
+    total_passwords = 0
+    for file_path in file_paths:
+        with Instrumentation.measure("count", file_path, profile=True) as measurement:
+            added_total_passwords, added_ilegal_passwords = enrich_counts_from_files(file_path, base_word_count, prefix_count, suffix_count, shift_pattern_count, leet_pattern_count)
+            measurement.add(records_in=added_total_passwords + added_ilegal_passwords, records_out=added_total_passwords, bytes_read=Instrumentation.get_file_size(file_path))
+        total_passwords += added_total_passwords
+        ilegal_passwords += added_ilegal_passwords
+    return (render_pattern_counts(count_dics), total_passwords, ilegal_passwords)
+
+def merge_counts(counts_pair: tuple):
+    """
+        Merges the right counts of the pair into the left counts, as returned by count_files. This is the reduce step of count_files_in_parallel.
+        Keys first seen in the right counts are added after the keys of the left counts, so merging consecutive file groups in order keeps the key order of counting them serially.
+    """
+    ((left_dics, left_total, left_ilegal), (right_dics, right_total, right_ilegal)) = counts_pair
+    for left_dic, right_dic in zip(left_dics, right_dics):
+        left_dic.update(right_dic)
+    return (left_dics, left_total + right_total, left_ilegal + right_ilegal)
+
+def split_files_to_groups(file_paths: list, groups_count: int):
+    """
+        Splits the files to at most groups_count groups of consecutive files with about the same number of bytes.
+    """
+    total_size = sum(os.path.getsize(file_path) for file_path in file_paths)
+    group_size = max(total_size / max(groups_count, 1), 1)
+    groups = []
+    group, size = [], 0
+    for file_path in file_paths:
+        group.append(file_path)
+        size += os.path.getsize(file_path)
+        if size >= group_size * (len(groups) + 1):
+            groups.append(group)
+            group = []
+    if group or not groups:
+        groups.append(group)
+    return groups
+
+def count_files_in_parallel(files_by_key: dict, workers: int, timings: list = None):
+    """
+        Counts the files of every key (e.g. country) with map-reduce over a single pool of `workers` processes.
+        Every key's files are split to consecutive groups of about the same number of bytes across all the keys (see plan_count_groups),
+        which are counted in parallel (map), and the counts of each key are merged pairwise in rounds, with all the merges of a round running in parallel (tree reduce).
+        Tasks are scheduled largest first (see run_tasks_largest_first), and their timings are appended to timings if provided.
+        Returns a dictionary of {key: counts} with counts as returned by count_files, identical to counting the key's files serially.
+    """
+    with multiprocessing.Pool(processes=workers) as pool:
+        return count_files_on_pool(pool, files_by_key, workers, timings if timings is not None else [])
+
+def plan_count_groups(files_by_key: dict, workers: int):
+    """
+        Splits the files of every key to groups of consecutive files, sized by the bytes of all the keys together: the keys get
+        workers * GROUPS_PER_WORKER groups between them, in proportion to their bytes, so a small key is counted by a single task
+        and a large one is spread over all the workers.
+        Returns a list of (key, group, bytes) tuples, in key order and then group order.
+    """
+    sizes = {key: sum(os.path.getsize(file_path) for file_path in file_paths) for key, file_paths in files_by_key.items()}
+    group_size = max(sum(sizes.values()) / (workers * GROUPS_PER_WORKER), 1)
+    groups = []
+    for key, file_paths in files_by_key.items():
+        for group in split_files_to_groups(file_paths, math.ceil(sizes[key] / group_size)):
+            groups.append((key, group, sum(os.path.getsize(file_path) for file_path in group)))
+    return groups
+
+def count_files_on_pool(pool, files_by_key: dict, workers: int, timings: list):
+    """
+        The map-reduce of count_files_in_parallel over an existing pool. Returns a dictionary of {key: counts} and a dictionary of {key: bytes}.
+    """
+    groups = plan_count_groups(files_by_key, workers)
+    tasks = [("count", key, f"{len(group)} files", count_files, (group,), size) for (key, group, size) in groups]
+    counts_by_key = defaultdict(list)
+    for (key, _, size), counts in zip(groups, run_tasks_largest_first(pool, tasks, timings)):
+        counts_by_key[key].append((counts, size))
+    while any(len(counts_list) > 1 for counts_list in counts_by_key.values()):
+        pairs = []
+        for key, counts_list in counts_by_key.items():
+            for index in range(0, len(counts_list) - 1, 2):
+                ((left, left_size), (right, right_size)) = (counts_list[index], counts_list[index + 1])
+                pairs.append((key, left_size + right_size, ("merge", key, f"{index} + {index + 1}", merge_counts, ((left, right),), left_size + right_size)))
+        merged_by_key = defaultdict(list)
+        for (key, size, _), merged in zip(pairs, run_tasks_largest_first(pool, [task for (_, _, task) in pairs], timings)):
+            merged_by_key[key].append((merged, size))
+        for key, counts_list in counts_by_key.items():
+            if len(counts_list) % 2 == 1:
+                merged_by_key[key].append(counts_list[-1])
+        counts_by_key = merged_by_key
+    return {key: counts_list[0][0] for key, counts_list in counts_by_key.items()}
+
+def run_tasks_largest_first(pool, tasks: list, timings: list):
+    """
+        Runs (stage, key, name, function, args, size) tasks on the pool, the largest size first (longest processing time first scheduling):
+        workers take the next task as soon as they are free, so small tasks fill in around the large ones instead of waiting for them.
+        Appends the timing of every task to timings (see run_timed_task) and returns the results in the order of the tasks.
+    """
+    order = sorted(range(len(tasks)), key=lambda index: tasks[index][5], reverse=True)
+    results = [None] * len(tasks)
+    for (index, result, timing) in pool.imap_unordered(run_timed_task, [(index, tasks[index]) for index in order]):
+        results[index] = result
+        timings.append(timing)
+    return results
+
+def run_timed_task(indexed_task: tuple):
+    """
+        Runs a task of run_tasks_largest_first in a worker. Returns a tuple of (index, result, timing), where timing is a dictionary of
+        the task's stage, key, name, bytes, worker pid, start time (epoch seconds), wall time and CPU time.
+    """
+    (index, (stage, key, name, function, args, size)) = indexed_task
+    start, start_cpu = time.time(), time.process_time()
+    result = function(*args)
+    timing = {
+        "stage": stage,
+        "key": key,
+        "task": name,
+        "bytes": size,
+        "worker": os.getpid(),
+        "start": start,
+        "wall_seconds": time.time() - start,
+        "cpu_seconds": time.process_time() - start_cpu
+    }
+    return (index, result, timing)
+
+def build_models_in_parallel(files_by_key: dict, destination_base_path: str, workers: int, ratios: list = RATIOS):
+    """
+        Counts the files of every key (e.g. country) like count_files_in_parallel, and then builds the sub models of every key
+        in the same pool, largest key first, to "{destination_base_path}/{key}" like count_dict_to_distribution_dict builds them.
+        The merged counts are passed to the workers in memory, so count_dict.json is only written, never read back.
+        Returns the timings of all the tasks (see run_timed_task).
+    """
+    timings = []
+    with multiprocessing.Pool(processes=workers) as pool:
+        counts_by_key = count_files_on_pool(pool, files_by_key, workers, timings)
+        tasks = []
+        for key, counts in counts_by_key.items():
+            size = sum(os.path.getsize(file_path) for file_path in files_by_key[key])
+            tasks.append(("distribution", key, "model", build_model, (counts, os.path.join(destination_base_path, key), ratios), size))
+        run_tasks_largest_first(pool, tasks, timings)
+    return timings
+
+def build_model(counts: tuple, destination_path: str, ratios: list = RATIOS):
+    """
+        Saves the counts returned by count_files (with count_dict.json) and creates the sub models of all the ratios from them in destination_path.
+    """
+    Path(destination_path).mkdir(parents=True, exist_ok=True)
+    count_dics = save_count_dictionaries(counts, True, destination_path)
+    create_probability_distributions(count_dics, destination_path, ratios)
+
+def report_task_timings(timings: list, workers: int):
+    """
+        Prints the timing of every task by start time, and the makespan and worker utilization (busy time / (workers * makespan)) of the run.
+        Every task is recorded to Instrumentation as a file "{key}: {task}" of its stage.
+    """
+    if len(timings) == 0:
+        return
+    run_start = min(timing["start"] for timing in timings)
+    makespan = max(timing["start"] + timing["wall_seconds"] for timing in timings) - run_start
+    for timing in sorted(timings, key=lambda timing: timing["start"]):
+        print(f"{timing['stage']:<12} {timing['key']:<32} {timing['task']:<12} {timing['bytes'] / 1024 / 1024:>9.1f} MB  worker {timing['worker']:<7} "
+              f"start {timing['start'] - run_start:>8.2f}s  wall {timing['wall_seconds']:>8.2f}s  cpu {timing['cpu_seconds']:>8.2f}s")
+        Instrumentation.record(timing["stage"], f"{timing['key']}: {timing['task']}", timing["wall_seconds"], timing["cpu_seconds"], bytes_read=timing["bytes"])
+    busy_seconds = sum(timing["wall_seconds"] for timing in timings)
+    print(f"{len(timings)} tasks, makespan {makespan:.2f}s, utilization {busy_seconds / max(workers * makespan, 1e-9):.0%}")
+
+def save_count_dictionaries(counts: tuple, save_count_dict: bool, destination_path: str):
+    """
+        Saves the counts returned by count_files to count_dict.json (if save_count_dict) and model_size.txt in destination_path.
+        Returns the count dictionaries as a list of {name, total_size, data}, with the total_mass and error_bound of approximate counts.
+        Spilling counters are returned as {name, counter}, their size is only known once their runs are merged.
+    """
+    (count_dics, total_passwords, ilegal_passwords) = counts
     data_list = []
-    for dic_name, dic in count_dics:
+    for dic_name, dic in zip(COUNT_DICTIONARIES_NAMES, count_dics):
+        if isinstance(dic, ExternalCounting.SpillingCounter):
+            data_list.append({
+                "name": dic_name,
+                "counter": dic
+            })
+            continue
+        if isinstance(dic, ApproximateCounting.SpaceSaving):
+            # total_size is the estimated number of distinct keys, total_mass the true number of counted keys and every count is at most error_bound too high.
+            data_list.append({
+                "name": dic_name,
+                "total_size": dic.distinct_count(),
+                "total_mass": dic.total,
+                "error_bound": dic.error_bound(),
+                'data': dic.counts
+            })
+            continue
         data_list.append({
             "name": dic_name,
             "total_size": len(dic),
@@ -125,6 +402,79 @@ def create_count_dictionaries(path: str, country: str, save_count_dict: bool, de
         file.write(f"Ilegal passwords: {ilegal_passwords}")
     return data_list
 
+def create_count_dictionaries_incremental(path: str, country: str, destination_path: str):
+    """
+        An incremental version of create_count_dictionaries, which only counts the files that are new or changed since the last run.
+        A manifest of the counted files (path, size, mtime and content hash) is kept in count_manifest.json next to count_dict.json,
+        and the counts of every file are kept in the count_parts directory, so the old counts of a changed or deleted file can be subtracted.
+        Files whose size and mtime are unchanged are skipped without being read, and files whose content hash is unchanged are not recounted.
+        Saves count_dict.json, model_size.txt and the manifest, and returns the count dictionaries as a list of {name, total_size, data}.
+    """
+    manifest_path = os.path.join(destination_path, "count_manifest.json")
+    count_dict_path = os.path.join(destination_path, "count_dict.json")
+    parts_path = os.path.join(destination_path, "count_parts")
+    Path(parts_path).mkdir(parents=True, exist_ok=True)
+    if os.path.isfile(manifest_path) and os.path.isfile(count_dict_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        with open(count_dict_path, 'r') as file:
+            count_dics = [Counter(dic_data["data"]) for dic_data in json.load(file)]
+    else:
+        manifest = {"total_passwords": 0, "ilegal_passwords": 0, "files": {}}
+        count_dics = [Counter() for _ in COUNT_DICTIONARIES_NAMES]
+
+    file_paths = get_files_to_count(path, country)
+    for file_path in set(manifest["files"]) - set(file_paths):
+        remove_file_counts(manifest, count_dics, file_path)
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        entry = manifest["files"].get(file_path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            continue
+        file_hash = FilesUtils.get_file_hash(file_path)
+        if entry is not None and entry["hash"] == file_hash:
+            entry["mtime"] = stat.st_mtime
+            continue
+        if entry is not None:
+            remove_file_counts(manifest, count_dics, file_path)
+        (file_dics, total_passwords, ilegal_passwords) = count_files([file_path])
+        for count_dic, file_dic in zip(count_dics, file_dics):
+            count_dic.update(file_dic)
+        part_path = os.path.join(parts_path, hashlib.sha1(file_path.encode()).hexdigest() + ".json")
+        with open(part_path, 'w+') as file:
+            json.dump(file_dics, file)
+        manifest["total_passwords"] += total_passwords
+        manifest["ilegal_passwords"] += ilegal_passwords
+        manifest["files"][file_path] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": file_hash,
+            "part": part_path,
+            "total_passwords": total_passwords,
+            "ilegal_passwords": ilegal_passwords
+        }
+
+    data_list = save_count_dictionaries((count_dics, manifest["total_passwords"], manifest["ilegal_passwords"]), True, destination_path)
+    with open(manifest_path, 'w+') as file:
+        json.dump(manifest, file, indent=4)
+    return data_list
+
+def remove_file_counts(manifest: dict, count_dics: list, file_path: str):
+    """
+        Subtracts the counts of a file in the manifest from the count dictionaries and the totals, and removes the file from the manifest.
+    """
+    entry = manifest["files"].pop(file_path)
+    with open(entry["part"], 'r') as file:
+        file_dics = json.load(file)
+    for count_dic, file_dic in zip(count_dics, file_dics):
+        for key, count in file_dic.items():
+            count_dic[key] -= count
+            if count_dic[key] <= 0:
+                del count_dic[key]
+    manifest["total_passwords"] -= entry["total_passwords"]
+    manifest["ilegal_passwords"] -= entry["ilegal_passwords"]
+    os.remove(entry["part"])
+
 def create_probability_disribution(count_dics: list[dict[str, any]], destination_path, ratio: int = 500):
     """
         Calculates the probability distribution of all the passwords under the provided path \n
@@ -133,23 +483,96 @@ def create_probability_disribution(count_dics: list[dict[str, any]], destination
             country: The country of the passwords
             ratio: The ratio of the top n words to the total number of words. If ratio == 1, all the words will be saved.
     """
-    meta_data = []
+    create_probability_distributions(count_dics, destination_path, [ratio])
+
+def create_probability_distributions(count_dics: list[dict[str, any]], destination_path, ratios: list = RATIOS):
+    """
+        Creates the sub models of all the provided ratios at once. The output is identical to calling create_probability_disribution with each ratio in order
+        (meta_data.json describes the last ratio), but every dictionary is normalized, saved as a full distribution and ranked only once:
+        a single heapq.nlargest of the largest n serves all the ratios, as the top n of every ratio is a prefix of it.
+    """
+    meta_data = {ratio: [] for ratio in ratios}
     for index, dic_data in enumerate(count_dics):
         count_dic = dic_data["data"]
         dict_size = dic_data["total_size"]
         distribution_dict = count_to_distribution(count_dic)
         save_distribution(distribution_dict, f"a{index + 1}", destination_path)
-        n = dict_size // ratio if dict_size > (ratio * 2) else 2
-        if ratio > 1:
-            distribution_dict = get_top_n_values(n, distribution_dict)
-            save_distribution(distribution_dict, f"{ratio}_a{index + 1}", destination_path)
-            meta_data.append({
+        top_n_by_ratio = {ratio: (dict_size // ratio if dict_size > (ratio * 2) else 2) for ratio in ratios if ratio > 1}
+        if len(top_n_by_ratio) == 0:
+            continue
+        top_values = heapq.nlargest(max(top_n_by_ratio.values()), distribution_dict.items(), key=lambda item: item[1])
+        for ratio, n in top_n_by_ratio.items():
+            save_sorted_distribution(sorted(top_values[ : n]), f"{ratio}_a{index + 1}", destination_path)
+            meta_data[ratio].append({
                 "name": dic_data["name"],
                 "n": n,
-                "p": sum(distribution_dict.values())
+                "p": sum(value for _, value in top_values[ : n])
             })
     with open(os.path.join(destination_path, "meta_data.json"), 'w+') as file:
-        json.dump(meta_data, file, indent=4)
+        json.dump(meta_data[ratios[-1]], file, indent=4)
+
+def create_probability_distributions_external(count_dics: list[dict[str, any]], destination_path, ratios: list = RATIOS, save_count_dict: bool = True):
+    """
+        Creates the sub models of all the provided ratios from spilling counters (see create_count_dictionaries), with the same output as
+        create_probability_distributions, except that the full distributions are only saved as text: their binary copies would need all the keys in memory.
+        The runs of every counter are k-way merged to a single key-sorted run, which is streamed once to write the full distribution and to keep
+        the largest n counts in a bounded heap. Ties are broken by the first occurrence of the keys, like nlargest over a counted dictionary breaks them.
+        If save_count_dict, the merged counts are saved to count_dict.json (see save_spilled_count_dictionaries). The runs are deleted afterwards.
+    """
+    meta_data = {ratio: [] for ratio in ratios}
+    distribution_path = os.path.join(destination_path, "distributions")
+    Path(distribution_path).mkdir(parents=True, exist_ok=True)
+    for index, dic_data in enumerate(count_dics):
+        counter = dic_data["counter"]
+        total_size = counter.total()
+        merged_path = os.path.join(counter.directory, f"{counter.name}.merged")
+        dict_size = counter.merge_to_file(merged_path)
+        dic_data["total_size"] = dict_size
+        binary_path = os.path.join(distribution_path, f"a{index + 1}.bin")
+        if os.path.isfile(binary_path):
+            os.remove(binary_path)
+        top_n_by_ratio = {ratio: (dict_size // ratio if dict_size > (ratio * 2) else 2) for ratio in ratios if ratio > 1}
+        max_n = max(top_n_by_ratio.values(), default=0)
+        top_heap = []
+        with open(os.path.join(distribution_path, f"a{index + 1}.txt"), "w") as file:
+            for (key, count, rank) in ExternalCounting.iter_run(merged_path):
+                file.write(format_distribution_line(key, count / total_size))
+                if len(top_heap) < max_n:
+                    heapq.heappush(top_heap, (count, -rank, key))
+                elif max_n > 0:
+                    heapq.heappushpop(top_heap, (count, -rank, key))
+        top_values = [(key, count / total_size) for (count, _, key) in sorted(top_heap, reverse=True)]
+        for ratio, n in top_n_by_ratio.items():
+            save_sorted_distribution(sorted(top_values[ : n]), f"{ratio}_a{index + 1}", destination_path)
+            meta_data[ratio].append({
+                "name": dic_data["name"],
+                "n": n,
+                "p": sum(value for _, value in top_values[ : n])
+            })
+    with open(os.path.join(destination_path, "meta_data.json"), 'w+') as file:
+        json.dump(meta_data[ratios[-1]], file, indent=4)
+    if save_count_dict:
+        save_spilled_count_dictionaries(count_dics, destination_path)
+    for dic_data in count_dics:
+        dic_data["counter"].remove_runs()
+
+def save_spilled_count_dictionaries(count_dics: list[dict[str, any]], destination_path: str):
+    """
+        Saves the merged counts of spilling counters to count_dict.json in the format of save_count_dictionaries, so load_from_file runs read them.
+        Every dictionary is streamed in the order of its keys' first occurrence (see ExternalCounting.SpillingCounter.iter_counts_by_rank), like a
+        counted dictionary is saved, so they get the same distributions. The file is written to a temporary file and replaced atomically.
+    """
+    count_dict_path = os.path.join(destination_path, "count_dict.json")
+    temp_path = count_dict_path + ".tmp"
+    with open(temp_path, 'w') as file:
+        file.write("[")
+        for index, dic_data in enumerate(count_dics):
+            file.write(("," if index > 0 else "") + f'\n    {{"name": {json.dumps(dic_data["name"])}, "total_size": {dic_data["total_size"]}, "data": {{')
+            for key_index, (key, count) in enumerate(dic_data["counter"].iter_counts_by_rank()):
+                file.write(("" if key_index == 0 else ", ") + f"{json.dumps(key)}: {count}")
+            file.write("}}")
+        file.write("\n]")
+    FilesUtils.replace_file(temp_path, count_dict_path)
 
 def get_top_n_values(n: int, distribution_dict: dict):
     """
@@ -163,65 +586,95 @@ def execute(country: str):
     """
         Creates the sub model for each country for each ratio. If needed, creates the count dictionaries.
     """
-    base_path = "C:\Country_Data"
-    destination_base_path = "C:\School_data\distributions"
+    base_path = r"C:\Country_Data"
+    destination_base_path = r"C:\School_data\distributions"
     destination_path = os.path.join(destination_base_path, country)
     Path(destination_path).mkdir(parents=True, exist_ok=True)
     create_count_dictionaries(base_path, country, True, destination_path)
 
-def count_dict_to_distribution_dict(country: str, destination_base_path: str, base_path, load_from_file: bool):
+def count_dict_to_distribution_dict(country: str, destination_base_path: str, base_path, load_from_file: bool, workers: int = 1, incremental: bool = False, capacity: int = None, spill_keys: int = None):
     """
         Creates the sub model for each country for each ratio. If needed, creates the count dictionaries.
+        If incremental, the count dictionaries are updated with the new and changed files only (see create_count_dictionaries_incremental).
+        If capacity is provided, the count dictionaries are counted approximately in sketches of `capacity` keys (see create_count_dictionaries).
+        If spill_keys is provided, the count dictionaries are counted exactly with at most `spill_keys` keys in memory and merged from disk
+        straight to the distribution files (see create_probability_distributions_external).
     """
     destination_path = os.path.join(destination_base_path, country)
     Path(destination_path).mkdir(parents=True, exist_ok=True)
-    count_dics = json.load(open(os.path.join(destination_path, "count_dict.json"), 'r')) if load_from_file else create_count_dictionaries(base_path, country, True, destination_path)
-    for ratio in [1000, 500, 200, 100]:
-        create_probability_disribution(count_dics, destination_path, ratio)
+    with Instrumentation.measure("count"):
+        if load_from_file:
+            count_dics = json.load(open(os.path.join(destination_path, "count_dict.json"), 'r'))
+        elif incremental:
+            count_dics = create_count_dictionaries_incremental(base_path, country, destination_path)
+        else:
+            count_dics = create_count_dictionaries(base_path, country, True, destination_path, workers, capacity, spill_keys)
+    with Instrumentation.measure("distribution", destination_path, profile=True) as measurement:
+        if spill_keys is not None and not load_from_file and not incremental:
+            create_probability_distributions_external(count_dics, destination_path, RATIOS)
+            measurement.add(records_in=sum(dic_data["counter"].total() for dic_data in count_dics))
+        else:
+            create_probability_distributions(count_dics, destination_path, RATIOS)
+            measurement.add(records_in=sum(dic_data["total_size"] for dic_data in count_dics))
 
-def runAsync():
+def runAsync(countries: list = None, base_path: str = r"C:\Country_Data", destination_base_path: str = r"C:\School_data\distributions", workers: int = None):
     """
-        An async version of the main function
+        An async version of the main function. The files of all countries are counted and their sub models built by a single pool of
+        `workers` processes (defaults to the number of CPUs), scheduled by size (see build_models_in_parallel), and the timing of every task is printed.
     """
-    num_processes = multiprocessing.cpu_count()
+    num_processes = workers or multiprocessing.cpu_count()
     # print start time
     print("start: " + str(datetime.datetime.now()))
-    countries = ["China", "Poland", "United Kingdom (common practice)", "Italy", "India", "France", "Germany", "Japan"]
-    destination_base_path = "C:\School_data\distributions"
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        pool.map(execute, countries)
-    for country in countries:
-        count_dict_to_distribution_dict(country, destination_base_path, "",True)
+    countries = countries or ["China", "Poland", "United Kingdom (common practice)", "Italy", "India", "France", "Germany", "Japan"]
+    # The files of all countries are counted together, so the largest country is spread over all the processes too.
+    files_by_country = {country: get_files_to_count(base_path, country) for country in countries}
+    with Instrumentation.measure("async"):
+        timings = build_models_in_parallel(files_by_country, destination_base_path, num_processes)
+    report_task_timings(timings, num_processes)
     print("end: " + str(datetime.datetime.now()))
 
-def runSync(load_from_file: bool = False):
+def runSync(load_from_file: bool = False, workers: int = 1, incremental: bool = False, capacity: int = None, spill_keys: int = None):
     """"
-        A sync version of the main function
+        A sync version of the main function. If workers > 1, the files of each country are counted by a pool of `workers` processes.
     """
     # print start time
     print("start: " + str(datetime.datetime.now()))
-    base_path = "C:\Country_Data"
-    destination_base_path = "C:\School_data\distributions"
+    base_path = r"C:\Country_Data"
+    destination_base_path = r"C:\School_data\distributions"
     countries = ["China", "Poland", "United Kingdom (common practice)", "Italy", "India", "France", "Germany", "Japan"]
     for country in countries:
-        count_dict_to_distribution_dict(country, destination_base_path, base_path, load_from_file)
+        count_dict_to_distribution_dict(country, destination_base_path, base_path, load_from_file, workers, incremental, capacity, spill_keys)
     print("end: " + str(datetime.datetime.now()))
 
 
 def main():
     """
         Creates the sub model for each country for each ratio. If needed, creates the count dictionaries.
-        Usage: python CreateProbabilityDistribution.py [async/sync] [load_from_file]
+        Usage: python CreateProbabilityDistribution.py [async/sync] [load_from_file] [--workers <n>] [--incremental] [--capacity <n>] [--spill_keys <n>] [--metrics <report_path>]
         Args:
             async/sync: If async, the program will run in parallel. If sync, the program will run in serial.
             load_from_file: If True, the program will load the count dictionaries from a file. If False, the program will create the count dictionaries.
+            --workers: In sync mode, the number of processes counting the files of each country. Defaults to 1.
+                       In async mode, the number of processes counting and building the models of all the countries. Defaults to the number of CPUs.
+            --incremental: In sync mode, only count the files that are new or changed since the last run.
+            --capacity: In sync mode, count approximately with at most `capacity` keys per count dictionary. Defaults to exact counting.
+            --spill_keys: In sync mode, count exactly with at most `spill_keys` keys per count dictionary in memory, spilling the rest to disk. Defaults to counting in memory.
+            --metrics, --metrics_format, --profile: Instrumentation report options (see Instrumentation.enable_from_cli). Defaults to no report.
     """
+    Instrumentation.enable_from_cli(sys.argv)
+    workers = FilesUtils.pop_cli_option(sys.argv, "workers")
+    incremental = FilesUtils.pop_cli_flag(sys.argv, "incremental")
+    capacity = FilesUtils.pop_cli_option(sys.argv, "capacity")
+    capacity = int(capacity) if capacity else None
+    spill_keys = FilesUtils.pop_cli_option(sys.argv, "spill_keys")
+    spill_keys = int(spill_keys) if spill_keys else None
     isAsync = sys.argv[1] == "async"
     load_from_file = (sys.argv[2]).lower() == "true"
     if isAsync:
-        runAsync()
+        runAsync(workers=int(workers) if workers else None)
     else:
-        runSync(load_from_file)
+        runSync(load_from_file, int(workers) if workers else 1, incremental, capacity, spill_keys)
+    Instrumentation.save_report()
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,23 @@
 import tldextract
 from world.database import Database # Source: https://gitlab.com/warsaw/world
 import json
-from FilesUtils import save_json_array_to_file # Source: https://github.com/john-kurkowski/tldextract
+import re
+from FilesUtils import save_json_array_to_file, save_labeled_records, iter_labeled_records, iter_line_blocks # Source: https://github.com/john-kurkowski/tldextract
+
+DOMAIN_CACHE_MAX_SIZE = 1000000
+# A byte of a raw row that parse_raw_lines can't decode with the rest of the block: a non ascii byte or a backslash.
+DIRTY_BYTE_PATTERN = re.compile(rb"[\x80-\xff\\]")
+domain_country_cache = {}
+domain_cache_updates = {}
+domain_cache_stats = {"hits": 0, "misses": 0}
+labeling_stats = {"lines": 0}
+database = None
 
 def is_legal_password(s):
     """
         Source: isascci() here - https://github.com/lirondavid/PESrank/blob/master/PESrank/PESrank.py#L47
     """
-    return all(ord(char) < 128 for char in s)
+    return s.isascii()
 
 def create_origin_label(path, domains_count):
     """
@@ -18,33 +28,103 @@ def create_origin_label(path, domains_count):
             country: "country"\n
         }}
     """
-    json_array = []
-    file = open(path, 'rb')
-    emailPasswordPairs = file.readlines()
-    db = Database()
-    for emailPasswordPair in emailPasswordPairs:
-        try:
-            string_content = emailPasswordPair.decode('unicode_escape')
-            [email, password] = parse_email_password(string_content)
-        except:
-            continue
-        if not is_legal_password(password):
-            continue
-        try:
-            tld = parse_domain(email)
-            country = db.lookup_code(tld)
-        except:
-            country = "null"
-        curr_json = {
-            "email": email,
-            "password": password,
-            "country": country
-        }
-        json_array.append(curr_json)
-        domains_count[country] += 1
-    return json_array
+    return list(iter_origin_labels(path, domains_count))
+
+def iter_origin_labels(path, domains_count, start: int = 0, end: int = None):
+    """
+        A streaming version of create_origin_label.
+        Reads the file in buffered chunks and yields the labeled json of each legal row as soon as it is parsed, so memory does not grow with the size of the file.
+        domains_count is updated with every yielded row, and labeling_stats["lines"] with the number of rows read once the range is done.
+
+        start, end: Optional byte range of the file to label. A row belongs to the range its first byte falls in,
+                    so labeling consecutive ranges yields exactly the rows of labeling the whole file.
+    """
+    lines = 0
+    for block in iter_line_blocks(path, start, end):
+        lines += block.count(b"\n") + (not block.endswith(b"\n"))
+        for (email, password) in parse_raw_lines(block):
+            country = get_email_country(email)
+            curr_json = {
+                "email": email,
+                "password": password,
+                "country": country
+            }
+            domains_count[country] += 1
+            yield curr_json
+    labeling_stats["lines"] += lines
     
 
+def parse_raw_lines(block: bytes):
+    """
+        Returns the [email, password] pairs of the legal rows in a block of raw rows, as parse_raw_line would return them row by row.
+        The rows that are all ascii and have no backslash, the common case, are decoded and split a run of rows at a time: the rows with
+        a non ascii byte or a backslash are found with a single search of the block, and the runs of rows between them are decoded at once.
+        The rows with a backslash are parsed by parse_raw_line. The other non ascii rows are parsed without decode('unicode_escape'),
+        which maps their bytes to the same characters as latin-1, so they are split on their first ':' (or ';') and their password is
+        checked with bytes.isascii before anything is decoded.
+    """
+    pairs = []
+    clean_start = 0
+    match = DIRTY_BYTE_PATTERN.search(block)
+    while match is not None:
+        row_start = block.rfind(b"\n", 0, match.start()) + 1
+        row_end = block.find(b"\n", match.end())
+        row_end = len(block) if row_end < 0 else row_end + 1
+        if row_start > clean_start:
+            parse_ascii_rows(block[clean_start : row_start], pairs)
+        parse_non_ascii_row(block[row_start : row_end], pairs)
+        clean_start = row_end
+        match = DIRTY_BYTE_PATTERN.search(block, row_end)
+    if clean_start < len(block):
+        parse_ascii_rows(block[clean_start : ], pairs)
+    return pairs
+
+def parse_ascii_rows(rows_block: bytes, pairs: list):
+    """
+        Adds the pairs of a run of raw rows that are all ascii and have no backslash to pairs, decoding and splitting the rows at once.
+    """
+    rows = rows_block.decode("ascii").split("\n")
+    for (block_rows, terminator) in ((rows[ : -1], "\n"), (rows[-1 : ], "")):
+        for row in block_rows:
+            (email, separator, password) = row.partition(":")
+            if not separator:
+                (email, separator, password) = row.partition(";")
+                if not separator:
+                    continue
+            pairs.append([email, password + terminator])
+
+def parse_non_ascii_row(row: bytes, pairs: list):
+    """
+        Adds the pair of a raw row (with its "\\n" terminator, if any) that has a non ascii byte or a backslash to pairs, if it is legal.
+    """
+    if b"\\" in row:
+        # Escapes may decode to a separator or a non ascii character, so the row is parsed after decoding it.
+        pair = parse_raw_line(row)
+        if pair is not None:
+            pairs.append(pair)
+        return
+    (row, terminator) = (row[ : -1], b"\n") if row.endswith(b"\n") else (row, b"")
+    (email, separator, password) = row.partition(b":")
+    if not separator:
+        (email, separator, password) = row.partition(b";")
+        if not separator:
+            return
+    if password.isascii():
+        pairs.append([email.decode("latin-1"), (password + terminator).decode("ascii")])
+
+def parse_raw_line(line: bytes):
+    """
+        Returns the [email, password] pair of a raw row, or None if the row can't be parsed or its password is not legal.
+    """
+    try:
+        string_content = line.decode('unicode_escape')
+        [email, password] = parse_email_password(string_content)
+    except:
+        return None
+    if not is_legal_password(password):
+        return None
+    return [email, password]
+
 def parse_email_password(str):
     """
         Gets an "email:password" or "email;password" string and returns an array of [email, password].
@@ -68,16 +148,94 @@ def parse_domain(email):
     tld = suffix.split(".")[-1]
     return tld
 
+def get_email_country(email):
+    """
+        Returns the country code of the email's domain, or "null" if it can't be resolved.
+        Results are memoized by domain in domain_country_cache, which is shared by all the files labeled in the process,
+        so tldextract and the Database only run once per distinct domain.
+    """
+    domain = get_cache_domain(email)
+    if domain is not None and domain in domain_country_cache:
+        domain_cache_stats["hits"] += 1
+        return domain_country_cache[domain]
+    domain_cache_stats["misses"] += 1
+    db = get_database()
+    try:
+        tld = parse_domain(email)
+        country = db.lookup_code(tld)
+    except:
+        country = "null"
+    if domain is not None:
+        cache_domain_country(domain, country)
+        domain_cache_updates[domain] = country
+    return country
+
+def cache_domain_country(domain, country):
+    """
+        Adds the domain to domain_country_cache, evicting the oldest domain first if the cache holds DOMAIN_CACHE_MAX_SIZE domains.
+    """
+    if domain not in domain_country_cache and len(domain_country_cache) >= DOMAIN_CACHE_MAX_SIZE:
+        del domain_country_cache[next(iter(domain_country_cache))]
+    domain_country_cache[domain] = country
+
+def get_cache_domain(email):
+    """
+        Returns the part of the email tldextract resolves the domain from, to be used as the cache key.
+        Returns None for emails containing url delimiters ('/', '?', '#'), as tldextract may cut those before the '@'.
+    """
+    if "/" in email or "?" in email or "#" in email:
+        return None
+    return email.rpartition("@")[2]
+
+def get_database():
+    """
+        Returns the process' Database, creating it on the first call.
+    """
+    global database
+    if database is None:
+        database = Database()
+    return database
+
+def load_domain_cache(path):
+    """
+        Loads a domain cache saved by save_domain_cache into domain_country_cache. Missing files are ignored.
+    """
+    try:
+        with open(path, "r") as read_file:
+            merge_domain_cache_updates(json.load(read_file))
+    except FileNotFoundError:
+        pass
+
+def save_domain_cache(path):
+    """
+        Saves domain_country_cache as a json of {domain: country} to the provided path.
+    """
+    save_json_array_to_file(domain_country_cache, path)
+
+def pop_domain_cache_updates():
+    """
+        Returns the {domain: country} entries resolved since the last call and the cache stats, and resets both.
+        Used to pass what a worker process learned back to the parent.
+    """
+    updates, stats = dict(domain_cache_updates), dict(domain_cache_stats)
+    domain_cache_updates.clear()
+    domain_cache_stats["hits"], domain_cache_stats["misses"] = 0, 0
+    return updates, stats
+
+def merge_domain_cache_updates(updates: dict):
+    """
+        Adds the {domain: country} entries (e.g. a worker's pop_domain_cache_updates) to domain_country_cache, bounded like get_email_country bounds it.
+    """
+    for domain, country in updates.items():
+        cache_domain_country(domain, country)
+
 def aggregate_meta_data_from_labeled_data(path, domains_count):
     """
         Enriches a domains_count of {domain: #_of_passwords} with the data saves under the provided path
     """
-    with open(path, "r") as read_file:
-        array = json.load(read_file)
-        for user in array:
-            json_user = json.loads(user)
-            country = json_user["country"]
-            domains_count[country] += 1
+    for user in iter_labeled_records(path):
+        country = user["country"]
+        domains_count[country] += 1
 
 def aggregate_meta_data_from_meta_data(path, domains_count):
     """
@@ -99,18 +257,16 @@ def enrich_country_dict(destination_path: str, path: str, country: str, country_
         MAX_FILE_ENTRIES: The max number of entries in a file
         file_index: The index of the current country's data file being created
     """
-    with open(path, "r") as read_file:
-        try:
-            curr_json = json.load(read_file)
-            for user in curr_json:
-                if user['country'] == country and  not is_short_and_not_date(user['password']):
-                    if len(country_data) >= MAX_FILE_ENTRIES:
-                        save_json_array_to_file(country_data, destination_path + "" f"/{country}" + f"/{country}_{file_index}.json")
-                        file_index += 1
-                        country_data = []
-                    country_data.append(user)
-        except Exception as e:
-            print(e, path)
+    try:
+        for user in iter_labeled_records(path):
+            if user['country'] == country and  not is_short_and_not_date(user['password']):
+                if len(country_data) >= MAX_FILE_ENTRIES:
+                    save_labeled_records(country_data, destination_path + "" f"/{country}" + f"/{country}_{file_index}.json")
+                    file_index += 1
+                    country_data = []
+                country_data.append(user)
+    except Exception as e:
+        print(e, path)
 
     return (country_data, file_index)
 
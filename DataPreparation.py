@@ -1,42 +1,289 @@
+import itertools
 import os
 import sys
+import time
+import multiprocessing
 from collections import defaultdict
-from FilesUtils import save_to_log, save_json_array_to_file
-from DataLabelingUtils import create_origin_label, aggregate_meta_data_from_labeled_data, aggregate_meta_data_from_meta_data, enrich_country_dict
+from FilesUtils import save_to_log, save_json_array_to_file, save_labeled_records, iter_labeled_records, concatenate_files, get_labeled_data_path, is_labeled_data_file, pop_cli_option, RollingRecordsWriter
+import CorpusCatalog
+import DataLabelingUtils
+import FilesUtils
+import Deduplication
+import Instrumentation
+from DataLabelingUtils import iter_origin_labels, aggregate_meta_data_from_labeled_data, aggregate_meta_data_from_meta_data, enrich_country_dict, is_short_and_not_date
 
-def label_all_files_in_path(path: str):
+LABEL_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_FILE_ENTRIES = 50000
+# The journal of the files a label run completed. Its name has "log" in it, so it is not labeled as a raw file (see get_files_to_label).
+LABEL_JOURNAL_NAME = "label_journal_log.jsonl"
+
+def label_all_files_in_path(path: str, compress: str = None, deduplicator: Deduplication.Deduplicator = None, catalog: CorpusCatalog.CorpusCatalog = None,
+                            journal: FilesUtils.RunJournal = None):
     """
         Labels all files in the provided path.
+        compress: Optional compression of the labeled data files (see FilesUtils.COMPRESSED_SUFFIXES).
+        deduplicator: Optional Deduplication.Deduplicator dropping the rows whose email:password pair was already labeled, in this or a previous file.
+        catalog: Optional CorpusCatalog.CorpusCatalog the counts of every labeled data file are recorded to.
+        journal: Optional FilesUtils.RunJournal of the labeled files. Files it has as labeled are skipped and their journaled counts are used
+                 (see get_journaled_domains_count), and every file labeled is recorded to it, so a restarted run only labels the unfinished files.
         Returns a dictionary of {country: #_of_passwords}
     """
     if not os.path.isdir(path):
         print("bad path")
     domains_count = defaultdict(int)
+    for file_path in get_files_to_label(path):
+        labeled_path = get_labeled_data_path(file_path, compress)
+        file_domains_count = get_journaled_domains_count(journal, file_path, labeled_path)
+        if file_domains_count is None:
+            file_domains_count = defaultdict(int)
+            if not label_file(file_path, file_domains_count, compress, deduplicator, catalog):
+                continue
+            if journal is not None:
+                journal_labeled_file(journal, file_path, labeled_path, file_domains_count)
+        for country, count in file_domains_count.items():
+            domains_count[country] += count
+    return domains_count
+
+def get_journaled_domains_count(journal: FilesUtils.RunJournal, file_path: str, labeled_path: str):
+    """
+        Returns the {country: #_of_passwords} journaled for the raw file if it was labeled to labeled_path and neither file changed since,
+        otherwise None.
+    """
+    if journal is None:
+        return None
+    entry = journal.get(file_path)
+    if (entry is None or entry["fingerprint"] != FilesUtils.get_file_fingerprint(file_path) or entry["labeled_path"] != journal.get_key(labeled_path)
+            or entry["labeled_fingerprint"] != FilesUtils.get_file_fingerprint(labeled_path)):
+        return None
+    return dict(entry["domains_count"])
+
+def journal_labeled_file(journal: FilesUtils.RunJournal, file_path: str, labeled_path: str, domains_count: dict):
+    """
+        Records a labeled raw file to the journal, with the fingerprints of the raw and labeled files and the file's {country: #_of_passwords}
+        (as pairs, so a None country stays None).
+    """
+    journal.record(file_path, fingerprint=FilesUtils.get_file_fingerprint(file_path), labeled_path=journal.get_key(labeled_path),
+                   labeled_fingerprint=FilesUtils.get_file_fingerprint(labeled_path), domains_count=list(domains_count.items()))
+
+def get_files_to_label(path: str):
+    """
+        Returns the paths of all the raw data files in the provided path, skipping labeled data, meta data and log files.
+    """
+    files_to_label = []
     for root, directories, files in os.walk(path):
         for file_name in files:
             if not "data" in file_name and not "meta" in file_name and not "log" in file_name:
-                file_path = os.path.join(root, file_name)
-                label_file(file_path, domains_count)
+                files_to_label.append(os.path.join(root, file_name))
+    return files_to_label
+
+def label_all_files_in_path_parallel(path: str, workers: int, domain_cache_path: str = None, compress: str = None, deduplicator: Deduplication.Deduplicator = None,
+                                     catalog: CorpusCatalog.CorpusCatalog = None, journal: FilesUtils.RunJournal = None):
+    """
+        A parallel version of label_all_files_in_path.
+        Every file is split to byte-range chunks of at most LABEL_CHUNK_SIZE bytes and the chunks are labeled by a pool of `workers` processes,
+        largest chunks first. Each chunk is labeled to its own fragment file with its own domains_count, and when all chunks are done the
+        fragments of every file are concatenated, in order, to the same labeled data file label_file creates and the counts are merged.
+        Every worker starts from the domain cache saved in domain_cache_path (if provided), and the domains the workers resolve are merged back to the parent's cache.
+        If a deduplicator is provided, the parent deduplicates the records of the fragments while merging them, in the order label_all_files_in_path labels them,
+        so the same rows are dropped as when labeling serially.
+        If a catalog is provided, the workers count the records of their chunks and the counts of every labeled data file are recorded to it
+        (counted by the parent while merging when deduplicating, as the workers count the records before deduplication).
+        If a journal is provided, the files it has as labeled are skipped like in label_all_files_in_path, and every file is recorded to it once its fragments are merged.
+        Returns a dictionary of {country: #_of_passwords}
+    """
+    if not os.path.isdir(path):
+        print("bad path")
+    tasks = []
+    fragments = {}
+    journaled_counts = {}
+    files_to_label = get_files_to_label(path)
+    for file_path in files_to_label:
+        labeled_path = get_labeled_data_path(file_path, compress)
+        journaled_count = get_journaled_domains_count(journal, file_path, labeled_path)
+        if journaled_count is not None:
+            journaled_counts[file_path] = journaled_count
+            continue
+        fragments[file_path] = (labeled_path, [])
+        for index, (start, end) in enumerate(split_file_to_chunks(file_path, LABEL_CHUNK_SIZE)):
+            fragment_path = FilesUtils.add_path_tag(labeled_path, f".part{index}")
+            fragments[file_path][1].append(fragment_path)
+            tasks.append((file_path, start, end, fragment_path, catalog is not None))
+    tasks.sort(key=lambda task: task[2] - task[1], reverse=True)
+
+    files_count = defaultdict(lambda: defaultdict(int))
+    files_counts = defaultdict(CorpusCatalog.FileCounts)
+    failed_files = set()
+    with multiprocessing.Pool(processes=workers, initializer=init_label_worker, initargs=(domain_cache_path,)) as pool:
+        for file_path, chunk_domains_count, error, cache_updates, cache_stats, chunk_stats, chunk_counts in pool.imap_unordered(label_chunk, tasks):
+            Instrumentation.record("label", file_path, **chunk_stats)
+            DataLabelingUtils.merge_domain_cache_updates(cache_updates)
+            for stat, value in cache_stats.items():
+                DataLabelingUtils.domain_cache_stats[stat] += value
+            if error is not None:
+                save_to_log(log_path, "Error in file: " + file_path + f"\t{error}")
+                failed_files.add(file_path)
+                continue
+            for country, count in chunk_domains_count.items():
+                files_count[file_path][country] += count
+            if chunk_counts is not None:
+                files_counts[file_path].update(chunk_counts)
+
+    domains_count = defaultdict(int)
+    for file_path in files_to_label:
+        if file_path in journaled_counts:
+            for country, count in journaled_counts[file_path].items():
+                domains_count[country] += count
+            continue
+        (labeled_path, fragment_paths) = fragments[file_path]
+        if file_path in failed_files:
+            for fragment_path in fragment_paths:
+                if os.path.isfile(fragment_path):
+                    os.remove(fragment_path)
+            continue
+        # The fragments are merged to a temporary file that replaces the labeled file once complete.
+        temp_path = FilesUtils.add_path_tag(labeled_path, ".tmp")
+        if deduplicator is not None:
+            files_counts[file_path] = CorpusCatalog.FileCounts() if catalog is not None else None
+            merge_unique_fragments(fragment_paths, temp_path, deduplicator, files_count[file_path], files_counts[file_path])
+        else:
+            concatenate_files(fragment_paths, temp_path)
+        FilesUtils.replace_file(temp_path, labeled_path)
+        if catalog is not None:
+            catalog.record_file(labeled_path, "labeled", files_counts[file_path])
+        if journal is not None:
+            journal_labeled_file(journal, file_path, labeled_path, files_count[file_path])
+        for country, count in files_count[file_path].items():
+            domains_count[country] += count
     return domains_count
 
-def label_file(file_path: str, domains_count):
+def merge_unique_fragments(fragment_paths: list, labeled_path: str, deduplicator: Deduplication.Deduplicator, domains_count: dict,
+                           file_counts: CorpusCatalog.FileCounts = None):
+    """
+        Writes the records of the fragments, in order, whose pair the deduplicator didn't see before to the labeled data file, deletes
+        the fragments, and removes the dropped records from domains_count. The written records are counted in file_counts, if provided.
+    """
+    records = itertools.chain.from_iterable(map(iter_labeled_records, fragment_paths))
+    with Instrumentation.measure("dedup", labeled_path) as measurement:
+        records = deduplicator.iter_unique_records(records, domains_count)
+        if file_counts is not None:
+            records = file_counts.iter_counted(records)
+        records_out = save_labeled_records(records, labeled_path)
+        measurement.add(records_out=records_out, bytes_written=Instrumentation.get_file_size(labeled_path))
+    for fragment_path in fragment_paths:
+        os.remove(fragment_path)
+
+def split_file_to_chunks(file_path: str, chunk_size: int):
+    """
+        Splits the file to consecutive byte ranges of at most chunk_size bytes.
+        A zst file is split at its frame boundaries instead, every range holding consecutive frames of about chunk_size compressed bytes,
+        and other compressed files, which can't be split, have a single range (see FilesUtils.iter_line_blocks).
+        Returns a list of (start, end) tuples. An empty file has a single empty range.
+    """
+    file_size = os.path.getsize(file_path)
+    compression = FilesUtils.detect_compression(file_path)
+    if compression == "zst":
+        chunks = []
+        for (offset, size) in FilesUtils.get_zstd_frames(file_path):
+            if chunks and offset - chunks[-1][0] < chunk_size:
+                chunks[-1] = (chunks[-1][0], offset + size)
+            else:
+                chunks.append((offset, offset + size))
+        return chunks or [(0, file_size)]
+    if compression is not None:
+        return [(0, file_size)]
+    return [(start, min(start + chunk_size, file_size)) for start in range(0, file_size, chunk_size)] or [(0, 0)]
+
+def init_label_worker(domain_cache_path: str):
+    """
+        Initializes a worker process of label_all_files_in_path_parallel with the saved domain cache.
+    """
+    if domain_cache_path:
+        DataLabelingUtils.load_domain_cache(domain_cache_path)
+
+def label_chunk(task: tuple):
+    """
+        Labels a byte range of a file to a fragment file. Runs inside a worker process of label_all_files_in_path_parallel.
+        Returns a tuple of (file_path, {country: #_of_passwords}, error, domain_cache_updates, domain_cache_stats, chunk_stats, chunk_counts)
+        where error is None if the chunk was labeled successfully, chunk_stats holds the chunk's measurements for Instrumentation and chunk_counts
+        the chunk's CorpusCatalog.FileCounts counts if the task asks to count the records (otherwise None).
+    """
+    (file_path, start, end, fragment_path, count_records) = task
+    domains_count = defaultdict(int)
+    file_counts = CorpusCatalog.FileCounts() if count_records else None
+    start_time, start_cpu, start_lines = time.perf_counter(), time.process_time(), DataLabelingUtils.labeling_stats["lines"]
+    try:
+        data = iter_origin_labels(file_path, domains_count, start, end)
+        if file_counts is not None:
+            data = file_counts.iter_counted(data)
+        records_out = save_labeled_records(data, fragment_path)
+        error = None
+    except Exception as e:
+        domains_count, error, records_out = None, str(e), 0
+    cache_updates, cache_stats = DataLabelingUtils.pop_domain_cache_updates()
+    chunk_stats = {
+        "wall_seconds": time.perf_counter() - start_time,
+        "cpu_seconds": time.process_time() - start_cpu,
+        "records_in": DataLabelingUtils.labeling_stats["lines"] - start_lines,
+        "records_out": records_out,
+        "bytes_read": end - start,
+        "bytes_written": Instrumentation.get_file_size(fragment_path),
+        "peak_rss_mb": Instrumentation.get_peak_rss_mb()
+    }
+    return (file_path, dict(domains_count) if error is None else None, error, cache_updates, cache_stats, chunk_stats,
+            file_counts.countries if file_counts is not None and error is None else None)
+
+def label_file(file_path: str, domains_count, compress: str = None, deduplicator: Deduplication.Deduplicator = None, catalog: CorpusCatalog.CorpusCatalog = None):
     """
         Labels a single file.
-        Creates a new file with the same name and the suffix "_labeled_data.json".
+        Creates a new file with the same name and the suffix "_labeled_data.json" (and the compression suffix if compress is provided), holding a json record per line.
+        The rows are labeled and written one by one, so memory stays flat regardless of the size of the file.
+        If a deduplicator is provided, rows whose email:password pair it already saw are not written nor counted in domains_count.
+        If a catalog is provided, the records are counted as they are written and the counts of the labeled data file are recorded to it.
+        The records are written to a temporary file that atomically replaces the labeled data file once complete (see FilesUtils.replace_file),
+        so an interrupted or failed file never leaves a partial labeled data file.
+        Returns True if the file was labeled.
     """
+    is_labeled = False
     if os.path.isfile(file_path):
-        try:
-            data = create_origin_label(file_path, domains_count)
-            save_json_array_to_file(data, file_path.replace("\\", "/") + "_labeled_data.json")
-        except Exception as e:
-            save_to_log(log_path, "Error in file: " + file_path + f"\t{e}")
+        labeled_path = get_labeled_data_path(file_path, compress)
+        temp_path = FilesUtils.add_path_tag(labeled_path, ".tmp")
+        with Instrumentation.measure("label", file_path, profile=True) as measurement:
+            start_lines = DataLabelingUtils.labeling_stats["lines"]
+            try:
+                data = iter_origin_labels(file_path, domains_count)
+                if deduplicator is not None:
+                    data = deduplicator.iter_unique_records(data, domains_count)
+                file_counts = CorpusCatalog.FileCounts()
+                if catalog is not None:
+                    data = file_counts.iter_counted(data)
+                records_out = save_labeled_records(data, temp_path)
+                FilesUtils.replace_file(temp_path, labeled_path)
+                measurement.add(records_in=DataLabelingUtils.labeling_stats["lines"] - start_lines, records_out=records_out)
+                if catalog is not None:
+                    catalog.record_file(labeled_path, "labeled", file_counts)
+                is_labeled = True
+            except Exception as e:
+                save_to_log(log_path, "Error in file: " + file_path + f"\t{e}")
+                if os.path.isfile(temp_path):
+                    os.remove(temp_path)
+            measurement.add(bytes_read=Instrumentation.get_file_size(file_path), bytes_written=Instrumentation.get_file_size(labeled_path))
+    return is_labeled
 
 
-def calculate_meta_data_by_directory(path: str, domains_count):
+def calculate_meta_data_by_directory(path: str, domains_count, catalog: CorpusCatalog.CorpusCatalog = None):
     """
         Calculates the meta data of all files in the provided path.
+        If a catalog is provided, only the labeled data files that changed since they were recorded are scanned (see CorpusCatalog.refresh)
+        and the meta data is queried from the catalog.
     """
-    if os.path.isfile(path) and path.find("labeled_data") > 0:
+    if catalog is not None:
+        catalog.refresh(path)
+        for country, (records, legal, illegal) in catalog.count_countries(path, "labeled").items():
+            domains_count[country] += records
+        if os.path.isdir(path):
+            save_json_array_to_file(domains_count, path.replace("\\", "/") + "/dir_meta_data.json")
+        return
+    if os.path.isfile(path) and is_labeled_data_file(path):
         aggregate_meta_data_from_labeled_data(path.replace("\\", "/"), domains_count)
     elif os.path.isdir(path):
         for root, directories, files in os.walk(path):
@@ -46,10 +293,24 @@ def calculate_meta_data_by_directory(path: str, domains_count):
         save_json_array_to_file(domains_count, path.replace("\\", "/") + "/dir_meta_data.json")
 
 
-def aggreagte_meta_data_from_meta_data_files(path: str, domains_count):
+def aggreagte_meta_data_from_meta_data_files(path: str, domains_count, catalog: CorpusCatalog.CorpusCatalog = None):
     """
         Calculates the meta data of all files in the provided path.
+        If a catalog is provided, the meta data is queried from the counts of the country files the catalog has under the path, or of the labeled data
+        files if it has no country files there, instead of from the meta_data files, after re-scanning the files that changed since they were recorded
+        (see CorpusCatalog.refresh). The two kinds are never summed, as the country files hold the records of the labeled data files.
     """
+    if catalog is not None:
+        catalog.refresh(path)
+        country_counts = catalog.count_countries(path, "shard")
+        if len(country_counts) == 0:
+            country_counts = catalog.count_countries(path, "labeled")
+        for country, (records, legal, illegal) in country_counts.items():
+            domains_count[country] += records
+            domains_count["total"] += records
+        if os.path.isdir(path):
+            save_json_array_to_file(domains_count, path.replace("\\", "/") + "/dir_meta_data.json")
+        return
     if os.path.isfile(path) and path.find("meta_data") > 0:
         aggregate_meta_data_from_meta_data(path.replace("\\", "/"), domains_count)
     elif os.path.isdir(path):
@@ -72,61 +333,166 @@ def create_country_files(destination_path: str, path: str, country: str, country
         Returns:
             (list, int): tuple of the updated country_data and the current file_index.
     """
-    total_passwords = 0
     if not os.path.exists(destination_path + "" f"/{country}"):
         os.makedirs(destination_path + "" f"/{country}")
-    MAX_FILE_ENTRIES = 50000
-    if os.path.isfile(path) and path.find("labeled_data") > 0:
+    if os.path.isfile(path) and is_labeled_data_file(path):
         
-        (country_data, file_index) = enrich_country_dict(destination_path, path, country, country_data, MAX_FILE_ENTRIES, file_index)
-        total_passwords += len(country_data)
+        with Instrumentation.measure("country", path, profile=True) as measurement:
+            start_records = file_index * MAX_FILE_ENTRIES + len(country_data)
+            (country_data, file_index) = enrich_country_dict(destination_path, path, country, country_data, MAX_FILE_ENTRIES, file_index)
+            measurement.add(records_out=file_index * MAX_FILE_ENTRIES + len(country_data) - start_records, bytes_read=Instrumentation.get_file_size(path))
         return (country_data, file_index)
     elif os.path.isdir(path):
         for root, directories, files in os.walk(path):
             for file_name in files:
                 file_path = os.path.join(root, file_name)
                 (country_data, file_index) = create_country_files(destination_path=destination_path, path=file_path, country=country, country_data=country_data, file_index=file_index)
-        total_passwords += len(country_data)
-        return (country_data, file_index)
+        total_passwords = file_index * MAX_FILE_ENTRIES + len(country_data)
+        if len(country_data) > 0:
+            save_labeled_records(country_data, destination_path + "" f"/{country}" + f"/{country}_{file_index}.json")
+            file_index += 1
+            country_data = []
+        write_country_meta_data(destination_path, country, total_passwords)
+    return (country_data, file_index)
+
+def shard_labeled_data(destination_path: str, path: str, countries: set = None, compress: str = None, deduplicator: Deduplication.Deduplicator = None,
+                       catalog: CorpusCatalog.CorpusCatalog = None):
+    """
+        Creates the country files of all countries in a single read of the labeled data in `path`, instead of a create_country_files run per country.
+        Every record is routed to a RollingRecordsWriter of its country, which starts a new file every MAX_FILE_ENTRIES records,
+        and a meta_data.json with the country's total is written to every country directory.
+        Args:
+            destination_path (str): path to the destination folder
+            path (str): path to the labeled data
+            countries (set): optional allow-list of countries to create files for. If None, files are created for every labeled country.
+            compress (str): optional compression of the country files (see FilesUtils.COMPRESSED_SUFFIXES)
+            deduplicator (Deduplication.Deduplicator): optional deduplicator dropping the records whose email:password pair was already written.
+            catalog (CorpusCatalog.CorpusCatalog): optional catalog the counts of every country file are recorded to.
+        Returns:
+            dict: a dictionary of {country: #_of_passwords} written.
+    """
+    writers = {}
+    for root, directories, files in os.walk(path):
+        for file_name in files:
+            if not is_labeled_data_file(file_name):
+                continue
+            file_path = os.path.join(root, file_name)
+            with Instrumentation.measure("shard", file_path, profile=True) as measurement:
+                records_in, records_out = 0, 0
+                try:
+                    for user in iter_labeled_records(file_path):
+                        records_in += 1
+                        country = user['country']
+                        if country is None or country == "null" or (countries is not None and country not in countries):
+                            continue
+                        if is_short_and_not_date(user['password']):
+                            continue
+                        if deduplicator is not None and deduplicator.is_duplicate(user):
+                            continue
+                        if country not in writers:
+                            writers[country] = RollingRecordsWriter(destination_path + "" f"/{country}", country, MAX_FILE_ENTRIES, compress, catalog=catalog)
+                        writers[country].write(user)
+                        records_out += 1
+                except Exception as e:
+                    print(e, file_path)
+                measurement.add(records_in=records_in, records_out=records_out, bytes_read=Instrumentation.get_file_size(file_path))
+    countries_count = {}
+    for country, writer in writers.items():
+        writer.close()
+        write_country_meta_data(destination_path, country, writer.total_records)
+        countries_count[country] = writer.total_records
+    return countries_count
+
+def write_country_meta_data(destination_path: str, country: str, total_passwords: int):
+    """
+        Writes the total number of passwords of the country to the meta_data.json in its directory.
+    """
     with open(destination_path + "" f"/{country}/meta_data.json", 'w+') as f:
         f.write(f"Total passwords: {total_passwords}\n")
-    return (country_data, file_index)
     
     
 def main():
     """
         Provides different data analysis functions.
-        Usage: python DataPreparation.py <path> <function> <destination_path> <country>
+        Usage: python DataPreparation.py <path> <function> <destination_path> <country> [--workers <n>] [--domain_cache <cache_path>] [--compress <gz/bz2/xz/zst>] [--countries <country>,<country>...] [--dedup <bloom/exact>] [--catalog <catalog_path>] [--metrics <report_path>]
 
         Args:
             path (str): path to the data
-            function (str): one of the following: label, meta_data, aggregate, country
+            function (str): one of the following: label, meta_data, aggregate, country, shard
                 label - label all files in path
                 meta_data - calculate meta data for all the directories in path
                 aggregate - aggregate meta data from all the meta data files in path
                 country - create country files from labeled data
+                shard - create the country files of all countries from labeled data in a single pass
             destination_path (str): path to the destination folder
             country (str): country name
+            --workers (int): number of processes to label with. Defaults to 1, which labels the files serially.
+            --domain_cache (str): path of a {domain: country} cache file to load before labeling and to save after it.
+            --compress (str): compression of the labeled data or country files, one of FilesUtils.COMPRESSED_SUFFIXES. Defaults to no compression.
+            --countries (str): comma separated allow-list of countries to shard. Defaults to all countries.
+            --dedup, --dedup_path, --dedup_capacity, --dedup_error_rate: Drop the repeated email:password pairs when labeling or sharding
+                (see Deduplication.create_deduplicator_from_cli).
+                The number of dropped records is saved to meta_data.json as "duplicates".
+            --catalog (str): path of a CorpusCatalog SQLite file. label and shard record the counts of the files they write to it, and meta_data
+                and aggregate query it, re-scanning only the files that changed. Defaults to no catalog, which scans all the files.
+            --metrics, --metrics_format, --profile: Instrumentation report options (see Instrumentation.enable_from_cli). Defaults to no report.
+        A label run records every labeled file to the LABEL_JOURNAL_NAME journal of the path, so when it is interrupted and started again
+        it only labels the unfinished files, and saves the same meta data as an uninterrupted run. Runs with --dedup start over, as the pairs
+        the deduplicator saw in the unfinished files can't be removed from it.
     """
+    Instrumentation.enable_from_cli(sys.argv)
+    workers = int(pop_cli_option(sys.argv, "workers", 1))
+    domain_cache_path = pop_cli_option(sys.argv, "domain_cache")
+    compress = pop_cli_option(sys.argv, "compress")
+    countries = pop_cli_option(sys.argv, "countries")
+    catalog_path = pop_cli_option(sys.argv, "catalog")
+    deduplicator = Deduplication.create_deduplicator_from_cli(sys.argv)
+    catalog = CorpusCatalog.CorpusCatalog(catalog_path) if catalog_path else None
     path = sys.argv[1]
     global log_path
     function = sys.argv[2]
     log_path = os.path.join(path, f"{function}_log.txt")
     with open(log_path, 'w+') as f:
         f.write(f"Start {function}\n")
-    if function == "label":
-        domains_count = label_all_files_in_path(path)
-        domains_count["total"] = sum(domains_count.values())
-        save_json_array_to_file(domains_count, path + "/meta_data.json")
-    elif function == "meta_data":
-        calculate_meta_data_by_directory(path, domains_count=domains_count)
-    elif function == "aggregate":
-        aggreagte_meta_data_from_meta_data_files(path, domains_count)
-    elif function == "country":
-        country = sys.argv[4]
-        country_data = []
-        destination_path = sys.argv[3].replace("\\", "/")
-        create_country_files(destination_path=destination_path, path=path, country=country, country_data=country_data, file_index=0)
+    with Instrumentation.measure(function):
+        if function == "label":
+            if domain_cache_path:
+                DataLabelingUtils.load_domain_cache(domain_cache_path)
+            journal = FilesUtils.RunJournal(os.path.join(path, LABEL_JOURNAL_NAME)) if deduplicator is None else None
+            if workers > 1:
+                domains_count = label_all_files_in_path_parallel(path, workers, domain_cache_path, compress, deduplicator, catalog, journal)
+            else:
+                domains_count = label_all_files_in_path(path, compress, deduplicator, catalog, journal)
+            if journal is not None:
+                journal.close()
+            save_to_log(log_path, f"Domain cache: {DataLabelingUtils.domain_cache_stats['hits']} hits, {DataLabelingUtils.domain_cache_stats['misses']} misses")
+            if domain_cache_path:
+                DataLabelingUtils.save_domain_cache(domain_cache_path)
+            domains_count["total"] = sum(domains_count.values())
+            if deduplicator is not None:
+                domains_count["duplicates"] = deduplicator.total_duplicates()
+            save_json_array_to_file(domains_count, path + "/meta_data.json")
+        elif function == "meta_data":
+            calculate_meta_data_by_directory(path, domains_count=defaultdict(int), catalog=catalog)
+        elif function == "aggregate":
+            aggreagte_meta_data_from_meta_data_files(path, defaultdict(int), catalog)
+        elif function == "country":
+            country = sys.argv[4]
+            country_data = []
+            destination_path = sys.argv[3].replace("\\", "/")
+            create_country_files(destination_path=destination_path, path=path, country=country, country_data=country_data, file_index=0)
+        elif function == "shard":
+            destination_path = sys.argv[3].replace("\\", "/")
+            countries_count = shard_labeled_data(destination_path, path, set(countries.split(",")) if countries else None, compress, deduplicator, catalog)
+            countries_count["total"] = sum(countries_count.values())
+            if deduplicator is not None:
+                countries_count["duplicates"] = deduplicator.total_duplicates()
+            save_json_array_to_file(countries_count, destination_path + "/meta_data.json")
+    if deduplicator is not None:
+        deduplicator.close()
+    if catalog is not None:
+        catalog.close()
+    Instrumentation.save_report()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
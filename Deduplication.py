@@ -0,0 +1,147 @@
+import hashlib
+import math
+import os
+import sqlite3
+from collections import defaultdict
+from FilesUtils import pop_cli_option
+
+DEDUP_MODES = ["bloom", "exact"]
+BLOOM_CAPACITY = 10000000
+BLOOM_ERROR_RATE = 0.001
+EXACT_COMMIT_INTERVAL = 100000
+# The file name has "data" in it, so it is not labeled as a raw file (see DataPreparation.get_files_to_label).
+EXACT_FILE_NAME = "dedup_data.sqlite"
+
+class BloomFilter:
+    """
+        A Bloom filter of the hashed pairs, sized for `capacity` pairs with a false positive rate of `error_rate`: it takes
+        -capacity * ln(error_rate) / ln(2)^2 bits (about 1.8 MB per million pairs at 0.1%), however many pairs are added.
+        A false positive drops a unique pair as a duplicate, a duplicate is never kept.
+        The k bit indices of a pair are derived from a single 128 bit blake2b hash (Kirsch & Mitzenmacher double hashing).
+        If path is provided, the bits are loaded from it if it exists, and saved to it by close, so dumps ingested by later runs are deduplicated too.
+        A saved filter must be loaded with the capacity and error rate it was created with.
+    """
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE, path: str = None):
+        self.bits_count = (max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 1) + 7) // 8 * 8
+        self.hashes_count = max(int(round(self.bits_count / capacity * math.log(2))), 1)
+        self.path = path
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as file:
+                self.bits = bytearray(file.read())
+            self.bits_count = len(self.bits) * 8
+        else:
+            self.bits = bytearray(self.bits_count // 8)
+
+    def add(self, key: str):
+        """
+            Adds the key and returns True if it was (probably) added before.
+        """
+        digest = hashlib.blake2b(key.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        first_hash, second_hash = int.from_bytes(digest[ : 8], "little"), int.from_bytes(digest[8 : ], "little") | 1
+        bits, bits_count = self.bits, self.bits_count
+        is_duplicate = True
+        for index in range(self.hashes_count):
+            bit = (first_hash + index * second_hash) % bits_count
+            mask = 1 << (bit & 7)
+            if not bits[bit >> 3] & mask:
+                is_duplicate = False
+                bits[bit >> 3] |= mask
+        return is_duplicate
+
+    def close(self):
+        if self.path is not None:
+            with open(self.path, "wb") as file:
+                file.write(self.bits)
+
+class DiskHashSet:
+    """
+        An exact set of the hashed pairs in a SQLite table on disk, so memory is bounded by SQLite's page cache however many pairs are added.
+        Pairs are kept as 128 bit blake2b hashes, which makes a false duplicate as likely as a hash collision.
+        The file at path is kept by close, so dumps ingested by later runs are deduplicated too.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pairs (hash BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.uncommitted = 0
+
+    def add(self, key: str):
+        """
+            Adds the key and returns True if it was added before.
+        """
+        digest = hashlib.blake2b(key.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        cursor = self.connection.execute("INSERT OR IGNORE INTO pairs VALUES (?)", (digest,))
+        self.uncommitted += 1
+        if self.uncommitted >= EXACT_COMMIT_INTERVAL:
+            self.connection.commit()
+            self.uncommitted = 0
+        return cursor.rowcount == 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+class Deduplicator:
+    """
+        Drops the records whose email:password pair was already seen, and counts the dropped records by country.
+        Pairs are compared with the email lowercased and the line terminator of the password removed, as the same credentials are
+        written with both by different dumps.
+
+        Args:
+            mode: "bloom" for a fixed-memory BloomFilter, or "exact" for a DiskHashSet
+            path: The file of the filter (optional for bloom, required for exact)
+            capacity, error_rate: The size of a bloom filter (see BloomFilter)
+    """
+    def __init__(self, mode: str, path: str = None, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode {mode}, expected one of {DEDUP_MODES}")
+        self.pairs = BloomFilter(capacity, error_rate, path) if mode == "bloom" else DiskHashSet(path)
+        self.duplicates = defaultdict(int)
+
+    def is_duplicate(self, record: dict):
+        """
+            Returns True if the pair of the record was seen before, and marks it as seen otherwise.
+        """
+        if self.pairs.add(record["email"].lower() + "\n" + record["password"].rstrip("\r\n")):
+            self.duplicates[record["country"]] += 1
+            return True
+        return False
+
+    def iter_unique_records(self, records, domains_count: dict = None):
+        """
+            Yields the records whose pair was not seen before. The count of every dropped record is removed from domains_count, if provided.
+        """
+        for record in records:
+            if self.is_duplicate(record):
+                if domains_count is not None:
+                    domains_count[record["country"]] -= 1
+                continue
+            yield record
+
+    def total_duplicates(self):
+        return sum(self.duplicates.values())
+
+    def close(self):
+        self.pairs.close()
+
+def create_deduplicator_from_cli(argv: list):
+    """
+        Removes the deduplication options from argv and returns a Deduplicator if --dedup was provided, otherwise None.
+        Call it after the other options are removed, as the default file of the exact set is in the directory of the first positional argument.
+        Options:
+            --dedup <bloom/exact>: The deduplication mode
+            --dedup_path <path>: The file of the filter. Defaults to EXACT_FILE_NAME in the data path for exact deduplication, and to no file for bloom.
+            --dedup_capacity <n>: The number of pairs a bloom filter is sized for. Defaults to BLOOM_CAPACITY.
+            --dedup_error_rate <rate>: The false positive rate of a bloom filter. Defaults to BLOOM_ERROR_RATE.
+    """
+    mode = pop_cli_option(argv, "dedup")
+    path = pop_cli_option(argv, "dedup_path")
+    capacity = int(pop_cli_option(argv, "dedup_capacity", BLOOM_CAPACITY))
+    error_rate = float(pop_cli_option(argv, "dedup_error_rate", BLOOM_ERROR_RATE))
+    if not mode:
+        return None
+    if path is None and mode == "exact":
+        path = os.path.join(argv[1], EXACT_FILE_NAME)
+    return Deduplicator(mode, path, capacity, error_rate)
@@ -0,0 +1,249 @@
+import array
+import codecs
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+
+BINARY_MAGIC = b"PWDIST01"
+# magic, byte order mark, probability item size, #_of_keys, #_of_hash_slots, offsets of: key offsets, key blob, probabilities, ranks, hash slots
+HEADER_FORMAT = "=8sIIQQQQQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+BYTE_ORDER_MARK = 0x01020304
+PROBABILITY_FORMATS = {"float64": "d", "float32": "f"}
+
+def save_binary_distribution(sorted_items: list, file_name: str, path: str, precision: str = "float64", hash_index: bool = True):
+    """
+        Saves a list of (key, p) pairs, sorted by key, as a binary distribution file "{file_name}.bin" next to the text distribution files.
+        The file holds a header, the key offsets (uint64), the utf-8 key blob, the probabilities (float64 or float32), the rank of every key
+        by descending probability (uint32) and, if hash_index, an open addressing hash table of key indices (uint32), in native byte order.
+        Read it with BinaryDistribution.
+
+        Args:
+            sorted_items: A list of (key, p) pairs sorted by key
+            file_name: The desiered name to the file created
+            path: The path to the model, the file is created in its "distributions" directory
+            precision: "float64" or "float32"
+            hash_index: If True, adds a hash table for O(1) lookups. Otherwise lookups use binary search.
+    """
+    distribution_path = os.path.join(path, "distributions")
+    Path(distribution_path).mkdir(parents=True, exist_ok=True)
+    file_path = os.path.join(distribution_path, file_name + ".bin")
+
+    encoded_keys = [key.encode("utf-8", "surrogatepass") for key, _ in sorted_items]
+    key_offsets = array.array("Q", [0])
+    for encoded_key in encoded_keys:
+        key_offsets.append(key_offsets[-1] + len(encoded_key))
+    probabilities = array.array(PROBABILITY_FORMATS[precision], (value for _, value in sorted_items))
+    order = sorted(range(len(sorted_items)), key=lambda index: sorted_items[index][1], reverse=True)
+    ranks = array.array("I", bytes(4 * len(sorted_items)))
+    for rank, index in enumerate(order):
+        ranks[index] = rank + 1
+    hash_slots = array.array("I")
+    if hash_index and len(encoded_keys) > 0:
+        slots_count = 1 << (2 * len(encoded_keys) - 1).bit_length()
+        hash_slots = array.array("I", bytes(4 * slots_count))
+        mask = slots_count - 1
+        for index, encoded_key in enumerate(encoded_keys):
+            slot = zlib.crc32(encoded_key) & mask
+            while hash_slots[slot] != 0:
+                slot = (slot + 1) & mask
+            hash_slots[slot] = index + 1
+
+    sections = [key_offsets.tobytes(), b"".join(encoded_keys), probabilities.tobytes(), ranks.tobytes(), hash_slots.tobytes()]
+    section_offsets = []
+    offset = HEADER_SIZE
+    for section in sections:
+        offset = align(offset)
+        section_offsets.append(offset)
+        offset += len(section)
+    header = struct.pack(HEADER_FORMAT, BINARY_MAGIC, BYTE_ORDER_MARK, probabilities.itemsize, len(encoded_keys), len(hash_slots), *section_offsets)
+    with open(file_path, "wb") as file:
+        file.write(header)
+        for section_offset, section in zip(section_offsets, sections):
+            file.write(bytes(section_offset - file.tell()))
+            file.write(section)
+
+def align(offset: int):
+    """
+        Rounds the offset up to a multiple of 8, so every section can be cast to its item type.
+    """
+    return (offset + 7) & ~7
+
+class BinaryDistribution:
+    """
+        A read-only, memory-mapped view of a distribution saved by save_binary_distribution.
+        Opening it only maps the file, so its startup time and memory do not depend on the number of keys, and prob(key)/rank(key)
+        read just the pages they touch. If use_hash_index is False, or the file has no hash index, lookups use binary search over the sorted keys.
+    """
+    def __init__(self, file_path: str, use_hash_index: bool = True):
+        self.use_hash_index = use_hash_index
+        self.file = open(file_path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, byte_order_mark, probability_size, self.size, slots_count, offsets_start, blob_start, probabilities_start, ranks_start, slots_start) = struct.unpack_from(HEADER_FORMAT, self.mmap)
+        if magic != BINARY_MAGIC or byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"{file_path} is not a binary distribution of this platform")
+        view = memoryview(self.mmap)
+        self.key_offsets = view[offsets_start : offsets_start + 8 * (self.size + 1)].cast("Q")
+        self.blob = view[blob_start : blob_start + self.key_offsets[self.size]]
+        self.probabilities = view[probabilities_start : probabilities_start + probability_size * self.size].cast("d" if probability_size == 8 else "f")
+        self.ranks = view[ranks_start : ranks_start + 4 * self.size].cast("I")
+        self.hash_slots = view[slots_start : slots_start + 4 * slots_count].cast("I")
+        self.hash_mask = slots_count - 1
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key: str):
+        return self.index(key) >= 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for view in (self.key_offsets, self.blob, self.probabilities, self.ranks, self.hash_slots):
+            view.release()
+        self.mmap.close()
+        self.file.close()
+
+    def key_at(self, index: int):
+        """
+            Returns the key at the provided index of the key-sorted order.
+        """
+        return bytes(self.blob[self.key_offsets[index] : self.key_offsets[index + 1]]).decode("utf-8", "surrogatepass")
+
+    def index(self, key: str):
+        """
+            Returns the index of the key in the key-sorted order, or -1 if it is not in the distribution.
+        """
+        encoded_key = key.encode("utf-8", "surrogatepass")
+        if self.use_hash_index and len(self.hash_slots) > 0:
+            slot = zlib.crc32(encoded_key) & self.hash_mask
+            while self.hash_slots[slot] != 0:
+                index = self.hash_slots[slot] - 1
+                if self.blob[self.key_offsets[index] : self.key_offsets[index + 1]] == encoded_key:
+                    return index
+                slot = (slot + 1) & self.hash_mask
+            return -1
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            if bytes(self.blob[self.key_offsets[mid] : self.key_offsets[mid + 1]]) < encoded_key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.size and self.blob[self.key_offsets[low] : self.key_offsets[low + 1]] == encoded_key:
+            return low
+        return -1
+
+    def prob(self, key: str):
+        """
+            Returns the probability of the key, or 0.0 if it is not in the distribution.
+        """
+        index = self.index(key)
+        return self.probabilities[index] if index >= 0 else 0.0
+
+    def rank(self, key: str):
+        """
+            Returns the 1-based rank of the key by descending probability, or None if it is not in the distribution.
+        """
+        index = self.index(key)
+        return self.ranks[index] if index >= 0 else None
+
+    def items(self):
+        """
+            Yields the (key, p) pairs of the distribution, sorted by key.
+        """
+        for index in range(self.size):
+            yield (self.key_at(index), self.probabilities[index])
+
+def load_text_distribution(file_path: str):
+    """
+        Loads a text distribution file saved by CreateProbabilityDistribution.save_distribution to a dictionary of {key: p}.
+    """
+    distribution = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            (escaped_key, _, value) = line.rstrip("\n").rpartition(" ")
+            distribution[unescape_key(escaped_key)] = float(value)
+    return distribution
+
+def unescape_key(escaped_key: str):
+    """
+        Reverts the repr(key)[1:-1] escaping of the keys in the text distribution files.
+    """
+    if "\\" not in escaped_key:
+        return escaped_key
+    return codecs.decode(escaped_key.encode("latin-1", "backslashreplace"), "unicode_escape")
+
+def open_distribution(path: str, file_name: str):
+    """
+        Opens the distribution "file_name" of the model in path: the binary file if it exists, otherwise the text file loaded to a dictionary.
+        Both support `key in distribution`, and the probability of a key is distribution.prob(key) or distribution.get(key, 0.0) respectively.
+    """
+    binary_path = os.path.join(path, "distributions", file_name + ".bin")
+    if os.path.isfile(binary_path):
+        return BinaryDistribution(binary_path)
+    return load_text_distribution(os.path.join(path, "distributions", file_name + ".txt"))
+
+def benchmark_distribution(path: str, file_name: str, lookups: int = 100000, seed: int = 0):
+    """
+        Compares the text and binary formats of a distribution of the model in path: the startup time (loading the text file to a dictionary
+        vs mapping the binary file, with and without its hash index) and the average latency of prob(key) over `lookups` random keys, a tenth of them missing.
+        Returns the results as a dictionary.
+    """
+    distribution_path = os.path.join(path, "distributions")
+    results = {"file_name": file_name, "lookups": lookups}
+
+    start = time.perf_counter()
+    text_distribution = load_text_distribution(os.path.join(distribution_path, file_name + ".txt"))
+    results["text_startup_seconds"] = time.perf_counter() - start
+    results["keys"] = len(text_distribution)
+
+    generator = random.Random(seed)
+    keys = list(text_distribution)
+    sample = [generator.choice(keys) if keys and generator.random() < 0.9 else f"missing-{index}" for index in range(lookups)]
+
+    start = time.perf_counter()
+    for key in sample:
+        text_distribution.get(key, 0.0)
+    results["text_lookup_microseconds"] = (time.perf_counter() - start) / max(lookups, 1) * 1e6
+    del text_distribution, keys
+
+    start = time.perf_counter()
+    binary_distribution = BinaryDistribution(os.path.join(distribution_path, file_name + ".bin"))
+    results["binary_startup_seconds"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for key in sample:
+        binary_distribution.prob(key)
+    results["binary_lookup_microseconds"] = (time.perf_counter() - start) / max(lookups, 1) * 1e6
+    binary_distribution.use_hash_index = False
+    start = time.perf_counter()
+    for key in sample:
+        binary_distribution.prob(key)
+    results["binary_search_lookup_microseconds"] = (time.perf_counter() - start) / max(lookups, 1) * 1e6
+    binary_distribution.close()
+    return results
+
+def main():
+    """
+        Benchmarks the text and binary formats of a distribution.
+        Usage: python DistributionStore.py <model_path> <file_name> [lookups]
+        Args:
+            model_path: The path of the model, holding the "distributions" directory
+            file_name: The name of the distribution, e.g. a2 or 100_a2
+            lookups: The number of random lookups to time. Defaults to 100000.
+    """
+    lookups = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    print(json.dumps(benchmark_distribution(sys.argv[1], sys.argv[2], lookups), indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import heapq
+import json
+import os
+from collections import Counter
+from pathlib import Path
+
+SPILL_KEYS = 5000000
+
+class SpillingCounter:
+    """
+        An exact counter whose memory is bounded by max_keys distinct keys: once it holds max_keys keys, its counts are spilled to a run file
+        sorted by key and it starts over. iter_counts merges the runs back with a k-way merge.
+        The first occurrence of every key is kept as a rank, so the merged counts can break ties in the order a Counter of all the keys
+        would iterate them: the keys of a run are ranked by their insertion order, after all the keys of the previous runs.
+
+        Args:
+            directory: The directory of the run files
+            name: The name of the counter, the run files are "{name}_{index}.run"
+            max_keys: The number of keys that triggers a spill
+    """
+    def __init__(self, directory: str, name: str, max_keys: int = SPILL_KEYS):
+        self.directory = directory
+        self.name = name
+        self.max_keys = max_keys
+        self.counter = Counter()
+        self.run_paths = []
+        self.ranks_offset = 0
+        self.spilled_total = 0
+
+    def update(self, keys):
+        """
+            Counts every key of the iterable once, spilling a run if the counter reached max_keys keys.
+        """
+        self.counter.update(keys)
+        if len(self.counter) >= self.max_keys:
+            self.spill()
+
+    def spill(self):
+        """
+            Writes the counts to a new run file, one "json_key<TAB>count<TAB>rank" line per key in key order, and clears them.
+        """
+        if len(self.counter) == 0:
+            return
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+        run_path = os.path.join(self.directory, f"{self.name}_{len(self.run_paths)}.run")
+        ranks = {key: self.ranks_offset + rank for rank, key in enumerate(self.counter)}
+        with open(run_path, "w") as file:
+            for key in sorted(self.counter):
+                file.write(f"{json.dumps(key)}\t{self.counter[key]}\t{ranks[key]}\n")
+        self.run_paths.append(run_path)
+        self.ranks_offset += len(self.counter)
+        self.spilled_total += sum(self.counter.values())
+        self.counter = Counter()
+
+    def total(self):
+        """
+            Returns the number of keys counted, N.
+        """
+        return self.spilled_total + sum(self.counter.values())
+
+    def iter_counts(self):
+        """
+            Spills the remaining counts and yields the (key, count, rank) of every distinct key in key order, merging the counts of the key
+            in all the runs and keeping its smallest rank. Memory is bounded by a line per run.
+        """
+        self.spill()
+        runs = [iter_run(run_path) for run_path in self.run_paths]
+        current = None
+        for (key, count, rank) in heapq.merge(*runs, key=lambda item: item[0]):
+            if current is not None and current[0] == key:
+                current[1] += count
+                current[2] = min(current[2], rank)
+                continue
+            if current is not None:
+                yield tuple(current)
+            current = [key, count, rank]
+        if current is not None:
+            yield tuple(current)
+
+    def iter_counts_by_rank(self):
+        """
+            Yields the (key, count) of every distinct key in the order of their first occurrence, the order a Counter of all the keys iterates them.
+            The merged counts are bucketed to files of max_keys ranks each, and every bucket is sorted by rank in memory, so memory stays bounded
+            by max_keys keys. Every run has at most as many distinct keys as the counter held when it spilled, so there are about as many buckets as runs.
+        """
+        bucket_paths = {}
+        buckets = {}
+        try:
+            for (key, count, rank) in self.iter_counts():
+                bucket = rank // self.max_keys
+                if bucket not in buckets:
+                    bucket_paths[bucket] = os.path.join(self.directory, f"{self.name}_bucket_{bucket}.run")
+                    buckets[bucket] = open(bucket_paths[bucket], "w")
+                buckets[bucket].write(f"{json.dumps(key)}\t{count}\t{rank}\n")
+            for file in buckets.values():
+                file.close()
+            for bucket in sorted(bucket_paths):
+                for (key, count, rank) in sorted(iter_run(bucket_paths[bucket]), key=lambda item: item[2]):
+                    yield (key, count)
+        finally:
+            for file in buckets.values():
+                file.close()
+            for bucket_path in bucket_paths.values():
+                if os.path.isfile(bucket_path):
+                    os.remove(bucket_path)
+
+    def merge_to_file(self, file_path: str):
+        """
+            Writes the merged counts (see iter_counts) to a single run file and deletes the runs. Returns the number of distinct keys.
+        """
+        distinct_keys = 0
+        with open(file_path, "w") as file:
+            for (key, count, rank) in self.iter_counts():
+                file.write(f"{json.dumps(key)}\t{count}\t{rank}\n")
+                distinct_keys += 1
+        self.remove_runs()
+        self.run_paths = [file_path]
+        return distinct_keys
+
+    def remove_runs(self):
+        """
+            Deletes the run files, and their directory once it is empty.
+        """
+        for run_path in self.run_paths:
+            if os.path.isfile(run_path):
+                os.remove(run_path)
+        self.run_paths = []
+        if os.path.isdir(self.directory) and len(os.listdir(self.directory)) == 0:
+            os.rmdir(self.directory)
+
+def iter_run(run_path: str):
+    """
+        Yields the (key, count, rank) entries of a run file.
+    """
+    with open(run_path, "r") as file:
+        for line in file:
+            (key, count, rank) = line.rsplit("\t", 2)
+            yield (json.loads(key), int(count), int(rank))
@@ -1,4 +1,23 @@
+import bz2
+import gzip
+import hashlib
+import io
 import json
+import lzma
+import os
+import re
+import shutil
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LABELED_DATA_SUFFIX = "_labeled_data.json"
+COMPRESSED_SUFFIXES = {"gz": ".gz", "bz2": ".bz2", "xz": ".xz", "zst": ".zst"}
+COMPRESSION_MAGICS = {"gz": b"\x1f\x8b", "bz2": b"BZh", "xz": b"\xfd7zXZ\x00", "zst": b"\x28\xb5\x2f\xfd"}
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+COPY_BUFFER_SIZE = 1024 * 1024
+JSON_ARRAY_SEPARATORS = re.compile(r"[\s,]*")
 
 def save_json_array_to_file(data, file_path):
     with open(file_path, 'w+') as file:
@@ -7,3 +26,473 @@ def save_json_array_to_file(data, file_path):
 def save_to_log(log_path, data):
     with open(log_path, 'a+') as file:
         file.write(data + "\n")
+
+def get_labeled_data_path(file_path: str, compress: str = None):
+    """
+        Returns the path of the labeled data file of the provided raw data file.
+        compress: Optional compression of the labeled data (see COMPRESSED_SUFFIXES).
+    """
+    return file_path.replace("\\", "/") + LABELED_DATA_SUFFIX + (COMPRESSED_SUFFIXES[compress] if compress else "")
+
+def is_labeled_data_file(file_name: str):
+    """
+        Returns True if the file name is of a labeled data file, compressed or not.
+    """
+    return file_name.endswith(LABELED_DATA_SUFFIX) or any(file_name.endswith(LABELED_DATA_SUFFIX + suffix) for suffix in COMPRESSED_SUFFIXES.values())
+
+def open_labeled_file(file_path: str, mode: str):
+    """
+        Opens a labeled data file in text mode.
+        Files are written compressed if their name ends with a suffix of COMPRESSED_SUFFIXES, and read compressed if they start with
+        the magic bytes of a compression (see detect_compression).
+    """
+    if "r" in mode:
+        compression = detect_compression(file_path)
+    else:
+        compression = get_compression_by_suffix(file_path)
+    if compression is not None:
+        return open_compressed_file(file_path, mode + "t" if "t" not in mode else mode, compression)
+    return open(file_path, mode)
+
+def detect_compression(file_path: str):
+    """
+        Returns the compression of the file (a key of COMPRESSED_SUFFIXES) by its magic bytes, or None if it isn't compressed.
+    """
+    with open(file_path, 'rb') as file:
+        magic = file.read(max(len(magic) for magic in COMPRESSION_MAGICS.values()))
+    for compression, compression_magic in COMPRESSION_MAGICS.items():
+        if magic.startswith(compression_magic):
+            return compression
+    if len(magic) >= 4 and int.from_bytes(magic[ : 4], "little") & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+        return "zst"
+    return None
+
+def get_compression_by_suffix(file_path: str):
+    """
+        Returns the compression of the file (a key of COMPRESSED_SUFFIXES) by its name, or None if it has no compressed suffix.
+    """
+    for compression, suffix in COMPRESSED_SUFFIXES.items():
+        if file_path.endswith(suffix):
+            return compression
+    return None
+
+def add_path_tag(file_path: str, tag: str):
+    """
+        Returns the file path with the tag (e.g. ".tmp") added before its compressed suffix, if any, so the tagged file is written
+        with the same compression as the file.
+    """
+    compression = get_compression_by_suffix(file_path)
+    if compression is None:
+        return file_path + tag
+    suffix = COMPRESSED_SUFFIXES[compression]
+    return file_path[ : -len(suffix)] + tag + suffix
+
+def is_temp_file(file_name: str):
+    """
+        Returns True if the file name is of a temporary file (tagged ".tmp" by add_path_tag), which an interrupted run may leave behind
+        unfinished, so it is never read as data.
+    """
+    compression = get_compression_by_suffix(file_name)
+    return (file_name[ : -len(COMPRESSED_SUFFIXES[compression])] if compression is not None else file_name).endswith(".tmp")
+
+def open_compressed_file(file_path: str, mode: str, compression: str):
+    """
+        Opens a file of the provided compression (a key of COMPRESSED_SUFFIXES), in binary or text mode, which is streamed through
+        the decompressor or compressor. Concatenated streams (e.g. several gzip members or zstd frames) are read as one.
+        zst files need the optional zstandard package.
+    """
+    if compression == "gz":
+        return gzip.open(file_path, mode)
+    if compression == "bz2":
+        return bz2.open(file_path, mode)
+    if compression == "xz":
+        return lzma.open(file_path, mode)
+    if compression != "zst":
+        raise ValueError(f"Unknown compression {compression}, expected one of {list(COMPRESSED_SUFFIXES)}")
+    if zstandard is None:
+        raise ImportError(f"Reading or writing {file_path} requires the zstandard package (pip install zstandard)")
+    if "r" in mode:
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader) if "t" in mode else reader
+    return zstandard.open(file_path, mode)
+
+def save_labeled_records(records, file_path: str):
+    """
+        Streams the records of the provided iterable to a labeled data file, one compact json record per line.
+        Returns the number of records written.
+    """
+    records_count = 0
+    with open_labeled_file(file_path, 'w') as file:
+        for record in records:
+            file.write(json.dumps(record))
+            file.write("\n")
+            records_count += 1
+    return records_count
+
+def iter_labeled_records(file_path: str):
+    """
+        Yields the records of a labeled data file one by one.
+        Reads both the line-delimited files written by save_labeled_records and legacy files holding a json array,
+        whose items may be records or json-encoded records. Legacy arrays are parsed incrementally (see iter_json_array), so a file is never held in memory.
+    """
+    with open_labeled_file(file_path, 'r') as file:
+        first_line = file.readline()
+        if first_line.lstrip().startswith("["):
+            # The array is parsed from a new file object, as compressed streams can't always seek back.
+            with open_labeled_file(file_path, 'r') as array_file:
+                for item in iter_json_array(array_file):
+                    yield json.loads(item) if isinstance(item, str) else item
+            return
+        if first_line.strip():
+            yield json.loads(first_line)
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_labeled_passwords(file_path: str):
+    """
+        Yields only the passwords of the records of a labeled data file, one by one, for callers that need nothing else of the records.
+    """
+    for record in iter_labeled_records(file_path):
+        yield record['password']
+
+def iter_json_array(file, read_size: int = COPY_BUFFER_SIZE):
+    """
+        Yields the items of the json array in a text file one by one, reading the file in read_size chunks.
+        Every item is decoded with raw_decode from a buffer holding the unparsed rest of the last chunk, which is refilled when an item
+        is cut by the end of the buffer, so memory is bounded by the chunk size and the largest item rather than by the array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(read_size).lstrip()
+    if not buffer.startswith("["):
+        raise json.JSONDecodeError("Expecting '['", buffer, 0)
+    position = 1
+    while True:
+        position = JSON_ARRAY_SEPARATORS.match(buffer, position).end()
+        if position == len(buffer):
+            buffer, position = file.read(read_size), 0
+            if not buffer:
+                raise json.JSONDecodeError("Unterminated array", "", 0)
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            (item, end) = decoder.raw_decode(buffer, position)
+            error = None
+        except json.JSONDecodeError as decode_error:
+            (end, error) = (len(buffer), decode_error)
+        # The item may be cut by the end of the buffer, so it is decoded again with the next chunk.
+        # A cut number decodes successfully up to a dangling ".", "e", "e+" or "e-", so numbers ending that close to the end are decoded again too.
+        if end == len(buffer) or (isinstance(item, (int, float)) and len(buffer) - end <= 2 and error is None):
+            chunk = file.read(read_size)
+            if chunk:
+                buffer, position = buffer[position : ] + chunk, 0
+                continue
+        if error is not None:
+            raise error
+        yield item
+        position = end
+
+def iter_line_blocks(file_path: str, start: int = 0, end: int = None, read_size: int = COPY_BUFFER_SIZE):
+    """
+        Yields the lines of a binary file in blocks of about read_size bytes, every block holding whole b"\n" terminated lines
+        (the last line of the file may be unterminated), so callers can process many lines with bulk bytes operations.
+        Compressed files (see detect_compression) are decompressed on the fly.
+
+        start, end: Optional byte range of the file to read. A line belongs to the range its first byte falls in,
+                    so reading consecutive ranges yields exactly the lines of reading the whole file.
+                    In a zst file a frame belongs to the range its first byte falls in, and a line to the range of the frame its first decompressed
+                    byte is in (see get_zstd_frames). Other compressed files can't be split, all their lines belong to the range starting at 0.
+    """
+    compression = detect_compression(file_path)
+    if compression == "zst":
+        yield from iter_zstd_line_blocks(file_path, start, end, read_size)
+        return
+    if compression is not None:
+        if start == 0:
+            with open_compressed_file(file_path, 'rb', compression) as file:
+                yield from iter_file_line_blocks(file, 0, None, read_size)
+        return
+    with open(file_path, 'rb') as file:
+        position = 0
+        if start > 0:
+            file.seek(start - 1)
+            position = start - 1 + len(file.readline())
+        yield from iter_file_line_blocks(file, position, end, read_size)
+
+def iter_file_line_blocks(file, position: int, end: int, read_size: int):
+    """
+        Yields the line blocks of iter_line_blocks from a binary file object at the start of a line, which is at byte `position`,
+        up to the last line starting before end (or the end of the file if end is None).
+    """
+    rest = b""
+    while end is None or position < end:
+        chunk = file.read(read_size)
+        if not chunk:
+            if rest:
+                yield rest
+            return
+        block = rest + chunk
+        last_line_end = block.rfind(b"\n") + 1
+        (block, rest) = (block[ : last_line_end], block[last_line_end : ])
+        if end is not None and position + len(block) > end:
+            # Cut after the last line starting before end.
+            block = block[ : block.find(b"\n", max(end - position - 1, 0)) + 1]
+            rest = b""
+        position += len(block)
+        if block:
+            yield block
+    if rest and (end is None or position < end):
+        yield rest
+
+def get_zstd_frames(file_path: str):
+    """
+        Returns the (offset, size) of every data frame of a zst file, skipping skippable frames.
+        Only the frame and block headers are read, so nothing is decompressed and the zstandard package isn't needed.
+        A file written by a single compressor call has a single frame, so it must be compressed in frames (e.g. with `zstd --split`
+        or `pzstd`) for its frames to be labeled in parallel.
+    """
+    frames = []
+    with open(file_path, 'rb') as file:
+        file_size = os.fstat(file.fileno()).st_size
+        offset = 0
+        while offset < file_size:
+            file.seek(offset)
+            magic = file.read(4)
+            if len(magic) == 4 and int.from_bytes(magic, "little") & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+                offset += 8 + int.from_bytes(file.read(4), "little")
+                continue
+            if magic != COMPRESSION_MAGICS["zst"]:
+                raise ValueError(f"Invalid zstd frame at byte {offset} of {file_path}")
+            descriptor = file.read(1)[0]
+            single_segment = descriptor >> 5 & 1
+            # The descriptor is followed by the window descriptor (unless single segment), the dictionary id and the frame content size.
+            position = offset + 5 + (1 - single_segment) + [0, 1, 2, 4][descriptor & 3] + [single_segment, 2, 4, 8][descriptor >> 6]
+            is_last_block = False
+            while not is_last_block:
+                file.seek(position)
+                block_header = file.read(3)
+                if len(block_header) < 3:
+                    raise ValueError(f"Truncated zstd frame at byte {offset} of {file_path}")
+                block_header = int.from_bytes(block_header, "little")
+                (is_last_block, block_type, block_size) = (block_header & 1, block_header >> 1 & 3, block_header >> 3)
+                if block_type == 3:
+                    raise ValueError(f"Invalid zstd block at byte {position} of {file_path}")
+                # An RLE block holds a single byte repeated block_size times.
+                position += 3 + (1 if block_type == 1 else block_size)
+            if descriptor >> 2 & 1:
+                position += 4
+            frames.append((offset, position - offset))
+            offset = position
+    return frames
+
+def iter_zstd_frames_data(file, frames: list, read_size: int):
+    """
+        Yields the decompressed data of the provided frames of a binary zst file object, in pieces of at most read_size bytes.
+    """
+    if zstandard is None:
+        raise ImportError(f"Reading {file.name} requires the zstandard package (pip install zstandard)")
+    decompressor = zstandard.ZstdDecompressor()
+    for (offset, size) in frames:
+        file.seek(offset)
+        reader = decompressor.stream_reader(file, read_size=min(size, read_size) or 1, read_across_frames=False, closefd=False)
+        for piece in iter(lambda: reader.read(read_size), b""):
+            yield piece
+
+def iter_zstd_line_blocks(file_path: str, start: int, end: int, read_size: int):
+    """
+        The zst version of iter_line_blocks. Decompresses only the frames starting in the range, the last decompressed byte of the frames before it
+        (to tell if the range starts in the middle of a line, which belongs to the previous range), and the frames after it up to the end
+        of the last line starting in the range.
+    """
+    frames = get_zstd_frames(file_path)
+    frames_before = [frame for frame in frames if frame[0] < start]
+    frames_in_range = [frame for frame in frames if frame[0] >= start and (end is None or frame[0] < end)]
+    frames_after = [frame for frame in frames if end is not None and frame[0] >= end]
+    with open(file_path, 'rb') as file:
+        skip_line = False
+        for frame in reversed(frames_before):
+            last_piece = b""
+            for piece in iter_zstd_frames_data(file, [frame], read_size):
+                last_piece = piece
+            if last_piece:
+                skip_line = not last_piece.endswith(b"\n")
+                break
+        rest = b""
+        for piece in iter_zstd_frames_data(file, frames_in_range, read_size):
+            if skip_line:
+                line_end = piece.find(b"\n")
+                if line_end < 0:
+                    continue
+                (piece, skip_line) = (piece[line_end + 1 : ], False)
+            block = rest + piece
+            last_line_end = block.rfind(b"\n") + 1
+            (block, rest) = (block[ : last_line_end], block[last_line_end : ])
+            if block:
+                yield block
+        if rest:
+            # The last line starting in the range ends in the frames after it.
+            for piece in iter_zstd_frames_data(file, frames_after, read_size):
+                line_end = piece.find(b"\n")
+                rest += piece if line_end < 0 else piece[ : line_end + 1]
+                if line_end >= 0:
+                    break
+            yield rest
+
+class RollingRecordsWriter:
+    """
+        Writes labeled records to the numbered files "{directory}/{name}_{index}.json", starting a new file every max_entries records.
+        Files are only created once a record is written to them, and are buffered by the underlying file object.
+        Every file is written to a temporary file (see add_path_tag) that atomically replaces it once closed (see replace_file), so an interrupted
+        run never leaves a partial file.
+        If a catalog is provided (see CorpusCatalog.CorpusCatalog), the records of every file are counted and recorded to it once the file is closed.
+    """
+    def __init__(self, directory: str, name: str, max_entries: int, compress: str = None, file_index: int = 0, catalog=None):
+        self.directory = directory
+        self.name = name
+        self.max_entries = max_entries
+        self.compress = compress
+        self.file_index = file_index
+        self.file = None
+        self.file_path = None
+        self.temp_path = None
+        self.file_entries = 0
+        self.total_records = 0
+        self.catalog = catalog
+        self.file_counts = None
+
+    def write(self, record):
+        if self.file is None or self.file_entries >= self.max_entries:
+            self._open_next_file()
+        self.file.write(json.dumps(record))
+        self.file.write("\n")
+        if self.file_counts is not None:
+            self.file_counts.add(record)
+        self.file_entries += 1
+        self.total_records += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            replace_file(self.temp_path, self.file_path)
+            if self.catalog is not None:
+                self.catalog.record_file(self.file_path, "shard", self.file_counts)
+
+    def _open_next_file(self):
+        if self.file is not None:
+            self.close()
+            self.file_index += 1
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = f"{self.name}_{self.file_index}.json" + (COMPRESSED_SUFFIXES[self.compress] if self.compress else "")
+        self.file_path = os.path.join(self.directory, file_name)
+        self.temp_path = add_path_tag(self.file_path, ".tmp")
+        self.file = open_labeled_file(self.temp_path, 'w')
+        self.file_counts = self.catalog.new_file_counts() if self.catalog is not None else None
+        self.file_entries = 0
+
+def concatenate_files(source_paths: list, file_path: str):
+    """
+        Concatenates the provided files, in order, to a single file and deletes them.
+        Line-delimited labeled data files (and their gzip, bz2, xz or zstd streams) stay valid when concatenated.
+    """
+    with open(file_path, 'wb') as file:
+        for source_path in source_paths:
+            with open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, file, COPY_BUFFER_SIZE)
+            os.remove(source_path)
+
+def replace_file(temp_path: str, file_path: str):
+    """
+        Atomically replaces file_path with the fully written temp_path. The content of temp_path is flushed to disk before it is renamed
+        over file_path, so after a crash file_path holds either its old or its new content, never a partial file.
+    """
+    with open(temp_path, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+def get_file_fingerprint(file_path: str):
+    """
+        Returns the [size, modification time in ns] of the file, which changes whenever the file is rewritten, or None if it doesn't exist.
+    """
+    if not os.path.isfile(file_path):
+        return None
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class RunJournal:
+    """
+        An append-only journal of the files a long run completed, one json entry {"key": key, ...} per line, so a restarted run can skip them.
+        Files are keyed by their path relative to the directory of the journal. Every entry is flushed to disk as it is recorded,
+        a line cut by a crash is ignored, and the last entry of a key wins.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.entries = {}
+        is_cut = False
+        if os.path.isfile(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    is_cut = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["key"]] = entry
+        self.file = open(path, 'a')
+        if is_cut:
+            # End the cut line, so the next entry starts a line of its own.
+            self.file.write("\n")
+
+    def get_key(self, file_path: str):
+        return os.path.relpath(os.path.abspath(file_path), self.directory).replace("\\", "/")
+
+    def get(self, file_path: str):
+        """
+            Returns the last entry recorded for the file, or None.
+        """
+        return self.entries.get(self.get_key(file_path))
+
+    def record(self, file_path: str, **values):
+        entry = {"key": self.get_key(file_path), **values}
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[entry["key"]] = entry
+
+    def close(self):
+        self.file.close()
+
+def pop_cli_option(argv: list, name: str, default=None):
+    """
+        Removes a "--name value" option from argv and returns its value, or default if the option is missing.
+        Used by the entry points so the positional arguments keep their indices.
+    """
+    option = f"--{name}"
+    if option not in argv:
+        return default
+    index = argv.index(option)
+    value = argv[index + 1]
+    del argv[index : index + 2]
+    return value
+
+def pop_cli_flag(argv: list, name: str):
+    """
+        Removes a "--name" flag from argv and returns True if it was provided.
+    """
+    option = f"--{name}"
+    if option not in argv:
+        return False
+    argv.remove(option)
+    return True
+
+def get_file_hash(file_path: str):
+    """
+        Returns the sha1 hex digest of the file's content, read in COPY_BUFFER_SIZE chunks.
+    """
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_BUFFER_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
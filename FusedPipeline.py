@@ -0,0 +1,172 @@
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from pathlib import Path
+import DataLabelingUtils
+import Deduplication
+import Instrumentation
+from CreateProbabilityDistribution import COUNT_DICTIONARIES_NAMES, PASSWORDS_BATCH_SIZE, RATIOS, count_passwords, render_pattern_counts, save_count_dictionaries, create_probability_distributions
+from DataLabelingUtils import iter_origin_labels, is_legal_password, is_short_and_not_date
+from DataPreparation import MAX_FILE_ENTRIES, get_files_to_label, write_country_meta_data
+from FilesUtils import add_path_tag, get_labeled_data_path, open_labeled_file, pop_cli_option, replace_file, save_json_array_to_file, RollingRecordsWriter
+
+class CountryCounter:
+    """
+        The count dictionaries of a country built by the fused pipeline. Passwords are checked like enrich_counts_from_files checks them
+        and counted in batches of PASSWORDS_BATCH_SIZE.
+    """
+    def __init__(self):
+        self.count_dics = [Counter() for _ in COUNT_DICTIONARIES_NAMES]
+        self.passwords = []
+        self.total_passwords = 0
+        self.ilegal_passwords = 0
+
+    def add(self, password: str):
+        password = str(password).removesuffix("\n")
+        if (not is_legal_password(password)) or is_short_and_not_date(password):
+            self.ilegal_passwords += 1
+            return
+        self.passwords.append(password)
+        if len(self.passwords) >= PASSWORDS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        [prefix_count, base_word_count, suffix_count, shift_pattern_count, leet_pattern_count] = self.count_dics
+        count_passwords(self.passwords, base_word_count, prefix_count, suffix_count, shift_pattern_count, leet_pattern_count)
+        self.total_passwords += len(self.passwords)
+        self.passwords = []
+
+    def counts(self):
+        """
+            Returns the counts in the format of CreateProbabilityDistribution.count_files: (count_dics, total_passwords, ilegal_passwords).
+        """
+        self.flush()
+        return (render_pattern_counts(self.count_dics), self.total_passwords, self.ilegal_passwords)
+
+def run_fused_pipeline(path: str, destination_path: str, countries: set = None, intermediates_path: str = None, compress: str = None, ratios: list = RATIOS, deduplicator: Deduplication.Deduplicator = None):
+    """
+        Builds the sub models of every country from the raw dumps in `path` in a single pass, instead of labeling, cleaning, sharding and counting
+        the corpus in separate passes. Every raw row is labeled (iter_origin_labels), routed to its country like shard_labeled_data routes it,
+        and its password is counted to the country's count dictionaries right away. Only the count dictionaries and the distributions of every
+        country are written, to "{destination_path}/{country}" like count_dict_to_distribution_dict writes them, with a meta_data.json of
+        {country: #_of_passwords} labeled in destination_path.
+        Cleaning is not repeated: the labeler already drops the passwords CleanLabeledData drops, so cleaning freshly labeled data changes nothing.
+
+        Args:
+            path: path to the raw data
+            destination_path: path of the models
+            countries: optional allow-list of countries to build models for. If None, every labeled country gets a model.
+            intermediates_path: If provided, the intermediate artifacts are also written for auditing: the labeled data files and meta_data.json next to
+                                the raw files, as DataPreparation's label writes them, and the country files of every country under intermediates_path,
+                                as its shard writes them. Every intermediate file is written to a temporary file that atomically replaces it
+                                once complete, like DataPreparation.label_file writes them, so a failed file never leaves a partial labeled data file.
+            compress: optional compression of the intermediate files (see FilesUtils.COMPRESSED_SUFFIXES)
+            ratios: the ratios of the sub models
+            deduplicator: optional Deduplication.Deduplicator dropping the rows whose email:password pair was already labeled, before they are written or counted
+        Returns:
+            dict: a dictionary of {country: #_of_passwords} counted.
+    """
+    domains_count = defaultdict(int)
+    counters = {}
+    writers = {}
+    for file_path in get_files_to_label(path):
+        with Instrumentation.measure("fused", file_path, profile=True) as measurement:
+            start_lines = DataLabelingUtils.labeling_stats["lines"]
+            labeled_path = get_labeled_data_path(file_path, compress)
+            temp_path = add_path_tag(labeled_path, ".tmp")
+            labeled_file = open_labeled_file(temp_path, 'w') if intermediates_path is not None else None
+            records_out = 0
+            try:
+                users = iter_origin_labels(file_path, domains_count)
+                if deduplicator is not None:
+                    users = deduplicator.iter_unique_records(users, domains_count)
+                for user in users:
+                    if labeled_file is not None:
+                        labeled_file.write(json.dumps(user))
+                        labeled_file.write("\n")
+                    country = user['country']
+                    if country is None or country == "null" or (countries is not None and country not in countries):
+                        continue
+                    if is_short_and_not_date(user['password']):
+                        continue
+                    if intermediates_path is not None:
+                        if country not in writers:
+                            writers[country] = RollingRecordsWriter(intermediates_path + "" f"/{country}", country, MAX_FILE_ENTRIES, compress)
+                        writers[country].write(user)
+                    if country not in counters:
+                        counters[country] = CountryCounter()
+                    counters[country].add(user['password'])
+                    records_out += 1
+                if labeled_file is not None:
+                    labeled_file.close()
+                    replace_file(temp_path, labeled_path)
+            except Exception as e:
+                print(e, file_path)
+            finally:
+                if labeled_file is not None and os.path.isfile(temp_path):
+                    labeled_file.close()
+                    os.remove(temp_path)
+            measurement.add(records_in=DataLabelingUtils.labeling_stats["lines"] - start_lines, records_out=records_out, bytes_read=Instrumentation.get_file_size(file_path))
+
+    domains_count["total"] = sum(domains_count.values())
+    if deduplicator is not None:
+        domains_count["duplicates"] = deduplicator.total_duplicates()
+    Path(destination_path).mkdir(parents=True, exist_ok=True)
+    save_json_array_to_file(domains_count, os.path.join(destination_path, "meta_data.json"))
+    if intermediates_path is not None:
+        save_json_array_to_file(domains_count, path + "/meta_data.json")
+        countries_count = {}
+        for country, writer in writers.items():
+            writer.close()
+            write_country_meta_data(intermediates_path, country, writer.total_records)
+            countries_count[country] = writer.total_records
+        countries_count["total"] = sum(countries_count.values())
+        save_json_array_to_file(countries_count, intermediates_path + "/meta_data.json")
+
+    countries_count = {}
+    for country, counter in counters.items():
+        with Instrumentation.measure("distribution", country):
+            country_destination_path = os.path.join(destination_path, country)
+            Path(country_destination_path).mkdir(parents=True, exist_ok=True)
+            count_dics = save_count_dictionaries(counter.counts(), True, country_destination_path)
+            create_probability_distributions(count_dics, country_destination_path, ratios)
+        countries_count[country] = counter.total_passwords
+    return countries_count
+
+def main():
+    """
+        Builds the sub models of every country from raw dumps in a single pass.
+        Usage: python FusedPipeline.py <path> <destination_path> [--countries <country>,<country>...] [--intermediates <country_files_path>] [--compress <gz/bz2/xz/zst>] [--domain_cache <cache_path>] [--dedup <bloom/exact>] [--metrics <report_path>]
+        Args:
+            path (str): path to the raw data
+            destination_path (str): path of the models
+            --countries (str): comma separated allow-list of countries to build models for. Defaults to all countries.
+            --intermediates (str): path to write the country files to. If provided, the labeled data files are also written next to the raw data.
+            --compress (str): compression of the intermediate files, one of FilesUtils.COMPRESSED_SUFFIXES. Defaults to no compression.
+            --domain_cache (str): path of a {domain: country} cache file to load before labeling and to save after it.
+            --dedup, --dedup_path, --dedup_capacity, --dedup_error_rate: Drop the repeated email:password pairs (see Deduplication.create_deduplicator_from_cli).
+                The number of dropped rows is saved to meta_data.json as "duplicates".
+            --metrics, --metrics_format, --profile: Instrumentation report options (see Instrumentation.enable_from_cli). Defaults to no report.
+    """
+    Instrumentation.enable_from_cli(sys.argv)
+    countries = pop_cli_option(sys.argv, "countries")
+    intermediates_path = pop_cli_option(sys.argv, "intermediates")
+    compress = pop_cli_option(sys.argv, "compress")
+    domain_cache_path = pop_cli_option(sys.argv, "domain_cache")
+    deduplicator = Deduplication.create_deduplicator_from_cli(sys.argv)
+    path = sys.argv[1]
+    destination_path = sys.argv[2].replace("\\", "/")
+    if domain_cache_path:
+        DataLabelingUtils.load_domain_cache(domain_cache_path)
+    with Instrumentation.measure("fused"):
+        countries_count = run_fused_pipeline(path, destination_path, set(countries.split(",")) if countries else None, intermediates_path.replace("\\", "/") if intermediates_path else None, compress, RATIOS, deduplicator)
+    if domain_cache_path:
+        DataLabelingUtils.save_domain_cache(domain_cache_path)
+    if deduplicator is not None:
+        deduplicator.close()
+    print(f"Built the models of {len(countries_count)} countries from {sum(countries_count.values())} passwords")
+    Instrumentation.save_report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import heapq
+import json
+import sys
+import time
+import DistributionStore
+import FilesUtils
+from ModelTrainingUtils import LEET_TRANSFORMATIONS
+
+# The distribution files of the components, in the order of CreateProbabilityDistribution.COUNT_DICTIONARIES_NAMES
+COMPONENT_NAMES = ["prefix", "base_word", "suffix", "shift_pattern", "leet_pattern"]
+LEET_ID_TO_TRANSFORMATION = {leet_index: (leet_char, unleet_letter) for leet_char, (leet_index, unleet_letter) in LEET_TRANSFORMATIONS.items() if isinstance(leet_char, str)}
+
+def load_sorted_components(path: str, ratio: int = None):
+    """
+        Loads the five component distributions of the model in path (the "{ratio}_a*" files, or "a*" if ratio is None)
+        as lists of (value, p) pairs sorted by descending probability. The shift and leet patterns are parsed back to tuples of ints.
+    """
+    components = []
+    for index, name in enumerate(COMPONENT_NAMES):
+        file_name = f"a{index + 1}" if ratio is None else f"{ratio}_a{index + 1}"
+        distribution = DistributionStore.open_distribution(path, file_name)
+        items = sorted(distribution.items(), key=lambda item: item[1], reverse=True)
+        if isinstance(distribution, DistributionStore.BinaryDistribution):
+            distribution.close()
+        if name in ("shift_pattern", "leet_pattern"):
+            items = [(parse_pattern(key), value) for key, value in items]
+        components.append(items)
+    return components
+
+def parse_pattern(pattern: str):
+    """
+        Parses the string form of a shift pattern ("[0, -1]") or a leet pattern ("(1, 2)") to a tuple of ints.
+    """
+    inner = pattern.strip("[]()")
+    return tuple(int(value) for value in inner.split(",") if value.strip())
+
+def apply_patterns(base_word: str, shift_pattern: tuple, leet_pattern: tuple):
+    """
+        Applies a leet pattern and then a shift pattern to a (lowercase, unleet) base word, reverting ModelTrainingUtils.extract_password_features.
+        Every letter of a transformation in the leet pattern is replaced by its leet character, and the letters at the shift pattern's positions
+        (non-negative from the start of the left half, negative from the end of the right half) are capitalized.
+        Returns None if the patterns can't have been extracted from the base word: the base word of a password with letters starts and ends
+        with its first and last letters, so a transformation can't replace them, and the transformations are listed in the order their
+        leet characters first appear. A word left without letters can only be a whole password (see has_letters).
+    """
+    word = base_word
+    for leet_index in leet_pattern:
+        (leet_char, unleet_letter) = LEET_ID_TO_TRANSFORMATION[leet_index]
+        if unleet_letter not in word:
+            return None
+        word = word.replace(unleet_letter, leet_char)
+    if has_letters(word) and not (word[0].isalpha() and word[-1].isalpha()):
+        return None
+    leet_char_indices = [word.index(LEET_ID_TO_TRANSFORMATION[leet_index][0]) for leet_index in leet_pattern]
+    if leet_char_indices != sorted(leet_char_indices):
+        return None
+    if len(shift_pattern) == 0:
+        return word
+    length = len(word)
+    mid_index = length // 2
+    letters = list(word)
+    for position in shift_pattern:
+        index = position if position >= 0 else length + position
+        if (position >= 0 and index >= mid_index) or (position < 0 and index < mid_index) or not letters[index].isalpha():
+            return None
+        letters[index] = letters[index].upper()
+    return "".join(letters)
+
+def has_letters(word: str):
+    """
+        Returns True if the word has a letter. A password without letters is a base word without a prefix or suffix (see ModelTrainingUtils.extract_password_features).
+    """
+    return any(char.isalpha() for char in word)
+
+class SortedComponent:
+    """
+        A component of the model: its values sorted by descending probability, with their probabilities.
+        The (value, p) pairs are pulled from the provided iterable only as far as the enumeration reaches, so a component can be a lazy stream.
+    """
+    def __init__(self, items):
+        self.values = []
+        self.probabilities = []
+        self.items = iter(items)
+        self.exhausted = False
+
+    def has(self, index: int):
+        """
+            Returns True if the component has a value at the provided index, pulling values from the stream up to it.
+        """
+        while index >= len(self.values) and not self.exhausted:
+            try:
+                (value, probability) = next(self.items)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.values.append(value)
+            self.probabilities.append(probability)
+        return index < len(self.values)
+
+def expand_best_first(components: list):
+    """
+        Lazily yields (indices, p) for the index tuples of the cross product of the SortedComponents in descending order of p,
+        the product of the components' probabilities at the indices.
+        A heap holds the frontier of index tuples, and every popped tuple pushes its successors (one index incremented). Only the dimensions
+        up to the tuple's first non-zero index are incremented, so every tuple has a single parent (the tuple with its first non-zero index
+        decremented), no visited set is needed and the heap is bounded by the frontier.
+    """
+    if not all(component.has(0) for component in components):
+        return
+    dimensions = range(len(components))
+    heappush, heappop = heapq.heappush, heapq.heappop
+    start = (0,) * len(components)
+    frontier = [(-probability_of(components, start), start)]
+    while frontier:
+        (negative_probability, indices) = heappop(frontier)
+        yield (indices, -negative_probability)
+        for dimension in dimensions:
+            index = indices[dimension]
+            component = components[dimension]
+            if index + 1 < len(component.values) or component.has(index + 1):
+                successor = indices[ : dimension] + (index + 1,) + indices[dimension + 1 : ]
+                probabilities = component.probabilities
+                if probabilities[index] > 0:
+                    # The successor differs in a single component, so its probability is updated by that component's ratio.
+                    heappush(frontier, (negative_probability / probabilities[index] * probabilities[index + 1], successor))
+                else:
+                    heappush(frontier, (-probability_of(components, successor), successor))
+            if index > 0:
+                break
+
+def probability_of(components: list, indices: tuple):
+    """
+        Returns the product of the probabilities of the components at the provided indices.
+    """
+    probability = 1.0
+    for component, index in zip(components, indices):
+        probability *= component.probabilities[index]
+    return probability
+
+def iter_patterned_base_words(base_words: SortedComponent, shift_patterns: SortedComponent, leet_patterns: SortedComponent):
+    """
+        Lazily yields (base word with its shift and leet patterns applied, p) pairs in descending order of p, skipping patterns that don't fit their base word.
+    """
+    for (base_word_index, shift_index, leet_index), probability in expand_best_first([base_words, shift_patterns, leet_patterns]):
+        base_word = apply_patterns(base_words.values[base_word_index], shift_patterns.values[shift_index], leet_patterns.values[leet_index])
+        if base_word is not None:
+            yield (base_word, probability)
+
+def enumerate_guesses(path: str, ratio: int = None, components: list = None):
+    """
+        Lazily yields (guess, p) pairs of the model in path in descending order of probability, where a guess is prefix + base word
+        (with the shift and leet patterns applied) + suffix and p is the product of the components' probabilities.
+        Base words without letters are only guessed with the empty prefix and suffix, as no other guess of them is decomposed to them.
+        The cross product is never materialized: the patterned base words are themselves a lazy best-first stream over the base words, shift
+        and leet patterns (see iter_patterned_base_words), and the guesses are a best-first expansion of the prefixes, that stream and the suffixes.
+        Memory is bounded by the two frontiers and the patterned base words the enumeration reached.
+
+        Args:
+            path: The path of the model, holding the "distributions" directory
+            ratio: The ratio of the sub model to use. If None, the full distributions are used.
+            components: Optional components as returned by load_sorted_components, to reuse them across runs.
+    """
+    if components is None:
+        components = load_sorted_components(path, ratio)
+    [prefixes, base_words, suffixes, shift_patterns, leet_patterns] = [SortedComponent(component) for component in components]
+    patterned_base_words = SortedComponent(iter_patterned_base_words(base_words, shift_patterns, leet_patterns))
+    for (prefix_index, base_word_index, suffix_index), probability in expand_best_first([prefixes, patterned_base_words, suffixes]):
+        (prefix, base_word, suffix) = (prefixes.values[prefix_index], patterned_base_words.values[base_word_index], suffixes.values[suffix_index])
+        if (prefix or suffix) and not has_letters(base_word):
+            continue
+        yield (prefix + base_word + suffix, probability)
+
+def guess_numbers(path: str, passwords: list, max_guesses: int, ratio: int = None):
+    """
+        Enumerates up to max_guesses guesses of the model and returns the guess number (1-based) of every password that was guessed,
+        with the coverage (the fraction of the passwords guessed) and the enumeration time.
+    """
+    remaining = set(passwords)
+    found = {}
+    start = time.perf_counter()
+    for guess_number, (guess, _) in enumerate(enumerate_guesses(path, ratio), 1):
+        if guess in remaining:
+            remaining.discard(guess)
+            found[guess] = guess_number
+            if not remaining:
+                break
+        if guess_number >= max_guesses:
+            break
+    return {
+        "guess_numbers": found,
+        "coverage": sum(1 for password in passwords if password in found) / len(passwords) if passwords else 0.0,
+        "seconds": time.perf_counter() - start
+    }
+
+def main():
+    """
+        Prints the most probable guesses of a model, or the guess numbers and coverage of a passwords file.
+        Usage: python GuessEnumerator.py <model_path> <max_guesses> [--ratio <ratio>] [--passwords <passwords_path>]
+        Args:
+            model_path: The path of the model, holding the "distributions" directory
+            max_guesses: The number of guesses to enumerate
+            --ratio: The ratio of the sub model to use. Defaults to the full distributions.
+            --passwords: A file of passwords, one per line. If provided, prints their guess numbers and coverage instead of the guesses.
+    """
+    ratio = FilesUtils.pop_cli_option(sys.argv, "ratio")
+    ratio = int(ratio) if ratio else None
+    passwords_path = FilesUtils.pop_cli_option(sys.argv, "passwords")
+    path = sys.argv[1]
+    max_guesses = int(sys.argv[2])
+    if passwords_path:
+        with open(passwords_path, "r") as file:
+            passwords = [line.removesuffix("\n") for line in file]
+        print(json.dumps(guess_numbers(path, passwords, max_guesses, ratio), indent=4))
+        return
+    for guess_number, (guess, probability) in enumerate(enumerate_guesses(path, ratio), 1):
+        print(f"{guess}\t{probability}")
+        if guess_number >= max_guesses:
+            break
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from FilesUtils import pop_cli_option, save_json_array_to_file
+try:
+    import resource
+except ImportError:
+    # resource is Unix only. Without it the peak RSS isn't measured, and the CPU time of the child processes is taken from os.times().
+    resource = None
+
+REPORT_FORMATS = ["json", "prometheus"]
+METRIC_PREFIX = "modeltraining"
+COUNTERS = ["records_in", "records_out", "bytes_read", "bytes_written"]
+TOP_FUNCTIONS_COUNT = 30
+# ru_maxrss is in bytes on macOS and in kilobytes on the other Unix platforms.
+MAXRSS_PER_MB = 1024 * 1024 if sys.platform == "darwin" else 1024
+
+metrics = None
+
+class Measurement:
+    """
+        The counters of a single measured stage or file. Call sites add to them with add() whether or not instrumentation is enabled.
+    """
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def add(self, **counters):
+        for name, value in counters.items():
+            self.counters[name] += value
+
+class SamplingProfiler:
+    """
+        A statistical profiler of the hot functions: while started, a SIGPROF timer fires every `interval` seconds of CPU time and the
+        stack of the interrupted frame is counted, by the stage it was sampled in, as a collapsed stack ("outer;...;inner").
+        Starting and stopping nests, so a hot function inside another hot function keeps the timer running.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self.stages = []
+
+    def start(self, stage: str):
+        if len(self.stages) == 0:
+            signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.stages.append(stage)
+
+    def stop(self):
+        self.stages.pop()
+        if len(self.stages) == 0:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def sample(self, signal_number, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(self.stages[-1] if self.stages else "idle")
+        self.samples[";".join(reversed(stack))] += 1
+
+    def top_functions(self, count: int):
+        """
+            Returns the `count` functions with the most samples, with the samples they were running in (self) and on the stack in (total).
+        """
+        self_samples, total_samples = Counter(), Counter()
+        for stack, samples in self.samples.items():
+            frames = stack.split(";")[1 : ]
+            if len(frames) == 0:
+                continue
+            self_samples[frames[-1]] += samples
+            for frame in set(frames):
+                total_samples[frame] += samples
+        return [{"function": function, "self_samples": samples, "total_samples": total_samples[function]} for function, samples in self_samples.most_common(count)]
+
+class Metrics:
+    """
+        Collects the measurements of a run: for every stage, and every file of every stage, the wall time, CPU time (of the process and of its
+        finished child processes), the records in and out, the bytes read and written and the peak RSS.
+        File counters are summed into their stage. The time of a stage is the time of its own measure() blocks, and the time of its files
+        that were measured outside of them.
+    """
+    def __init__(self, report_path: str, report_format: str = "json", profile_interval: float = 0.0):
+        self.report_path = report_path
+        self.report_format = report_format
+        self.stages = {}
+        self.files = {}
+        self.active_stages = Counter()
+        self.profiler = None
+        if profile_interval > 0:
+            if is_profiling_available():
+                self.profiler = SamplingProfiler(profile_interval)
+            else:
+                print("Profiling unavailable: the sampling profiler needs SIGPROF and setitimer, and to be enabled from the main thread. Profiling is disabled.")
+
+    def record(self, stage: str, file_path: str, measurement: Measurement, wall_seconds: float, cpu_seconds: float, children_cpu_seconds: float, peak_rss_mb: float = None):
+        stage_entry = self.stages.setdefault(stage, create_entry())
+        entries = [stage_entry]
+        if file_path is None or self.active_stages[stage] == 0:
+            add_time(stage_entry, wall_seconds, cpu_seconds, children_cpu_seconds)
+        if file_path is not None:
+            file_entry = self.files.setdefault(stage, {}).setdefault(file_path, create_entry())
+            add_time(file_entry, wall_seconds, cpu_seconds, children_cpu_seconds)
+            entries.append(file_entry)
+        if peak_rss_mb is None:
+            peak_rss_mb = get_peak_rss_mb()
+        for entry in entries:
+            for name, value in measurement.counters.items():
+                entry[name] += value
+            if peak_rss_mb is not None:
+                entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak_rss_mb)
+
+    def to_dict(self):
+        report = {"stages": self.stages, "files": self.files}
+        if self.profiler is not None:
+            report["profile"] = {
+                "interval_seconds": self.profiler.interval,
+                "samples": sum(self.profiler.samples.values()),
+                "top_functions": self.profiler.top_functions(TOP_FUNCTIONS_COUNT)
+            }
+        return report
+
+    def to_prometheus(self):
+        """
+            Returns the measurements in the Prometheus text exposition format, to be picked up by the node exporter's textfile collector.
+        """
+        lines = []
+        metric_names = ["calls", "wall_seconds", "cpu_seconds", "children_cpu_seconds"] + COUNTERS + ["peak_rss_mb"]
+        for level, entries in [("stage", {(stage, None): entry for stage, entry in self.stages.items()}),
+                               ("file", {(stage, file_path): entry for stage, files in self.files.items() for file_path, entry in files.items()})]:
+            for metric_name in metric_names:
+                name = f"{METRIC_PREFIX}_{level}_{metric_name}"
+                lines.append(f"# TYPE {name} gauge")
+                for (stage, file_path), entry in entries.items():
+                    labels = f'stage="{escape_label(stage)}"' + (f',file="{escape_label(file_path)}"' if file_path is not None else "")
+                    lines.append(f"{name}{{{labels}}} {entry[metric_name]}")
+        if self.profiler is not None:
+            name = f"{METRIC_PREFIX}_profile_self_samples"
+            lines.append(f"# TYPE {name} gauge")
+            for function in self.profiler.top_functions(TOP_FUNCTIONS_COUNT):
+                lines.append(f'{name}{{function="{escape_label(function["function"])}"}} {function["self_samples"]}')
+        return "\n".join(lines) + "\n"
+
+def create_entry():
+    entry = {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "children_cpu_seconds": 0.0, "peak_rss_mb": 0.0}
+    entry.update(dict.fromkeys(COUNTERS, 0))
+    return entry
+
+def add_time(entry: dict, wall_seconds: float, cpu_seconds: float, children_cpu_seconds: float):
+    entry["calls"] += 1
+    entry["wall_seconds"] += wall_seconds
+    entry["cpu_seconds"] += cpu_seconds
+    entry["children_cpu_seconds"] += children_cpu_seconds
+
+def escape_label(value: str):
+    """
+        Escapes a Prometheus label value.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def is_profiling_available():
+    """
+        Returns whether the sampling profiler can run here: it needs the SIGPROF signal and setitimer (Unix only), and signal handlers can only
+        be set from the main thread.
+    """
+    return hasattr(signal, "SIGPROF") and hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+def get_peak_rss_mb(children: bool = True):
+    """
+        Returns the peak resident set size of the process, or of its largest finished child process if larger and children, in MB.
+        The peak only grows, so the peak of a file is the process' peak up to the end of the file.
+        Returns None if the platform doesn't provide it (no resource module).
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak_rss = max(peak_rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak_rss / MAXRSS_PER_MB
+
+def get_children_cpu_seconds():
+    if resource is None:
+        times = os.times()
+        return times.children_user + times.children_system
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def enable(report_path: str, report_format: str = "json", profile_interval: float = 0.0):
+    """
+        Enables the instrumentation of the process. The report is written to report_path by save_report.
+        Args:
+            report_path: The path of the report file
+            report_format: One of REPORT_FORMATS
+            profile_interval: If > 0, the hot functions are sampled every profile_interval seconds of CPU time.
+    """
+    global metrics
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Unknown metrics format {report_format}, expected one of {REPORT_FORMATS}")
+    metrics = Metrics(report_path, report_format, profile_interval)
+
+def enable_from_cli(argv: list):
+    """
+        Removes the instrumentation options from argv and enables the instrumentation if --metrics was provided.
+        Options:
+            --metrics <path>: The path of the report
+            --metrics_format <json/prometheus>: The format of the report. Defaults to json.
+            --profile <seconds>: The sampling interval of the hot functions. Defaults to no profiling.
+    """
+    report_path = pop_cli_option(argv, "metrics")
+    report_format = pop_cli_option(argv, "metrics_format", "json")
+    profile_interval = float(pop_cli_option(argv, "profile", 0.0))
+    if report_path:
+        enable(report_path, report_format, profile_interval)
+
+@contextmanager
+def measure(stage: str, file_path: str = None, profile: bool = False):
+    """
+        Measures the block as the stage, or as a file of the stage if file_path is provided, and yields a Measurement to add the block's counters to.
+        If profile, the block is sampled by the profiler (if profiling is enabled). Does nothing but yield the Measurement if instrumentation is disabled.
+    """
+    measurement = Measurement()
+    if metrics is None:
+        yield measurement
+        return
+    profiler = metrics.profiler if profile else None
+    if profiler is not None:
+        profiler.start(stage)
+    if file_path is None:
+        metrics.active_stages[stage] += 1
+    start, start_cpu, start_children_cpu = time.perf_counter(), time.process_time(), get_children_cpu_seconds()
+    try:
+        yield measurement
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if file_path is None:
+            metrics.active_stages[stage] -= 1
+        metrics.record(stage, file_path, measurement, time.perf_counter() - start, time.process_time() - start_cpu, get_children_cpu_seconds() - start_children_cpu)
+
+def record(stage: str, file_path: str = None, wall_seconds: float = 0.0, cpu_seconds: float = 0.0, children_cpu_seconds: float = 0.0, peak_rss_mb: float = None, **counters):
+    """
+        Records a measurement taken elsewhere, e.g. by a worker process, as if it was a measure() block. Does nothing if instrumentation is disabled.
+    """
+    if metrics is None:
+        return
+    measurement = Measurement()
+    measurement.add(**counters)
+    metrics.record(stage, file_path, measurement, wall_seconds, cpu_seconds, children_cpu_seconds, peak_rss_mb)
+
+def get_file_size(file_path: str):
+    """
+        Returns the size of the file, or 0 if it doesn't exist.
+    """
+    return os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+
+def save_report():
+    """
+        Writes the report of the enabled instrumentation, in its format, and the collapsed stacks of the profiler to "{report_path}.stacks"
+        (the input format of flamegraph.pl). Does nothing if instrumentation is disabled.
+    """
+    if metrics is None:
+        return
+    if metrics.report_format == "prometheus":
+        with open(metrics.report_path, "w") as file:
+            file.write(metrics.to_prometheus())
+    else:
+        save_json_array_to_file(metrics.to_dict(), metrics.report_path)
+    if metrics.profiler is not None:
+        with open(metrics.report_path + ".stacks", "w") as file:
+            for stack, samples in metrics.profiler.samples.most_common():
+                file.write(f"{stack} {samples}\n")
@@ -1,6 +1,13 @@
 import codecs
 import re
 
+# The keys 6 and 9 are ints, so they never match a character of a password and "6"/"9" are not transformed.
+LEET_TRANSFORMATIONS = {"0": (1, "o"), "@": (2, "a"), "4": (3, "a"), "$": (4, "s"), "5": (5, "s"), "3": (6, "e"), 6: (7, "g"), 9: (8, "g"), "+": (9, "t"), "7": (10, "t"), "2": (11, "z"), "1": (12, "i"), "!": (13, "i"), "%": (14, "x")}
+UNLEET_TABLE = str.maketrans({leet_char: unleet_letter for leet_char, (_, unleet_letter) in LEET_TRANSFORMATIONS.items() if isinstance(leet_char, str)})
+LEET_ID_BITS = 4
+LEET_ID_MASK = (1 << LEET_ID_BITS) - 1
+FEATURE_NAMES = ("prefix", "base_word", "suffix", "shift_pattern", "leet_pattern", "unleet_base_word")
+
 def get_first_letter_index(password: str):
     """
         Gets the index of the first letter of the password
@@ -65,21 +72,103 @@ def get_base_word_leet_pattern(password):
         Gets the leet pattern of the base word of the provided password, according to the leet transformations described in https://arxiv.org/abs/1912.02551.
     """
     leet_pattern = []
-    unleet_password = ""
-    leet_transformations_dict = {"0": (1, "o"), "@": (2, "a"), "4": (3, "a"), "$": (4, "s"), "5": (5, "s"), "3": (6, "e"), 6: (7, "g"), 9: (8, "g"), "+": (9, "t"), "7": (10, "t"), "2": (11, "z"), "1": (12, "i"), "!": (13, "i"), "%": (14, "x")}
     unleet_letters = set()
-    for (_, letter) in enumerate(password):
-        if letter in leet_transformations_dict.keys():
-            (index, unleet_letter) = leet_transformations_dict[letter]
-            unleet_password += unleet_letter
+    for letter in password:
+        if letter in LEET_TRANSFORMATIONS:
+            (index, unleet_letter) = LEET_TRANSFORMATIONS[letter]
             if unleet_letter in unleet_letters:
                 continue
             unleet_letters.add(unleet_letter)
             leet_pattern.append(index)
-        else:
-            unleet_password += letter
+    unleet_password = password.translate(UNLEET_TABLE) if leet_pattern else password
     return tuple(leet_pattern), unleet_password
 
+def extract_password_features(password: str):
+    """
+        Computes in a single scan of the password all the features parse_password_to_3d, get_base_word_shift_pattern and get_base_word_leet_pattern compute.
+        Returns a tuple of (prefix, base_word, suffix, shift_pattern, leet_pattern, unleet_base_word), ordered as FEATURE_NAMES, where:
+            prefix, base_word, suffix: as returned by parse_password_to_3d(password)
+            shift_pattern: the code of get_base_word_shift_pattern(base_word) (see render_shift_pattern)
+            (leet_pattern, unleet_base_word): the code of the leet pattern (see render_leet_pattern) and the base word, as returned by get_base_word_leet_pattern(base_word)
+        The patterns are returned as int codes, so no list or string is built for them per password. Small ints are shared by the interpreter,
+        so counting the codes doesn't allocate either.
+    """
+    first_letter_index, last_letter_index = -1, -1
+    shift_indices = []
+    leet_indices = []
+    for index, char in enumerate(password):
+        if char.isalpha():
+            if first_letter_index < 0:
+                first_letter_index = index
+            last_letter_index = index
+            if not char.islower():
+                shift_indices.append(index)
+        elif char in LEET_TRANSFORMATIONS:
+            leet_indices.append(index)
+    length = len(password)
+    start = max(first_letter_index, 0)
+    end = last_letter_index + 1 if 0 <= last_letter_index < length - 1 else length
+    base_word = password[start : end]
+
+    base_word_length = end - start
+    mid_index = base_word_length // 2
+    shift_pattern = 0
+    for index in shift_indices:
+        index -= start
+        shift_pattern |= 1 << (2 * index if index < mid_index else 2 * (base_word_length - index) - 1)
+
+    leet_pattern = 0
+    leet_shift = 0
+    unleet_letters = set()
+    for index in leet_indices:
+        if start <= index < end:
+            (leet_index, unleet_letter) = LEET_TRANSFORMATIONS[password[index]]
+            if unleet_letter not in unleet_letters:
+                unleet_letters.add(unleet_letter)
+                leet_pattern |= leet_index << leet_shift
+                leet_shift += LEET_ID_BITS
+    unleet_base_word = base_word.translate(UNLEET_TABLE) if leet_pattern else base_word
+    return (password[ : start], base_word, password[end : ], shift_pattern, leet_pattern, unleet_base_word)
+
+def render_shift_pattern(code: int):
+    """
+        Renders the code of a shift pattern to the string form of get_base_word_shift_pattern's list, e.g. "[0, -1]".
+        The code is a bitmask interleaving the two halves of the base word: the position q of the left half is bit 2q, and the position -j
+        from the end of the right half is bit 2j - 1.
+    """
+    left_pattern, right_pattern = [], []
+    bit = 0
+    while code:
+        if code & 1:
+            if bit % 2 == 0:
+                left_pattern.append(bit // 2)
+            else:
+                right_pattern.append(-(bit + 1) // 2)
+        code >>= 1
+        bit += 1
+    return str(left_pattern + right_pattern[::-1])
+
+def render_leet_pattern(code: int):
+    """
+        Renders the code of a leet pattern to the string form of get_base_word_leet_pattern's tuple, e.g. "(3, 1)".
+        The code holds the ids of the pattern's transformations in LEET_ID_BITS bits each, the first id in the lowest bits. Ids are never 0,
+        and the order of the ids is kept, as patterns with the same ids in another order are different keys of the model.
+    """
+    leet_pattern = []
+    while code:
+        leet_pattern.append(code & LEET_ID_MASK)
+        code >>= LEET_ID_BITS
+    return str(tuple(leet_pattern))
+
+def extract_password_features_batch(passwords):
+    """
+        Runs extract_password_features on a list (or any iterable) of passwords.
+        Returns the results column-wise, as a dictionary of {feature_name: [feature of each password]} with the names of FEATURE_NAMES.
+    """
+    features = list(map(extract_password_features, passwords))
+    columns = zip(*features) if features else ([] for _ in FEATURE_NAMES)
+    return {name: list(column) for name, column in zip(FEATURE_NAMES, columns)}
+
 def escape_password(password: str):
     escape_password = codecs.encode(password, 'unicode_escape')
     return escape_password
@@ -0,0 +1,246 @@
+import json
+import math
+import multiprocessing
+import random
+import statistics
+import sys
+import time
+import DistributionStore
+import FilesUtils
+import ModelTrainingUtils
+
+# The distribution files of the components, in the order of CreateProbabilityDistribution.COUNT_DICTIONARIES_NAMES
+COMPONENT_NAMES = ["prefix", "base_word", "suffix", "shift_pattern", "leet_pattern"]
+COMPONENT_CACHE_MAX_SIZE = 1000000
+SCORE_CHUNK_SIZE = 10000
+
+scorer = None
+
+class PasswordScorer:
+    """
+        Estimates the strength of passwords with a trained sub model, as in https://arxiv.org/abs/1912.02551.
+        A password is decomposed with the training logic (ModelTrainingUtils.extract_password_features) and its probability is the product
+        of the probabilities of its prefix, base word, suffix, shift pattern and leet pattern. The strength is -log2 of the probability,
+        and if sample_size > 0 the guess rank is estimated from a Monte Carlo sample of the model (Dell'Amico & Filippone, CCS 2015).
+        The probability of every component value is cached, so repeated prefixes, suffixes and patterns cost a dictionary hit.
+
+        Args:
+            path: The path of the model, holding the "distributions" directory
+            ratio: The ratio of the sub model to use (the "{ratio}_a*" files). If None, the full distributions ("a*") are used.
+            sample_size: The number of model samples for rank estimation. If 0, ranks are not estimated.
+            seed: The seed of the Monte Carlo sample
+    """
+    def __init__(self, path: str, ratio: int = None, sample_size: int = 0, seed: int = 0):
+        self.distributions = []
+        for index in range(len(COMPONENT_NAMES)):
+            file_name = f"a{index + 1}" if ratio is None else f"{ratio}_a{index + 1}"
+            self.distributions.append(DistributionStore.open_distribution(path, file_name))
+        self.caches = [{} for _ in COMPONENT_NAMES]
+        self.sample_probabilities = []
+        self.sample_ranks = [0.0]
+        if sample_size > 0:
+            self.create_rank_sample(sample_size, seed)
+
+    def component_probability(self, index: int, key: str):
+        """
+            Returns the probability of the key in the component's distribution, through the component's cache.
+        """
+        cache = self.caches[index]
+        probability = cache.get(key)
+        if probability is None:
+            distribution = self.distributions[index]
+            probability = distribution.prob(key) if isinstance(distribution, DistributionStore.BinaryDistribution) else distribution.get(key, 0.0)
+            if len(cache) >= COMPONENT_CACHE_MAX_SIZE:
+                cache.clear()
+            cache[key] = probability
+        return probability
+
+    def probability(self, password: str):
+        """
+            Returns the model probability of the password.
+        """
+        (prefix, _, suffix, shift_pattern, leet_pattern, unleet_base_word) = ModelTrainingUtils.extract_password_features(password)
+        keys = (prefix, unleet_base_word.lower(), suffix, ModelTrainingUtils.render_shift_pattern(shift_pattern), ModelTrainingUtils.render_leet_pattern(leet_pattern))
+        probability = 1.0
+        for index, key in enumerate(keys):
+            probability *= self.component_probability(index, key)
+            if probability == 0.0:
+                break
+        return probability
+
+    def score(self, password: str):
+        """
+            Returns a dictionary of the probability, the strength in bits and the estimated guess rank (None if ranks are not estimated) of the password.
+        """
+        probability = self.probability(password)
+        return {
+            "probability": probability,
+            "strength": -math.log2(probability) if probability > 0 else math.inf,
+            "rank": self.estimate_rank(probability)
+        }
+
+    def score_batch(self, passwords):
+        """
+            Scores a list (or any iterable) of passwords. Returns the results column-wise, as a dictionary of {"probability": [...], "strength": [...], "rank": [...]}.
+        """
+        probabilities = list(map(self.probability, passwords))
+        return {
+            "probability": probabilities,
+            "strength": [-math.log2(probability) if probability > 0 else math.inf for probability in probabilities],
+            "rank": list(map(self.estimate_rank, probabilities))
+        }
+
+    def create_rank_sample(self, sample_size: int, seed: int):
+        """
+            Samples sample_size passwords from the model and keeps their probabilities sorted in descending order, with the prefix sums of 1 / (sample_size * p)
+            that estimate_rank uses.
+        """
+        generator = random.Random(seed)
+        self.sample_probabilities = [1.0] * sample_size
+        for distribution in self.distributions:
+            items = list(distribution.items())
+            if len(items) == 0:
+                self.sample_probabilities = [0.0] * sample_size
+                break
+            cumulative_weights = list(accumulate_weights(value for _, value in items))
+            sample = generator.choices(items, cum_weights=cumulative_weights, k=sample_size)
+            self.sample_probabilities = [probability * value for probability, (_, value) in zip(self.sample_probabilities, sample)]
+        self.sample_probabilities = sorted((probability for probability in self.sample_probabilities if probability > 0), reverse=True)
+        self.sample_ranks = [0.0]
+        for probability in self.sample_probabilities:
+            self.sample_ranks.append(self.sample_ranks[-1] + 1 / (sample_size * probability))
+
+    def estimate_rank(self, probability: float):
+        """
+            Estimates the number of passwords the model guesses before a password of the provided probability, or None if ranks are not estimated.
+            A password of probability 0 is never guessed, so its rank is infinite, like its strength.
+        """
+        if len(self.sample_probabilities) == 0:
+            return None
+        if probability <= 0:
+            return math.inf
+        # The number of sampled passwords that are more probable than the provided probability.
+        more_probable = count_greater(self.sample_probabilities, probability)
+        return self.sample_ranks[more_probable]
+
+def accumulate_weights(values):
+    """
+        Yields the running sums of the values.
+    """
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+def count_greater(descending_values: list, value: float):
+    """
+        Returns the number of items of a list sorted in descending order that are greater than value.
+    """
+    low, high = 0, len(descending_values)
+    while low < high:
+        mid = (low + high) // 2
+        if descending_values[mid] > value:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+def init_scorer_worker(path: str, ratio: int, sample_size: int):
+    """
+        Loads the process' scorer once. With the fork start method the scorer score_passwords_parallel loaded in the parent is inherited
+        and shared as is (the binary distributions are read-only memory maps), so it is only loaded by workers that are spawned.
+    """
+    global scorer
+    if scorer is None:
+        scorer = PasswordScorer(path, ratio, sample_size)
+
+def score_chunk(passwords: list):
+    """
+        Scores a chunk of passwords with the process' scorer. Runs inside a worker process of score_passwords_parallel.
+    """
+    return scorer.score_batch(passwords)
+
+def score_passwords_parallel(passwords: list, path: str, ratio: int = None, sample_size: int = 0, workers: int = None, loaded_scorer: PasswordScorer = None):
+    """
+        Scores the passwords with a pool of `workers` processes in chunks of SCORE_CHUNK_SIZE passwords.
+        With the fork start method the model is loaded once, by the parent (or loaded_scorer is used if provided, which must be the scorer of
+        path, ratio and sample_size), and the workers inherit it. Otherwise every worker loads the model once.
+        Returns the results column-wise, in the order of the passwords, like PasswordScorer.score_batch.
+    """
+    global scorer
+    scorer = None
+    if multiprocessing.get_start_method() == "fork":
+        scorer = loaded_scorer if loaded_scorer is not None else PasswordScorer(path, ratio, sample_size)
+    chunks = [passwords[index : index + SCORE_CHUNK_SIZE] for index in range(0, len(passwords), SCORE_CHUNK_SIZE)]
+    results = {"probability": [], "strength": [], "rank": []}
+    with multiprocessing.Pool(processes=workers, initializer=init_scorer_worker, initargs=(path, ratio, sample_size)) as pool:
+        for chunk_results in pool.imap(score_chunk, chunks):
+            for name, column in chunk_results.items():
+                results[name].extend(column)
+    return results
+
+def benchmark_scorer(path: str, passwords: list, ratio: int = None, sample_size: int = 0, workers: int = None):
+    """
+        Measures the model load time, the latency of scoring a single password (mean, p50 and p99, on a cold and a warm cache),
+        and the throughput of score_batch and of score_passwords_parallel on the provided passwords.
+        Returns the results as a dictionary.
+    """
+    results = {"passwords": len(passwords), "ratio": ratio, "sample_size": sample_size}
+    start = time.perf_counter()
+    benchmarked_scorer = PasswordScorer(path, ratio, sample_size)
+    results["load_seconds"] = time.perf_counter() - start
+
+    for cache_state in ["cold", "warm"]:
+        latencies = []
+        for password in passwords[ : 10000]:
+            start = time.perf_counter()
+            benchmarked_scorer.score(password)
+            latencies.append((time.perf_counter() - start) * 1e6)
+        latencies.sort()
+        results[f"{cache_state}_latency_microseconds"] = {
+            "mean": statistics.fmean(latencies) if latencies else 0.0,
+            "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p99": latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+        }
+
+    start = time.perf_counter()
+    benchmarked_scorer.score_batch(passwords)
+    results["batch_passwords_per_second"] = len(passwords) / max(time.perf_counter() - start, 1e-9)
+
+    start = time.perf_counter()
+    score_passwords_parallel(passwords, path, ratio, sample_size, workers, benchmarked_scorer)
+    results["parallel_passwords_per_second"] = len(passwords) / max(time.perf_counter() - start, 1e-9)
+    return results
+
+def main():
+    """
+        Scores the passwords in a file, one password per line, and prints "password<TAB>probability<TAB>strength<TAB>rank" per password.
+        Usage: python PasswordScorer.py <model_path> <passwords_path> [--ratio <ratio>] [--sample_size <n>] [--workers <n>] [--benchmark]
+        Args:
+            model_path: The path of the model, holding the "distributions" directory
+            passwords_path: A file of passwords, one per line
+            --ratio: The ratio of the sub model to use. Defaults to the full distributions.
+            --sample_size: The Monte Carlo sample size for rank estimation. Defaults to 0, which does not estimate ranks.
+            --workers: The number of scoring processes. Defaults to 1.
+            --benchmark: Print the benchmark_scorer results instead of the scores.
+    """
+    ratio = FilesUtils.pop_cli_option(sys.argv, "ratio")
+    ratio = int(ratio) if ratio else None
+    sample_size = int(FilesUtils.pop_cli_option(sys.argv, "sample_size", 0))
+    workers = int(FilesUtils.pop_cli_option(sys.argv, "workers", 1))
+    benchmark = FilesUtils.pop_cli_flag(sys.argv, "benchmark")
+    path = sys.argv[1]
+    with open(sys.argv[2], "r") as file:
+        passwords = [line.removesuffix("\n") for line in file]
+    if benchmark:
+        print(json.dumps(benchmark_scorer(path, passwords, ratio, sample_size, workers), indent=4))
+        return
+    if workers > 1:
+        results = score_passwords_parallel(passwords, path, ratio, sample_size, workers)
+    else:
+        results = PasswordScorer(path, ratio, sample_size).score_batch(passwords)
+    for password, probability, strength, rank in zip(passwords, results["probability"], results["strength"], results["rank"]):
+        print(f"{password}\t{probability}\t{strength}\t{rank}")
+
+if __name__ == "__main__":
+    main()